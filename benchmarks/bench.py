@@ -0,0 +1,261 @@
+"""
+bench.py
+Benchmark parsing and the main query paths on synthetic books
+
+Books of several sizes are generated with synthbook.py into a temporary
+directory (or --workdir, which caches them between runs). For each size
+this measures parse time, peak traced memory during the parse, memory
+retained by the loaded book with and without string interning, and the
+time taken by walk, find_account, find_guid, ledger and get_all_splits,
+by reconciling a statement against the account with most splits, and
+by publishing the book with share_book and rolling up its balances.
+The parse time is also split into I/O (reading and decompressing), XML
+parsing and building the book, for the gzip file and an uncompressed copy,
+with both the default ElementTree backend and the expat backend.
+A book with --schedules scheduled transactions is forecast ten years
+ahead, as a generator and in columnar form, and a monthly budget for a
+book with 1000 accounts is compared with the actual amounts. Finally, the time to start
+Python and import gnucashxml is measured in fresh processes, which also
+fails if the import loads one of DEFERRED_MODULES.
+Times are in seconds (best of --repeat runs), memory in megabytes.
+
+Results can be stored with --save and compared against an earlier run
+with --compare, which prints the relative change per measurement.
+
+Usage: PYTHONPATH=. python benchmarks/bench.py [--sizes 1000,10000] [--repeat 3]
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gnucashxml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthbook  # noqa: E402
+
+
+# Modules that import gnucashxml must leave to the code using them
+DEFERRED_MODULES = ("asyncio", "csv", "dateutil.parser", "gzip", "hashlib",
+                    "http.server", "json", "lxml.etree", "multiprocessing")
+
+
+def timeit(func, repeat):
+    """Return the best wall time of repeat calls to func, and its last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def peak_memory(func):
+    """Return the peak traced memory in bytes while running func."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(func):
+    """Return the traced memory in bytes still held by the result of func."""
+    tracemalloc.start()
+    try:
+        result = func()
+        retained = tracemalloc.get_traced_memory()[0]
+        del result
+        return retained
+    finally:
+        tracemalloc.stop()
+
+
+def book_path(workdir, transactions):
+    path = os.path.join(workdir, "synth-{}.gnucash".format(transactions))
+    if not os.path.exists(path):
+        synthbook.write_book(path,
+                             accounts=max(20, transactions // 100),
+                             transactions=transactions,
+                             prices=max(10, transactions // 10),
+                             customers=max(5, transactions // 1000),
+                             invoices=max(10, transactions // 20))
+    return path
+
+
+def io_breakdown(path, repeat, backend="etree"):
+    """Return the io, xml and build times of the fastest of repeat loads."""
+    best = None
+    for _ in range(repeat):
+        stats = gnucashxml.from_filename(path, stats=True, backend=backend).load_stats
+        if best is None or stats.total < best.total:
+            best = stats
+    io = best.sections.get("read", 0.0) + best.sections.get("decompress", 0.0)
+    xml = best.sections["xml"]
+    return io, xml, best.total - io - xml
+
+
+def bench_size(path, repeat):
+    results = {}
+    results["parse"], book = timeit(lambda: gnucashxml.from_filename(path), repeat)
+    results["parse_expat"], _ = timeit(
+        lambda: gnucashxml.from_filename(path, backend="expat"), repeat)
+    results["parse_peak_mb"] = peak_memory(lambda: gnucashxml.from_filename(path)) / 1e6
+    results["retained_mb"] = retained_memory(lambda: gnucashxml.from_filename(path)) / 1e6
+    results["retained_mb_nointern"] = retained_memory(
+        lambda: gnucashxml.from_filename(path, intern=False)) / 1e6
+
+    rng = random.Random(0)
+    names = [acc.name for acc in rng.sample(book.accounts, min(20, len(book.accounts)))]
+    guids = [trn.guid for trn in rng.sample(book.transactions, min(20, len(book.transactions)))]
+
+    results["walk"], _ = timeit(lambda: sum(len(splits) for _, _, splits in book.walk()), repeat)
+    results["find_account"], _ = timeit(lambda: [book.find_account(name) for name in names], repeat)
+    results["find_guid"], _ = timeit(lambda: [book.find_guid(guid) for guid in guids], repeat)
+    results["ledger"], _ = timeit(book.ledger, repeat)
+    results["get_all_splits"], _ = timeit(book.root_account.get_all_splits, repeat)
+
+    # a statement for the busiest account, dates shifted by up to two days
+    account = max(book.accounts, key=lambda acc: len(acc.splits))
+    statement = [{"date": split.transaction.date.date() + datetime.timedelta(days=rng.randint(-2, 2)),
+                  "amount": split.quantity, "reference": split.transaction.num}
+                 for split in account.splits]
+    results["reconcile"], _ = timeit(lambda: gnucashxml.reconcile(account, statement), repeat)
+    results["share_book"], shared = timeit(lambda: gnucashxml.share_book(book), 1)
+    try:
+        results["shared_rollup"], _ = timeit(shared.rollup, repeat)
+    finally:
+        shared.close()
+        shared.unlink()
+    results["splits"] = sum(len(trn.splits) for trn in book.transactions)
+
+    plain = os.path.splitext(path)[0] + ".xml"
+    if not os.path.exists(plain):
+        with gzip.open(path, "rb") as src, open(plain, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    for name, filename in (("gzip", path), ("plain", plain)):
+        for backend in ("etree", "expat"):
+            prefix = name if backend == "etree" else name + "_expat"
+            io, xml, build = io_breakdown(filename, repeat, backend)
+            results[prefix + "_io"] = io
+            results[prefix + "_xml"] = xml
+            results[prefix + "_build"] = build
+    return results
+
+
+def bench_forecast(workdir, schedules, repeat):
+    path = os.path.join(workdir, "synth-sx-{}.gnucash".format(schedules))
+    if not os.path.exists(path):
+        synthbook.write_book(path, transactions=100, schedules=schedules)
+    book = gnucashxml.from_filename(path)
+    start = datetime.date(2020, 1, 1)
+    end = datetime.date(2030, 1, 1)
+    results = {}
+    results["forecast"], splits = timeit(lambda: list(book.forecast(start, end)), repeat)
+    results["forecast_columnar"], _ = timeit(lambda: book.forecast(start, end, columnar=True), repeat)
+    results["splits"] = len(splits)
+    return results
+
+
+def bench_import(repeat):
+    def run(code):
+        return subprocess.check_output([sys.executable, "-c", code],
+                                       universal_newlines=True).strip()
+
+    loaded = run("import sys, gnucashxml; print(' '.join(name for name in {!r} "
+                 "if name in sys.modules))".format(DEFERRED_MODULES))
+    if loaded:
+        raise SystemExit("import gnucashxml loaded {}".format(loaded))
+    results = {}
+    results["python_startup"], _ = timeit(lambda: run("pass"), repeat)
+    results["import"], _ = timeit(lambda: run("import gnucashxml"), repeat)
+    results["import"] -= results["python_startup"]
+    return results
+
+
+def bench_budget(workdir, repeat):
+    path = os.path.join(workdir, "synth-budget-1000.gnucash")
+    if not os.path.exists(path):
+        synthbook.write_book(path, accounts=1000, transactions=20000, budgets=1)
+    book = gnucashxml.from_filename(path)
+    results = {}
+    results["budget_vs_actual"], _ = timeit(lambda: book.budget_vs_actual(book.budgets[0]), repeat)
+    results["splits"] = sum(len(trn.splits) for trn in book.transactions)
+    return results
+
+
+def report(all_results, baseline=None):
+    def order(item):
+        return (0, int(item[0])) if item[0].isdigit() else (1, item[0])
+
+    for size, results in sorted(all_results.items(), key=order):
+        if size.isdigit():
+            print("{} transactions ({} splits)".format(size, results["splits"]))
+        elif "splits" in results:
+            print("{} ({} splits)".format(size, results["splits"]))
+        else:
+            print(size)
+        for key, value in results.items():
+            if key == "splits":
+                continue
+            line = "  {:20} {:12.4f}".format(key, value)
+            old = (baseline or {}).get(size, {}).get(key)
+            if old:
+                line += "  {:+7.1f}%".format((value - old) / old * 100)
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark gnucashxml on synthetic books")
+    parser.add_argument("--sizes", default="1000,10000,50000",
+                        help="comma separated transaction counts")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="directory to generate (and keep) books in")
+    parser.add_argument("--schedules", type=int, default=300,
+                        help="scheduled transactions in the forecast book")
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gnucashxml-bench-")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        all_results = {}
+        for size in args.sizes.split(","):
+            path = book_path(workdir, int(size))
+            all_results[size] = bench_size(path, args.repeat)
+        if args.schedules:
+            all_results["{} schedules, 10 years".format(args.schedules)] = bench_forecast(
+                workdir, args.schedules, args.repeat)
+        all_results["1000 account budget"] = bench_budget(workdir, args.repeat)
+        all_results["startup"] = bench_import(max(args.repeat, 5))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fobj:
+            baseline = json.load(fobj)
+    report(all_results, baseline)
+    if args.save:
+        with open(args.save, "w") as fobj:
+            json.dump(all_results, fobj, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+roundtrip.py
+Check that books survive parse -> write -> parse unchanged
+
+Synthetic books of several sizes are generated with synthbook.py, parsed,
+written back with gnucashxml.to_filename() and parsed again. Every
+field gnucashxml reads is compared between the two parsed books, and
+the time taken by the parse and the write is printed. Exits with status
+1 if any book differs, or if the parser filled a Book attribute that is
+not in COMPARED, so new sections cannot be left out of the writer
+unnoticed.
+
+Usage: PYTHONPATH=. python benchmarks/roundtrip.py [--sizes 100,10000]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import gnucashxml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthbook  # noqa: E402
+
+
+# Book attributes covered by book_records, and those that are not book data
+COMPARED = frozenset(("guid", "slots", "commodities", "prices", "root_account", "accounts",
+                      "transactions", "schedxactions", "budgets", "invoices"))
+NOT_DATA = frozenset(("tree", "load_stats", "verification", "exact", "_skipped",
+                      "_cost_basis", "_text_index"))
+
+
+def _commodity(commodity):
+    return commodity and (commodity.space, commodity.name)
+
+
+def _slots(slots):
+    return dict((key, _slots(value) if isinstance(value, dict) else value)
+                for key, value in (slots or {}).items())
+
+
+def book_records(book):
+    """Yield (kind, record) tuples covering every field gnucashxml reads."""
+    yield "book", (book.guid, _slots(book.slots))
+    root = book.root_account
+    yield "root", root and (root.guid, root.name, _slots(root.slots))
+    for commodity in book.commodities:
+        yield "commodity", _commodity(commodity)
+    for price in book.prices:
+        yield "price", (price.guid, _commodity(price.commodity),
+                        _commodity(price.currency), price.date, price.value)
+    for account in book.accounts:
+        yield "account", (account.guid, account.name, account.actype,
+                          account.parent.guid, _commodity(account.commodity),
+                          account.commodity_scu, account.description,
+                          _slots(account.slots), [split.guid for split in account.splits])
+        for lot in account.lots:
+            yield "lot", (lot.guid, _slots(lot.slots), [split.guid for split in lot.splits])
+    for trn in book.transactions:
+        yield "transaction", (trn.guid, _commodity(trn.currency), trn.date,
+                              trn.date_entered, trn.description, trn.num,
+                              _slots(trn.slots))
+        for split in trn.splits:
+            yield "split", (split.guid, split.memo, split.action,
+                            split.reconciled_state, split.reconcile_date,
+                            split.value, split.quantity, split.account.guid,
+                            split.lot and split.lot.guid, _slots(split.slots))
+    for sx in book.schedxactions:
+        template = sx.template_account
+        yield "schedxaction", (sx.guid, sx.name, sx.enabled, sx.start, sx.end, sx.last,
+                               sx.num_occur, sx.rem_occur, sx.instance_count,
+                               [(recurrence.mult, recurrence.period_type, recurrence.start,
+                                 recurrence.weekend_adj) for recurrence in sx.recurrences],
+                               template and (template.guid, template.name,
+                                             template.parent and template.parent.guid),
+                               _slots(sx.slots))
+        for trn in sx.transactions:
+            yield "template", (trn.guid, _commodity(trn.currency), trn.date,
+                               trn.description, _slots(trn.slots),
+                               [(split.guid, split.memo, split.value, split.account.guid,
+                                 _slots(split.slots)) for split in trn.splits])
+    for budget in book.budgets:
+        recurrence = budget.recurrence
+        yield "budget", (budget.guid, budget.name, budget.description, budget.num_periods,
+                         (recurrence.mult, recurrence.period_type, recurrence.start,
+                          recurrence.weekend_adj),
+                         sorted(budget.amounts.items()), _slots(budget.slots))
+    for invoice in book.invoices:
+        owner = invoice.customer or invoice.vendor
+        yield "invoice", (invoice.guid, invoice.id, invoice.date, invoice.active,
+                          owner.guid, owner.name, getattr(owner, "address", None))
+        for entry in invoice.entries:
+            taxtable = entry.taxtable
+            yield "entry", (entry.guid, entry.action, entry.description,
+                            entry.qty, entry.price, entry.taxable,
+                            taxtable and (taxtable.guid, taxtable.name,
+                                          [(tte.amount, tte.ttetype)
+                                           for tte in taxtable.taxtable_entries]))
+
+
+def compare(first, second):
+    """Return a list of differences between two books, empty if equal."""
+    differences = ["book.{} is not compared".format(name)
+                   for name in sorted(set(vars(first)) - COMPARED - NOT_DATA)]
+    old = list(book_records(first))
+    new = list(book_records(second))
+    if len(old) != len(new):
+        differences.append("{} records before, {} after".format(len(old), len(new)))
+    for before, after in zip(old, new):
+        if before != after:
+            differences.append("{}: {!r} != {!r}".format(before[0], before[1], after[1]))
+    return differences
+
+
+def roundtrip(path, workdir):
+    start = time.perf_counter()
+    book = gnucashxml.from_filename(path)
+    parsed = time.perf_counter()
+    output = os.path.join(workdir, "written.gnucash")
+    gnucashxml.to_filename(book, output)
+    written = time.perf_counter()
+    differences = compare(book, gnucashxml.from_filename(output))
+    return parsed - start, written - parsed, differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check parse/write round trips")
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated transaction counts")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="gnucashxml-roundtrip-")
+    failed = False
+    try:
+        for size in args.sizes.split(","):
+            size = int(size)
+            path = os.path.join(workdir, "synth-{}.gnucash".format(size))
+            synthbook.write_book(path, accounts=max(20, size // 100), transactions=size,
+                                 splits=2 + size % 3, prices=max(10, size // 10),
+                                 customers=max(5, size // 1000),
+                                 invoices=max(10, size // 20),
+                                 schedules=max(5, size // 100), budgets=2)
+            parse_time, write_time, differences = roundtrip(path, workdir)
+            print("{:8} transactions  parse {:8.3f}s  write {:8.3f}s  {}".format(
+                size, parse_time, write_time,
+                "{} differences".format(len(differences)) if differences else "ok"))
+            for line in differences[:10]:
+                print("    " + line[:200])
+            failed = failed or bool(differences)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+"""
+synthbook.py
+Generate deterministic synthetic GNU Cash v2 XML books
+
+The generated books are valid gnc-v2 files with a configurable number of
+accounts, transactions, splits per transaction, prices, customers,
+invoices, invoice entries and scheduled transactions. The same arguments and seed always
+produce byte-identical output, so benchmark runs are comparable.
+
+Usage: python synthbook.py OUTPUT [--transactions N] [--accounts N] ...
+"""
+
+import argparse
+import datetime
+import gzip
+import random
+from xml.sax.saxutils import escape
+
+NAMESPACES = ["gnc", "act", "book", "cd", "cmdty", "price", "slot", "split",
+              "trn", "ts", "cust", "addr", "entry", "invoice", "owner",
+              "taxtable", "tte", "vendor", "lot", "sx", "recurrence", "bgt"]
+
+ACCOUNT_TYPES = ["ASSET", "BANK", "CASH", "EXPENSE", "INCOME", "LIABILITY", "EQUITY"]
+WORDS = ["office", "rent", "coffee", "invoice", "salary", "travel", "train",
+         "hotel", "software", "license", "hosting", "phone", "insurance",
+         "tax", "refund", "consultancy", "hardware", "books", "lunch", "fuel"]
+RECONCILED = ["n", "n", "n", "c", "y"]
+PERIODS = [("month", 1), ("month", 1), ("month", 3), ("week", 2), ("end of month", 1),
+           ("nth weekday", 1), ("last weekday", 1), ("year", 1), ("day", 7)]
+TZ = "+0100"
+
+
+class _Writer(object):
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.parts = []
+
+    def __call__(self, text):
+        self.parts.append(text)
+        if len(self.parts) > 4096:
+            self.flush()
+
+    def flush(self):
+        self.fobj.write("".join(self.parts).encode("utf-8"))
+        self.parts = []
+
+
+def _guid(rng):
+    return "%032x" % rng.getrandbits(128)
+
+
+def _ts(d):
+    return "{:%Y-%m-%d %H:%M:%S} {}".format(d, TZ)
+
+
+def _number(cents, denom=100):
+    return "{}/{}".format(cents, denom)
+
+
+def _commodity(w, tag, space, name):
+    w("  <{0}>\n    <cmdty:space>{1}</cmdty:space>\n    <cmdty:id>{2}</cmdty:id>\n  </{0}>\n"
+      .format(tag, space, name))
+
+
+def generate(fobj, accounts=50, transactions=1000, splits=2, prices=100,
+             customers=10, invoices=50, entries=3, commodities=5, seed=1,
+             schedules=0, budgets=0):
+    """
+    Write a synthetic book to the binary file object fobj.
+
+    splits is the number of splits per transaction (at least 2), entries
+    the number of entries per invoice. commodities is the number of
+    non-currency commodities that prices are recorded for. schedules is
+    the number of scheduled transactions, each with a two-split template.
+    budgets is the number of monthly budgets, one per year from the start,
+    with amounts for about half of the accounts.
+    """
+    rng = random.Random(seed)
+    w = _Writer(fobj)
+    start = datetime.datetime(2010, 1, 1, 9, 0, 0)
+    splits = max(2, splits)
+
+    w('<?xml version="1.0" encoding="utf-8" ?>\n<gnc-v2\n')
+    w("\n".join('     xmlns:{0}="http://www.gnucash.org/XML/{0}"'.format(ns)
+                for ns in NAMESPACES))
+    w(">\n")
+    w('<gnc:count-data cd:type="book">1</gnc:count-data>\n')
+    w('<gnc:book version="2.0.0">\n')
+    w('<book:id type="guid">{}</book:id>\n'.format(_guid(rng)))
+    w('<book:slots>\n  <slot>\n    <slot:key>features</slot:key>\n'
+      '    <slot:value type="frame">\n      <slot>\n'
+      '        <slot:key>Register sort and filter settings stored in .gcm file</slot:key>\n'
+      '        <slot:value type="string">Store the register sort and filter settings in .gcm metadata file (requires at least GnuCash 3.3)</slot:value>\n'
+      '      </slot>\n    </slot:value>\n  </slot>\n</book:slots>\n')
+    counts = [("commodity", commodities + 1), ("account", accounts + 1),
+              ("transaction", transactions)]
+    if customers:
+        counts.append(("gnc:GncCustomer", customers))
+    if invoices and customers:
+        counts.append(("gnc:GncEntry", invoices * entries))
+        counts.append(("gnc:GncInvoice", invoices))
+        counts.append(("gnc:GncTaxTable", 1))
+    if prices:
+        counts.append(("price", prices))
+    if schedules:
+        counts.append(("schedxaction", schedules))
+    if budgets:
+        counts.append(("budget", budgets))
+    for cdtype, count in counts:
+        w('<gnc:count-data cd:type="{}">{}</gnc:count-data>\n'.format(cdtype, count))
+
+    w('<gnc:commodity version="2.0.0">\n  <cmdty:space>ISO4217</cmdty:space>\n'
+      '  <cmdty:id>EUR</cmdty:id>\n  <cmdty:get_quotes/>\n  <cmdty:quote_source>currency</cmdty:quote_source>\n'
+      '  <cmdty:quote_tz/>\n</gnc:commodity>\n')
+    stocks = ["STK{:03d}".format(i) for i in range(commodities)]
+    for name in stocks:
+        w('<gnc:commodity version="2.0.0">\n  <cmdty:space>NASDAQ</cmdty:space>\n'
+          '  <cmdty:id>{0}</cmdty:id>\n  <cmdty:name>{0} Inc.</cmdty:name>\n'
+          '  <cmdty:fraction>10000</cmdty:fraction>\n</gnc:commodity>\n'.format(name))
+
+    if prices and stocks:
+        w('<gnc:pricedb version="1">\n')
+        for i in range(prices):
+            d = start + datetime.timedelta(days=i * 3650 // max(prices, 1))
+            w('<price>\n  <price:id type="guid">{}</price:id>\n'.format(_guid(rng)))
+            _commodity(w, "price:commodity", "NASDAQ", stocks[i % len(stocks)])
+            _commodity(w, "price:currency", "ISO4217", "EUR")
+            w('  <price:time>\n    <ts:date>{}</ts:date>\n  </price:time>\n'
+              '  <price:source>user:price</price:source>\n'
+              '  <price:value>{}</price:value>\n</price>\n'
+              .format(_ts(d), _number(rng.randint(1000, 500000), 10000)))
+        w('</gnc:pricedb>\n')
+
+    root_guid = _guid(rng)
+    w('<gnc:account version="2.0.0">\n  <act:name>Root Account</act:name>\n'
+      '  <act:id type="guid">{}</act:id>\n  <act:type>ROOT</act:type>\n'
+      '  <act:commodity>\n    <cmdty:space>ISO4217</cmdty:space>\n    <cmdty:id>EUR</cmdty:id>\n'
+      '  </act:commodity>\n  <act:commodity-scu>100</act:commodity-scu>\n'
+      '</gnc:account>\n'.format(root_guid))
+    account_guids = []
+    for i in range(accounts):
+        guid = _guid(rng)
+        if i < len(ACCOUNT_TYPES) or not account_guids:
+            actype = ACCOUNT_TYPES[i % len(ACCOUNT_TYPES)]
+            parent = root_guid
+        else:
+            parent_index = rng.randrange(len(account_guids))
+            actype = ACCOUNT_TYPES[parent_index % len(ACCOUNT_TYPES)]
+            parent = account_guids[parent_index]
+        account_guids.append(guid)
+        w('<gnc:account version="2.0.0">\n  <act:name>{0} {1}</act:name>\n'
+          '  <act:id type="guid">{2}</act:id>\n  <act:type>{3}</act:type>\n'
+          .format(rng.choice(WORDS).capitalize(), i, guid, actype))
+        _commodity(w, "act:commodity", "ISO4217", "EUR")
+        w('  <act:commodity-scu>100</act:commodity-scu>\n')
+        if i % 3 == 0:
+            w('  <act:description>Account number {}</act:description>\n'.format(i))
+        if i % 4 == 0:
+            w('  <act:slots>\n    <slot>\n      <slot:key>placeholder</slot:key>\n'
+              '      <slot:value type="string">false</slot:value>\n    </slot>\n'
+              '    <slot>\n      <slot:key>color</slot:key>\n'
+              '      <slot:value type="string">Not Set</slot:value>\n    </slot>\n  </act:slots>\n')
+        w('  <act:parent type="guid">{}</act:parent>\n</gnc:account>\n'.format(parent))
+
+    for i in range(transactions):
+        d = start + datetime.timedelta(minutes=i * 5256000 // max(transactions, 1))
+        w('<gnc:transaction version="2.0.0">\n  <trn:id type="guid">{}</trn:id>\n'.format(_guid(rng)))
+        _commodity(w, "trn:currency", "ISO4217", "EUR")
+        if i % 10 == 0:
+            w('  <trn:num>{}</trn:num>\n'.format(i))
+        w('  <trn:date-posted>\n    <ts:date>{0}</ts:date>\n  </trn:date-posted>\n'
+          '  <trn:date-entered>\n    <ts:date>{0}</ts:date>\n  </trn:date-entered>\n'
+          '  <trn:description>{1}</trn:description>\n'
+          .format(_ts(d), escape(" ".join(rng.sample(WORDS, 3)))))
+        w('  <trn:slots>\n    <slot>\n      <slot:key>date-posted</slot:key>\n'
+          '      <slot:value type="gdate">\n        <gdate>{:%Y-%m-%d}</gdate>\n'
+          '      </slot:value>\n    </slot>\n'.format(d))
+        if i % 7 == 0:
+            w('    <slot>\n      <slot:key>notes</slot:key>\n'
+              '      <slot:value type="string">{}</slot:value>\n    </slot>\n'
+              .format(" ".join(rng.sample(WORDS, 4))))
+        w('  </trn:slots>\n  <trn:splits>\n')
+        amounts = [rng.randint(-500000, 500000) for _ in range(splits - 1)]
+        amounts.append(-sum(amounts))
+        for amount in amounts:
+            w('    <trn:split>\n      <split:id type="guid">{}</split:id>\n'.format(_guid(rng)))
+            if rng.random() < 0.3:
+                w('      <split:memo>{}</split:memo>\n'.format(rng.choice(WORDS)))
+            if rng.random() < 0.1:
+                w('      <split:action>{}</split:action>\n'.format(rng.choice(["Buy", "Sell", "Deposit"])))
+            w('      <split:reconciled-state>{0}</split:reconciled-state>\n'
+              '      <split:value>{1}</split:value>\n'
+              '      <split:quantity>{1}</split:quantity>\n'
+              '      <split:account type="guid">{2}</split:account>\n'
+              '    </trn:split>\n'
+              .format(rng.choice(RECONCILED), _number(amount), rng.choice(account_guids)))
+        w('  </trn:splits>\n</gnc:transaction>\n')
+
+    if schedules:
+        # separate generator, so books without schedules stay unchanged
+        _schedules(w, random.Random("{}-schedules".format(seed)), schedules,
+                   account_guids, start)
+    if budgets:
+        _budgets(w, random.Random("{}-budgets".format(seed)), budgets,
+                 account_guids, start)
+
+    customer_guids = []
+    for i in range(customers):
+        guid = _guid(rng)
+        customer_guids.append(guid)
+        w('<gnc:GncCustomer version="2.0.0">\n  <cust:guid type="guid">{0}</cust:guid>\n'
+          '  <cust:name>Customer {1} {2}</cust:name>\n  <cust:id>{1:06d}</cust:id>\n'
+          '  <cust:addr version="2.0.0">\n    <addr:name>Customer {1}</addr:name>\n'
+          '    <addr:addr1>{3} street {1}</addr:addr1>\n    <addr:addr2>1234 AB Town</addr:addr2>\n'
+          '  </cust:addr>\n  <cust:notes></cust:notes>\n  <cust:terms/>\n'
+          '  <cust:taxincluded>USEGLOBAL</cust:taxincluded>\n  <cust:active>1</cust:active>\n'
+          '  <cust:discount>0/1</cust:discount>\n  <cust:credit>0/1</cust:credit>\n'
+          .format(guid, i, rng.choice(WORDS).capitalize(), rng.choice(WORDS).capitalize()))
+        _commodity(w, "cust:currency", "ISO4217", "EUR")
+        w('  <cust:use-tt>0</cust:use-tt>\n</gnc:GncCustomer>\n')
+
+    if invoices and customer_guids:
+        taxtable_guid = _guid(rng)
+        w('<gnc:GncTaxTable version="2.0.0">\n  <taxtable:guid type="guid">{}</taxtable:guid>\n'
+          '  <taxtable:name>VAT high</taxtable:name>\n  <taxtable:refcount>{}</taxtable:refcount>\n'
+          '  <taxtable:invisible>0</taxtable:invisible>\n  <taxtable:entries>\n'
+          '    <gnc:GncTaxTableEntry>\n      <tte:acct type="guid">{}</tte:acct>\n'
+          '      <tte:amount>2100000/100000</tte:amount>\n      <tte:type>PERCENT</tte:type>\n'
+          '    </gnc:GncTaxTableEntry>\n  </taxtable:entries>\n</gnc:GncTaxTable>\n'
+          .format(taxtable_guid, invoices * entries, account_guids[0]))
+        invoice_guids = [_guid(rng) for _ in range(invoices)]
+        for i in range(invoices * entries):
+            d = start + datetime.timedelta(days=i // max(entries, 1))
+            w('<gnc:GncEntry version="2.0.0">\n  <entry:guid type="guid">{}</entry:guid>\n'
+              '  <entry:date>\n    <ts:date>{}</ts:date>\n  </entry:date>\n'
+              '  <entry:description>{}</entry:description>\n  <entry:action>{}</entry:action>\n'
+              '  <entry:qty>{}</entry:qty>\n  <entry:i-acct type="guid">{}</entry:i-acct>\n'
+              '  <entry:i-price>{}</entry:i-price>\n  <entry:invoice type="guid">{}</entry:invoice>\n'
+              '  <entry:i-disc-type>PERCENT</entry:i-disc-type>\n  <entry:i-disc-how>PRETAX</entry:i-disc-how>\n'
+              '  <entry:i-taxable>{}</entry:i-taxable>\n  <entry:i-taxincluded>0</entry:i-taxincluded>\n'
+              '  <entry:i-taxtable type="guid">{}</entry:i-taxtable>\n</gnc:GncEntry>\n'
+              .format(_guid(rng), _ts(d), " ".join(rng.sample(WORDS, 2)),
+                      rng.choice(["Uren", "Materiaal"]), _number(rng.randint(100, 4000)),
+                      account_guids[0], _number(rng.randint(1000, 20000)),
+                      invoice_guids[i // entries], rng.choice([0, 1]), taxtable_guid))
+        for i, guid in enumerate(invoice_guids):
+            d = start + datetime.timedelta(days=i)
+            w('<gnc:GncInvoice version="2.0.0">\n  <invoice:guid type="guid">{}</invoice:guid>\n'
+              '  <invoice:id>{:%Y}.{:05d}</invoice:id>\n'
+              '  <invoice:owner version="2.0.0">\n    <owner:type>gncCustomer</owner:type>\n'
+              '    <owner:id type="guid">{}</owner:id>\n  </invoice:owner>\n'
+              '  <invoice:opened>\n    <ts:date>{}</ts:date>\n  </invoice:opened>\n'
+              '  <invoice:billing_id></invoice:billing_id>\n  <invoice:notes></invoice:notes>\n'
+              '  <invoice:active>1</invoice:active>\n'
+              .format(guid, d, i, customer_guids[i % len(customer_guids)], _ts(d)))
+            _commodity(w, "invoice:currency", "ISO4217", "EUR")
+            w('</gnc:GncInvoice>\n')
+
+    w('</gnc:book>\n</gnc-v2>\n')
+    w.flush()
+
+
+def _schedules(w, rng, schedules, account_guids, start):
+    template_root = _guid(rng)
+    template_accounts = [_guid(rng) for _ in range(schedules)]
+    sx_guids = [_guid(rng) for _ in range(schedules)]
+    w('<gnc:template-transactions>\n')
+    w('<gnc:account version="2.0.0">\n  <act:name>Template Root</act:name>\n'
+      '  <act:id type="guid">{}</act:id>\n  <act:type>ROOT</act:type>\n'
+      '</gnc:account>\n'.format(template_root))
+    for sx_guid, account_guid in zip(sx_guids, template_accounts):
+        w('<gnc:account version="2.0.0">\n  <act:name>{}</act:name>\n'
+          '  <act:id type="guid">{}</act:id>\n  <act:type>BANK</act:type>\n'.format(sx_guid, account_guid))
+        _commodity(w, "act:commodity", "template", "template")
+        w('  <act:commodity-scu>1</act:commodity-scu>\n'
+          '  <act:parent type="guid">{}</act:parent>\n</gnc:account>\n'.format(template_root))
+    for i, account_guid in enumerate(template_accounts):
+        d = start + datetime.timedelta(days=i)
+        w('<gnc:transaction version="2.0.0">\n  <trn:id type="guid">{}</trn:id>\n'.format(_guid(rng)))
+        _commodity(w, "trn:currency", "ISO4217", "EUR")
+        w('  <trn:date-posted>\n    <ts:date>{0}</ts:date>\n  </trn:date-posted>\n'
+          '  <trn:date-entered>\n    <ts:date>{0}</ts:date>\n  </trn:date-entered>\n'
+          '  <trn:description>Scheduled {1} {2}</trn:description>\n  <trn:splits>\n'
+          .format(_ts(d), rng.choice(WORDS), i))
+        amount = rng.randint(100, 200000)
+        for debit, credit in ((amount, 0), (0, amount)):
+            w('    <trn:split>\n      <split:id type="guid">{}</split:id>\n'
+              '      <split:reconciled-state>n</split:reconciled-state>\n'
+              '      <split:value>0/1</split:value>\n      <split:quantity>0/1</split:quantity>\n'
+              '      <split:account type="guid">{}</split:account>\n'
+              '      <split:slots>\n        <slot>\n          <slot:key>sched-xaction</slot:key>\n'
+              '          <slot:value type="frame">\n'
+              '            <slot>\n              <slot:key>account</slot:key>\n'
+              '              <slot:value type="guid">{}</slot:value>\n            </slot>\n'
+              '            <slot>\n              <slot:key>credit-formula</slot:key>\n'
+              '              <slot:value type="string">{}</slot:value>\n            </slot>\n'
+              '            <slot>\n              <slot:key>credit-numeric</slot:key>\n'
+              '              <slot:value type="numeric">{}</slot:value>\n            </slot>\n'
+              '            <slot>\n              <slot:key>debit-formula</slot:key>\n'
+              '              <slot:value type="string">{}</slot:value>\n            </slot>\n'
+              '            <slot>\n              <slot:key>debit-numeric</slot:key>\n'
+              '              <slot:value type="numeric">{}</slot:value>\n            </slot>\n'
+              '          </slot:value>\n        </slot>\n      </split:slots>\n    </trn:split>\n'
+              .format(_guid(rng), account_guid, rng.choice(account_guids),
+                      "{:.2f}".format(credit / 100.0) if credit else "", _number(credit),
+                      "{:.2f}".format(debit / 100.0) if debit else "", _number(debit)))
+        w('  </trn:splits>\n</gnc:transaction>\n')
+    w('</gnc:template-transactions>\n')
+
+    for i, (sx_guid, account_guid) in enumerate(zip(sx_guids, template_accounts)):
+        period, mult = PERIODS[i % len(PERIODS)]
+        d = start + datetime.timedelta(days=rng.randrange(365))
+        w('<gnc:schedxaction version="2.0.0">\n  <sx:id type="guid">{}</sx:id>\n'
+          '  <sx:name>Schedule {}</sx:name>\n  <sx:enabled>y</sx:enabled>\n'
+          '  <sx:autoCreate>n</sx:autoCreate>\n  <sx:autoCreateNotify>n</sx:autoCreateNotify>\n'
+          '  <sx:advanceCreateDays>0</sx:advanceCreateDays>\n'
+          '  <sx:advanceRemindDays>0</sx:advanceRemindDays>\n'
+          '  <sx:instanceCount>0</sx:instanceCount>\n'
+          '  <sx:start>\n    <gdate>{:%Y-%m-%d}</gdate>\n  </sx:start>\n'
+          .format(sx_guid, i, d))
+        if i % 5 == 1:
+            w('  <sx:num-occur>{}</sx:num-occur>\n  <sx:rem-occur>{}</sx:rem-occur>\n'
+              .format(24, 24))
+        w('  <sx:templ-acct type="guid">{}</sx:templ-acct>\n  <sx:schedule>\n'
+          '    <gnc:recurrence version="1.0.0">\n'
+          '      <recurrence:mult>{}</recurrence:mult>\n'
+          '      <recurrence:period_type>{}</recurrence:period_type>\n'
+          '      <recurrence:start>\n        <gdate>{:%Y-%m-%d}</gdate>\n      </recurrence:start>\n'
+          '      <recurrence:weekend_adj>{}</recurrence:weekend_adj>\n'
+          '    </gnc:recurrence>\n  </sx:schedule>\n</gnc:schedxaction>\n'
+          .format(account_guid, mult, period, d, rng.choice(["none", "back", "forward"])))
+
+
+def _budgets(w, rng, budgets, account_guids, start):
+    for i in range(budgets):
+        w('<gnc:budget version="2.0.0">\n  <bgt:id type="guid">{}</bgt:id>\n'
+          '  <bgt:name>Budget {}</bgt:name>\n  <bgt:description>{}</bgt:description>\n'
+          '  <bgt:num-periods>12</bgt:num-periods>\n'
+          '  <bgt:recurrence version="1.0.0">\n    <recurrence:mult>1</recurrence:mult>\n'
+          '    <recurrence:period_type>month</recurrence:period_type>\n'
+          '    <recurrence:start>\n      <gdate>{}-01-01</gdate>\n    </recurrence:start>\n'
+          '  </bgt:recurrence>\n  <bgt:slots>\n'
+          .format(_guid(rng), start.year + i, " ".join(rng.sample(WORDS, 2)), start.year + i))
+        for guid in rng.sample(account_guids, (len(account_guids) + 1) // 2):
+            w('    <slot>\n      <slot:key>{}</slot:key>\n      <slot:value type="frame">\n'
+              .format(guid))
+            for period in range(12):
+                w('        <slot>\n          <slot:key>{}</slot:key>\n'
+                  '          <slot:value type="numeric">{}</slot:value>\n        </slot>\n'
+                  .format(period, _number(rng.randint(-500000, 500000))))
+            w('      </slot:value>\n    </slot>\n')
+        w('  </bgt:slots>\n</gnc:budget>\n')
+
+
+def write_book(filename, compress=True, **sizes):
+    """Generate a synthetic book into filename, gzip compressed by default."""
+    opener = gzip.open if compress else open
+    with opener(filename, "wb") as fobj:
+        generate(fobj, **sizes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic GNU Cash XML book")
+    parser.add_argument("output")
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--transactions", type=int, default=1000)
+    parser.add_argument("--splits", type=int, default=2, help="splits per transaction")
+    parser.add_argument("--prices", type=int, default=100)
+    parser.add_argument("--customers", type=int, default=10)
+    parser.add_argument("--invoices", type=int, default=50)
+    parser.add_argument("--entries", type=int, default=3, help="entries per invoice")
+    parser.add_argument("--schedules", type=int, default=0, help="scheduled transactions")
+    parser.add_argument("--budgets", type=int, default=0, help="yearly budgets")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--uncompressed", action="store_true")
+    args = parser.parse_args(argv)
+    write_book(args.output, compress=not args.uncompressed,
+               accounts=args.accounts, transactions=args.transactions,
+               splits=args.splits, prices=args.prices, customers=args.customers,
+               invoices=args.invoices, entries=args.entries, seed=args.seed,
+               schedules=args.schedules, budgets=args.budgets)
+
+
+if __name__ == "__main__":
+    main()
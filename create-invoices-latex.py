@@ -1,16 +1,22 @@
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from operator import attrgetter
 
 import gnucashxml
+import hashlib
 import locale
 import os
+import shutil
 import subprocess
+import tempfile
 import decimal
 
 gnucashfile = "/Users/angelo/Desktop/paperport/Hongens Automatisering/2018/gnucash/hongens-2018.gnucash"
 yearfilter = "2018"
 outputfolder = "/Users/angelo/Desktop/paperport/Hongens Automatisering/2018/facturen/tmp"
 xelatex_path = "/Library/TeX/texbin/xelatex"
+max_workers = os.cpu_count() or 2
+hashfile = os.path.join(outputfolder, ".invoice-hashes.json")
 
 
 def formatcurrency(amount):
@@ -28,78 +34,74 @@ def formatfloat(float):
 
 
 def getlatex(invoiceobj):
-    latex = ""
-    latex += "\\documentclass[a4paper]{letter}\n"
-    latex += "\n"
-    latex += "\\usepackage{graphicx}\n"
-    latex += "\\usepackage{eso-pic}\n"
-    latex += "\\usepackage{anysize}\n"
-    latex += "\\usepackage{eurosym}\n"
-    latex += "\\usepackage{color}\n"
-    latex += "\\usepackage{fontspec}\n"
-    latex += "\\setmainfont{Lato}\n"
-    latex += "\\usepackage{geometry}\n"
-    latex += "\\geometry{\n"
-    latex += "   paperwidth=210mm,\n"
-    latex += "   paperheight=297mm\n"
-    latex += "}\n"
-    latex += "\\thispagestyle{empty}\n"
-    latex += "\n"
-    latex += "\\newcommand\\BackgroundPic{\n"
-    latex += "  \\put(0,0){\n"
-    latex += "  \\parbox[b][\\paperheight]{\\paperwidth}{%\n"
-    latex += "  \\vfill\n"
-    latex += "  \\centering\n"
-    latex += "  \\includegraphics[width=\\paperwidth,height=\\paperheight, keepaspectratio]{back.eps}%\n"
-    latex += "  \\vfill\n"
-    latex += "  }\n"
-    latex += "}}\n"
-    latex += "\\marginsize{2cm}{2cm}{0cm}{0cm}\n"
-    latex += "\n"
-    latex += "\n"
-    latex += "\\title{Invoice}\n"
-    latex += "\\begin{document}\n"
-    latex += "\\AddToShipoutPicture{\\BackgroundPic}\n"
-    latex += "\n"
-    latex += "%-------------------------------------\n"
-    latex += "%ADDRESSEE\n"
-    latex += "\\begin{tabular}{ l }\n"
-    latex += "  {}\\\\\n".format(invoiceobj.customer.name)
+    latex = []
+    latex.append("\\documentclass[a4paper]{letter}\n")
+    latex.append("\n")
+    latex.append("\\usepackage{graphicx}\n")
+    latex.append("\\usepackage{eso-pic}\n")
+    latex.append("\\usepackage{anysize}\n")
+    latex.append("\\usepackage{eurosym}\n")
+    latex.append("\\usepackage{color}\n")
+    latex.append("\\usepackage{fontspec}\n")
+    latex.append("\\setmainfont{Lato}\n")
+    latex.append("\\usepackage{geometry}\n")
+    latex.append("\\geometry{\n")
+    latex.append("   paperwidth=210mm,\n")
+    latex.append("   paperheight=297mm\n")
+    latex.append("}\n")
+    latex.append("\\thispagestyle{empty}\n")
+    latex.append("\n")
+    latex.append("\\newcommand\\BackgroundPic{\n")
+    latex.append("  \\put(0,0){\n")
+    latex.append("  \\parbox[b][\\paperheight]{\\paperwidth}{%\n")
+    latex.append("  \\vfill\n")
+    latex.append("  \\centering\n")
+    latex.append("  \\includegraphics[width=\\paperwidth,height=\\paperheight, keepaspectratio]{back.eps}%\n")
+    latex.append("  \\vfill\n")
+    latex.append("  }\n")
+    latex.append("}}\n")
+    latex.append("\\marginsize{2cm}{2cm}{0cm}{0cm}\n")
+    latex.append("\n")
+    latex.append("\n")
+    latex.append("\\title{Invoice}\n")
+    latex.append("\\begin{document}\n")
+    latex.append("\\AddToShipoutPicture{\\BackgroundPic}\n")
+    latex.append("\n")
+    latex.append("%-------------------------------------\n")
+    latex.append("%ADDRESSEE\n")
+    latex.append("\\begin{tabular}{ l }\n")
+    latex.append("  {}\\\\\n".format(invoiceobj.customer.name))
     for addressline in invoiceobj.customer.address:
         addressline = addressline.replace(u'e\u0308', '\\"e')
-        latex += "  {} \\\\\n".format(addressline)
-    latex += "\n"
-    latex += "\\end{tabular}\n"
-    latex += "%-------------------------------------\n"
-    latex += "\\vspace{1cm}\n"
-    latex += "\n"
-    latex += "\\LARGE\n"
-    latex += "\\textbf{Factuur}\n"
-    latex += "\\normalsize\n"
-    latex += "\\vspace{0.5cm}\n"
-    latex += "\n"
-    latex += "\\begin{tabular}{ l l l }\n"
-    latex += "  \\textcolor{{gray}}{{Factuurnummer}} & & {} \\\\\n".format(invoiceobj.id)
-    latex += "   \\textcolor{{gray}}{{Datum}} & & {0:%d-%m-%Y} \\\\\n".format(invoiceobj.date)
-    latex += "   \\textcolor{gray}{Betalingswijze} & & per bank \\\\\n"
-    latex += "\\end{tabular}\n"
-    latex += "\n"
-    latex += "\n"
-    latex += "\\vspace{3.5cm}\n"
-    latex += "\\large\n"
-    latex += "\\textbf{Werkzaamheden}\n"
-    latex += "\\normalsize\n"
-    latex += "\\vspace{0.5cm}\n"
-    latex += "\n"
-    latex += "\\hrule\n"
-    latex += "%-------------------------------------\n"
-    latex += "% WERKZAAMHEDEN\n"
-    latex += "%-------------------------------------\n"
-    latex += "\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n"
-
-    totaalexcl = 0
-
-    btwtabel = {}
+        latex.append("  {} \\\\\n".format(addressline))
+    latex.append("\n")
+    latex.append("\\end{tabular}\n")
+    latex.append("%-------------------------------------\n")
+    latex.append("\\vspace{1cm}\n")
+    latex.append("\n")
+    latex.append("\\LARGE\n")
+    latex.append("\\textbf{Factuur}\n")
+    latex.append("\\normalsize\n")
+    latex.append("\\vspace{0.5cm}\n")
+    latex.append("\n")
+    latex.append("\\begin{tabular}{ l l l }\n")
+    latex.append("  \\textcolor{{gray}}{{Factuurnummer}} & & {} \\\\\n".format(invoiceobj.id))
+    latex.append("   \\textcolor{{gray}}{{Datum}} & & {0:%d-%m-%Y} \\\\\n".format(invoiceobj.date))
+    latex.append("   \\textcolor{gray}{Betalingswijze} & & per bank \\\\\n")
+    latex.append("\\end{tabular}\n")
+    latex.append("\n")
+    latex.append("\n")
+    latex.append("\\vspace{3.5cm}\n")
+    latex.append("\\large\n")
+    latex.append("\\textbf{Werkzaamheden}\n")
+    latex.append("\\normalsize\n")
+    latex.append("\\vspace{0.5cm}\n")
+    latex.append("\n")
+    latex.append("\\hrule\n")
+    latex.append("%-------------------------------------\n")
+    latex.append("% WERKZAAMHEDEN\n")
+    latex.append("%-------------------------------------\n")
+    latex.append("\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n")
 
     entries = invoiceobj.entries
     entries.sort(key=attrgetter('description'))
@@ -113,111 +115,144 @@ def getlatex(invoiceobj):
         if tarief is None:
             tarief = 0
         totaalexcl_regel = qty * tarief
-        if int(entry.taxable) == 1:
-            taxtable = entry.taxtable
-            if len(taxtable.taxtable_entries) > 1:
-                print("Error, more than one taxtableentry in taxtable!")
-                exit(1)
-            taxtableentry = taxtable.taxtable_entries[0]
-            btw_tarief_naam = "{0} ({1}\%)".format(taxtable.name, taxtableentry.amount.normalize())
-            if btw_tarief_naam not in btwtabel.keys():
-                btwtabel[btw_tarief_naam] = 0
-
-            btw_hier = decimal.Decimal((totaalexcl_regel * taxtableentry.amount) / 100)
-            btwtabel[btw_tarief_naam] += btw_hier
-        totaalexcl_regel
         if action == "Uren":
-            latex += "  {0}, {1} uur \\`a \\EUR{{{2}}}. &  \\EUR{{{3}}}\\\\\n".format(
+            latex.append("  {0}, {1} uur \\`a \\EUR{{{2}}}. &  \\EUR{{{3}}}\\\\\n".format(
                 entry.description,
                 formatfloat(qty),
                 formatcurrency(tarief),
                 formatcurrency(totaalexcl_regel)
-            )
+            ))
         else:
-            latex += "  {0}, {1} x \\EUR{{{2}}}. &  \\EUR{{{3}}}\\\\\n".format(
+            latex.append("  {0}, {1} x \\EUR{{{2}}}. &  \\EUR{{{3}}}\\\\\n".format(
                 entry.description,
                 qty.normalize(),
                 formatcurrency(tarief),
                 formatcurrency(totaalexcl_regel)
-            )
-        totaalexcl += totaalexcl_regel
-    latex += "\\end{tabular*}\n"
-    latex += "%-------------------------------------\n"
-    latex += "\\vfill\n"
-    latex += "\n"
-    latex += "\\hrule\n"
-    latex += "\n"
-    latex += "\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n"
-    latex += "  Totaal exclusief BTW & \EUR{{{0}}}\\\\\n".format(formatcurrency(totaalexcl))
-
-    totaalbtw = 0
-    for btwkey in btwtabel.keys():
-        latex += "  {0}\\ &  \EUR{{{1}}}\\\\\n".format(btwkey, formatcurrency(btwtabel[btwkey]))
-        totaalbtw += btwtabel[btwkey]
-
-    latex += "\\end{tabular*}\n"
-    latex += "\n"
-    latex += "\\hrule\n"
-    latex += "\n"
-    latex += "\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n"
-
-    totaalincl = totaalexcl + totaalbtw
-    latex += "  Totaal inclusief BTW &  \EUR{{{0}}}\\\\\n".format(formatcurrency(totaalincl))
-    latex += "\\end{tabular*}\n"
-    latex += "\n"
-    latex += "\\vspace{1cm}\n"
-    latex += "\n"
-    latex += "Met vriendelijke groet,\n"
-    latex += "\n"
-    latex += "\\includegraphics[width=40mm]{handtekening.eps}\n"
-    latex += "\n"
-    latex += "Angelo H\\\"ongens\n"
-    latex += "\n"
-    latex += "\\vspace{1cm}\n"
-    latex += "\n"
-    latex += "\\footnotesize\n"
-    latex += "Wij verzoeken u vriendelijk bij betaling per bank het bedrag binnen 14 dagen over te maken op " \
-             "bovenstaande bankrekening onder vermelding van het bovengenoemde factuurnummer.\n "
-    latex += "\n"
-    latex += "\\end{document}\n"
-    return latex
-
-
-def runxelatex(fulltexfilename):
-    fullpdffilename = fulltexfilename.replace(".tex", ".pdf")
-    if not os.path.exists(fullpdffilename):
-        command_line = "{0} \"{1}\"".format(xelatex_path, fulltexfilename)
-
-        print("would run {0}".format(command_line))
-        command_result = subprocess.Popen(command_line, stdout=subprocess.PIPE, shell=True, cwd=outputfolder)
-        output = command_result.communicate()
-        command_exitcode = command_result.returncode
-        if command_exitcode == 0:
-            print("Successfully created {0}".format(fullpdffilename))
-        else:
-            print("Error running command '{0}', exit code {1}".format(command_line, command_exitcode))
-            print(output)
+            ))
+    latex.append("\\end{tabular*}\n")
+    latex.append("%-------------------------------------\n")
+    latex.append("\\vfill\n")
+    latex.append("\n")
+    latex.append("\\hrule\n")
+    latex.append("\n")
+    latex.append("\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n")
+    latex.append("  Totaal exclusief BTW & \EUR{{{0}}}\\\\\n".format(formatcurrency(invoiceobj.subtotal)))
+
+    for taxtable, btw in invoiceobj.tax_by_table.items():
+        if len(taxtable.taxtable_entries) > 1:
+            print("Error, more than one taxtableentry in taxtable!")
             exit(1)
-    synctextpath = fulltexfilename.replace(".tex", ".synctex.gz")
-    if os.path.exists(synctextpath):
-        os.remove(synctextpath)
-    logpath = fulltexfilename.replace(".tex", ".log")
-    if os.path.exists(logpath):
-        os.remove(logpath)
-    auxpath = fulltexfilename.replace(".tex", ".aux")
-    if os.path.exists(auxpath):
-        os.remove(auxpath)
+        btw_tarief_naam = "{0} ({1}\%)".format(taxtable.name, taxtable.taxtable_entries[0].amount.normalize())
+        latex.append("  {0}\\ &  \EUR{{{1}}}\\\\\n".format(btw_tarief_naam, formatcurrency(btw)))
+
+    latex.append("\\end{tabular*}\n")
+    latex.append("\n")
+    latex.append("\\hrule\n")
+    latex.append("\n")
+    latex.append("\\begin{tabular*}{\\textwidth}{@{}@{\\extracolsep{\\fill}} l  r @{}}\n")
+
+    latex.append("  Totaal inclusief BTW &  \EUR{{{0}}}\\\\\n".format(formatcurrency(invoiceobj.total)))
+    latex.append("\\end{tabular*}\n")
+    latex.append("\n")
+    latex.append("\\vspace{1cm}\n")
+    latex.append("\n")
+    latex.append("Met vriendelijke groet,\n")
+    latex.append("\n")
+    latex.append("\\includegraphics[width=40mm]{handtekening.eps}\n")
+    latex.append("\n")
+    latex.append("Angelo H\\\"ongens\n")
+    latex.append("\n")
+    latex.append("\\vspace{1cm}\n")
+    latex.append("\n")
+    latex.append("\\footnotesize\n")
+    latex.append("Wij verzoeken u vriendelijk bij betaling per bank het bedrag binnen 14 dagen over te maken op "
+                 "bovenstaande bankrekening onder vermelding van het bovengenoemde factuurnummer.\n ")
+    latex.append("\n")
+    latex.append("\\end{document}\n")
+    return "".join(latex)
+
+
+def runxelatex(texfilename, latexcontent):
+    """Build one invoice in a private temp directory and move the PDF into outputfolder.
+
+    Returns a (texfilename, ok, output) tuple; safe to run from worker threads.
+    """
+    pdffilename = texfilename.replace(".tex", ".pdf")
+    workdir = tempfile.mkdtemp(prefix="invoice-")
+    try:
+        with open(os.path.join(workdir, texfilename), 'w') as outfile:
+            outfile.write(latexcontent)
+        # back.eps and handtekening.eps live in outputfolder; the trailing
+        # separator keeps the default TeX search path.
+        env = dict(os.environ, TEXINPUTS=outputfolder + os.pathsep)
+        command_line = [xelatex_path, "-interaction=nonstopmode", "-halt-on-error", texfilename]
+        command_result = subprocess.Popen(command_line, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                          cwd=workdir, env=env)
+        output = command_result.communicate()[0]
+        if command_result.returncode != 0:
+            return texfilename, False, output
+        shutil.move(os.path.join(workdir, pdffilename), os.path.join(outputfolder, pdffilename))
+        return texfilename, True, output
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def contenthash(latexcontent):
+    return hashlib.sha256(latexcontent.encode('utf-8')).hexdigest()
+
+
+def loadhashes():
+    try:
+        with open(hashfile) as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+
+
+def savehashes(hashes):
+    tmpfile = hashfile + ".tmp"
+    with open(tmpfile, 'w') as outfile:
+        json.dump(hashes, outfile, indent=2, sort_keys=True)
+    os.replace(tmpfile, hashfile)
 
 
 # begin
 book = gnucashxml.from_filename(gnucashfile)
+gnucashxml.compute_invoice_totals(book)
+hashes = loadhashes()
+jobs = {}
+unchanged = 0
 for invoice in book.invoices:
     if invoice.customer is not None:
         if yearfilter in invoice.id:
         #if invoice.id == '2017.022':
             latexcontent = getlatex(invoice)
             filename = "{0} {1}.tex".format(invoice.id, invoice.customer.name)
-            fullpath = os.path.join(outputfolder, filename)
-            with open(fullpath, 'w') as outfile:
+            fullpdfpath = os.path.join(outputfolder, filename.replace(".tex", ".pdf"))
+            digest = contenthash(latexcontent)
+            if hashes.get(filename) == digest and os.path.exists(fullpdfpath):
+                unchanged += 1
+                continue
+            with open(os.path.join(outputfolder, filename), 'w') as outfile:
                 outfile.write(latexcontent)
-            runxelatex(fullpath)
+            jobs[filename] = (latexcontent, digest)
+
+failed = []
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(runxelatex, filename, latexcontent)
+               for filename, (latexcontent, digest) in jobs.items()]
+    for future in as_completed(futures):
+        filename, ok, output = future.result()
+        if ok:
+            hashes[filename] = jobs[filename][1]
+            print("Successfully created {0}".format(filename.replace(".tex", ".pdf")))
+        else:
+            hashes.pop(filename, None)
+            failed.append(filename)
+            print("Error running xelatex on '{0}'".format(filename))
+            print(output.decode('utf-8', 'replace'))
+
+savehashes(hashes)
+print("{0} built, {1} failed, {2} unchanged".format(len(jobs) - len(failed), len(failed), unchanged))
+if failed:
+    exit(1)
@@ -21,21 +21,50 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
+import collections
+import contextlib
 import decimal
-import gzip
-import json
+import fractions
+import heapq
+import io
+import itertools
+import math
+import mmap
+import operator
+import os
+import re
+import zlib
 import datetime
-from dateutil.parser import parse as parse_date
+import sys
+import threading
+import time
+import warnings
+from xml.etree.ElementTree import ParseError, TreeBuilder
+from xml.parsers import expat
 
-try:
-    import lxml.etree as ElementTree
-except:
-    from xml.etree import ElementTree
-from xml.etree.ElementTree import ParseError
+from collections.abc import Mapping, MutableMapping, Sequence
 
 __version__ = "1.1"
 
 
+def __getattr__(name):
+    # Modules that take long to import compared to the rest of this one
+    # (dateutil, lxml, json, asyncio, http.server) are imported where
+    # they are used. These names used to be imported eagerly and are now
+    # provided on first access.
+    if name == 'parse_date':
+        from dateutil.parser import parse as parse_date
+        globals()['parse_date'] = parse_date
+        return parse_date
+    if name == 'ElementTree':
+        return _etree()
+    if name == 'CustomJSONEncoder':
+        return _json_encoder()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 class Book(object):
     """
     A book is the main container for GNU Cash data.
@@ -45,7 +74,8 @@ class Book(object):
     """
 
     def __init__(self, tree, guid, prices=None, transactions=None, root_account=None,
-                 accounts=None, commodities=None, slots=None, invoices=None):
+                 accounts=None, commodities=None, slots=None, invoices=None,
+                 schedxactions=None, budgets=None):
         self.tree = tree
         self.guid = guid
         self.prices = prices
@@ -53,8 +83,19 @@ class Book(object):
         self.root_account = root_account
         self.accounts = accounts or []
         self.commodities = commodities or []
-        self.slots = slots or {}
+        self.slots = slots if slots is not None else {}
         self.invoices = invoices or []
+        self.schedxactions = schedxactions or []
+        self.budgets = budgets or []
+        self.load_stats = None
+        self.verification = None
+        # loaded with exact=True, so amounts are Money
+        self.exact = False
+        # elements of transactions the expat backend read past, which
+        # write() cannot keep
+        self._skipped = 0
+        self._cost_basis = {}
+        self._text_index = None
 
     def __repr__(self):
         return "<Book {}>".format(self.guid)
@@ -68,35 +109,81 @@ class Book(object):
                 return account
 
     def find_guid(self, guid):
-        for item in self.accounts + self.transactions:
+        for item in self.accounts:
+            if item.guid == guid:
+                return item
+        if isinstance(self.transactions, _LazyTransactions):
+            return self.transactions.find(guid)
+        for item in self.transactions:
             if item.guid == guid:
                 return item
 
     def ledger(self):
-        outp = []
+        return '\n'.join(_ledger_lines(self))
+
+    def forecast(self, start, end, columnar=False):
+        """
+        Project the scheduled transactions between the dates start and end.
+
+        Generates a ForecastSplit for every split of every occurrence not
+        yet created by GNU Cash, ordered by date. With columnar=True, a
+        dictionary of equal-length lists (date, schedxaction, account,
+        amount, description, memo) is returned instead, grouped by
+        scheduled transaction rather than sorted, which is considerably
+        cheaper for long horizons. The columns are ordinary lists, filled
+        a schedule at a time.
+        """
+        if columnar:
+            return _forecast_columns(self, start, end)
+        return _forecast(self, start, end)
+
+    def budget_vs_actual(self, budget, field='quantity'):
+        """
+        Compare budget (a Budget, or its name) with the actual amounts.
+
+        Returns a BudgetReport with the budgeted and actual amounts of
+        every account and its subaccounts per budget period. Actuals sum
+        the split quantities (in the account's commodity), or the values
+        with field="value".
+        """
+        if not isinstance(budget, Budget):
+            for item in self.budgets:
+                if budget in (item.name, item.guid):
+                    budget = item
+                    break
+            else:
+                raise KeyError("No budget {!r}".format(budget))
+        return _budget_vs_actual(self, budget, field)
 
-        for comm in self.commodities:
-            outp.append('commodity {}'.format(comm.name))
-            outp.append('\tnamespace {}'.format(comm.space))
-            outp.append('')
+    @property
+    def text_index(self):
+        """The TextIndex of this book, built on first use."""
+        if self._text_index is None:
+            self._text_index = TextIndex(self)
+        return self._text_index
 
-        for account in self.accounts:
-            outp.append('account {}'.format(account.fullname()))
-            if account.description:
-                outp.append('\tnote {}'.format(account.description))
-            outp.append('\tcheck commodity == "{}"'.format(account.commodity))
-            outp.append('')
+    @text_index.setter
+    def text_index(self, index):
+        self._text_index = index
 
-        for trn in sorted(self.transactions):
-            outp.append('{:%Y/%m/%d} * {}'.format(trn.date, trn.description))
-            for spl in trn.splits:
-                outp.append('\t{:50} {:12.2f} {} {}'.format(spl.account.fullname(),
-                                                            spl.value,
-                                                            spl.account.commodity,
-                                                            '; ' + spl.memo if spl.memo else ''))
-            outp.append('')
+    def search(self, query, guids=False):
+        """
+        Return the transactions, invoice entries and customers containing
+        every word of query; see TextIndex.search().
+        """
+        return self.text_index.search(query, guids)
 
-        return '\n'.join(outp)
+    def cost_basis(self, account, method='fifo'):
+        """
+        Return the CostBasis engine for account, using the prices of this
+        book. Engines are kept, so later reports reuse their saved state,
+        until splits are added to the account or prices to the book.
+        """
+        engine = self._cost_basis.get((account.guid, method))
+        if engine is None or engine._sizes != (len(account.splits), len(self.prices or ())):
+            engine = self._cost_basis[(account.guid, method)] = CostBasis(
+                account, method, self.prices)
+        return engine
 
 
 class Commodity(object):
@@ -134,7 +221,8 @@ class Account(object):
         self.commodity = commodity
         self.commodity_scu = commodity_scu
         self.splits = []
-        self.slots = slots or {}
+        self.lots = []
+        self.slots = slots if slots is not None else {}
 
     def fullname(self):
         if self.parent:
@@ -201,7 +289,7 @@ class Transaction(object):
         self.description = description
         self.num = num or None
         self.splits = splits or []
-        self.slots = slots or {}
+        self.slots = slots if slots is not None else {}
 
     def __repr__(self):
         return "<Transaction on {} '{}' {}...>".format(
@@ -228,11 +316,36 @@ class Invoice(object):
         self.entries = entries
         self.guid = guid
         self.vendor = vendor
+        self._totals = None
 
     def __repr__(self):
         return "<Invoice id {} on {} (guid {})".format(
             self.id, self.date, self.guid)
 
+    @property
+    def subtotal(self):
+        """Sum of quantity * price over all entries, excluding tax."""
+        return self._get_totals()[0]
+
+    @property
+    def tax_by_table(self):
+        """Dictionary mapping each Taxtable used by the entries to its tax amount."""
+        return self._get_totals()[1]
+
+    @property
+    def total(self):
+        """Subtotal plus all taxes."""
+        return self._get_totals()[2]
+
+    def _get_totals(self):
+        if self._totals is None:
+            compute_invoice_totals([self])
+        return self._totals
+
+    def invalidate_totals(self):
+        """Forget the cached totals, e.g. after changing the entries."""
+        self._totals = None
+
     def __lt__(self, other):
         # For sorted() only
         if isinstance(other, Invoice):
@@ -353,7 +466,7 @@ class Split(object):
     def __init__(self, guid=None, memo=None,
                  reconciled_state=None, reconcile_date=None, value=None,
                  quantity=None, account=None, transaction=None, action=None,
-                 slots=None):
+                 slots=None, lot=None):
         self.guid = guid
         self.reconciled_state = reconciled_state
         self.reconcile_date = reconcile_date
@@ -364,6 +477,7 @@ class Split(object):
         self.action = action
         self.memo = memo
         self.slots = slots
+        self.lot = lot
 
     def __repr__(self):
         return "<Split {} '{}' {} {} {}...>".format(self.transaction.date,
@@ -380,6 +494,34 @@ class Split(object):
             False
 
 
+class Lot(object):
+    """
+    A lot groups the splits of an account that belong together, e.g. the
+    purchase of shares and their later sale, or an invoice and its
+    payments.
+
+    splits is only filled for books that are not loaded lazily.
+    """
+
+    def __init__(self, guid=None, account=None, slots=None):
+        self.guid = guid
+        self.account = account
+        self.splits = []
+        self.slots = slots if slots is not None else {}
+
+    def __repr__(self):
+        return "<Lot '{}' {}...>".format(self.title, self.guid[:6])
+
+    @property
+    def title(self):
+        return self.slots.get('title')
+
+    @property
+    def is_closed(self):
+        """True if the quantities of the splits in this lot sum to zero."""
+        return bool(self.splits) and sum(split.quantity for split in self.splits) == 0
+
+
 class Price(object):
     """
     A price is GNUCASH record of the price of a commodity against a currency
@@ -409,36 +551,1013 @@ class Price(object):
             False
 
 
+class Money(object):
+    """
+    An exact amount: units of 1/scale, as GNU Cash stores it.
+
+    Books loaded with exact=True use Money instead of Decimals rounded
+    to cents for split values and quantities, prices, invoice entries and
+    numeric slots, with the denominator of the file (normally the SCU of
+    the commodity) as scale.
+
+    Adding, subtracting and comparing Money, ints and Decimals is exact
+    and cheap, since amounts of the same scale only add their units.
+    Money.sum() adds many amounts at once. Multiplying by an int or Money
+    and round() to a number of places give Money; division and other
+    arithmetic goes through to_decimal().
+    Money hashes and compares equal to the same value as int, Decimal or
+    Fraction.
+    """
+
+    __slots__ = ('units', 'scale')
+
+    def __init__(self, units, scale=1):
+        self.units = units
+        self.scale = scale
+
+    @classmethod
+    def from_decimal(cls, value):
+        """Return the Money of a Decimal (or int or str), keeping its digits."""
+        value = decimal.Decimal(value)
+        exponent = value.as_tuple().exponent
+        if exponent >= 0:
+            return cls(int(value), 1)
+        return cls(int(value.scaleb(-exponent)), 10 ** -exponent)
+
+    @classmethod
+    def sum(cls, values):
+        """Return the total of an iterable of Money as Money."""
+        values = list(values)
+        scales = set(map(_money_scale, values))
+        if len(scales) == 1:
+            return cls(sum(map(_money_units, values)), scales.pop())
+        total = cls(0)
+        for value in values:
+            total += value
+        return total
+
+    def to_decimal(self):
+        """Return the amount as a Decimal."""
+        digits = _MONEY_DIGITS.get(self.scale)
+        if digits is not None:
+            return decimal.Decimal(self.units).scaleb(-digits)
+        return decimal.Decimal(self.units) / self.scale
+
+    def __repr__(self):
+        if self.scale in _MONEY_DIGITS:
+            return "Money('{}')".format(self)
+        return "Money({}, {})".format(self.units, self.scale)
+
+    def __str__(self):
+        if self.scale in _MONEY_DIGITS:
+            return str(self.to_decimal())
+        return "{}/{}".format(self.units, self.scale)
+
+    def __format__(self, spec):
+        return format(self.to_decimal(), spec)
+
+    def __float__(self):
+        return self.units / self.scale
+
+    def __int__(self):
+        units = abs(self.units) // self.scale
+        return units if self.units >= 0 else -units
+
+    def __bool__(self):
+        return self.units != 0
+
+    def __hash__(self):
+        # The hash Python gives every number of this value (see Fraction)
+        inverse = pow(self.scale, _HASH_MODULUS - 2, _HASH_MODULUS)
+        if not inverse:
+            return sys.hash_info.inf if self.units >= 0 else -sys.hash_info.inf
+        result = hash(abs(self.units)) * inverse % _HASH_MODULUS
+        if self.units < 0:
+            result = -result
+        return -2 if result == -1 else result
+
+    def __neg__(self):
+        return Money(-self.units, self.scale)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Money(abs(self.units), self.scale)
+
+    def __add__(self, other):
+        if other.__class__ is not Money:
+            other = _as_money(other)
+            if other is None:
+                return NotImplemented
+        if other.scale == self.scale:
+            return Money(self.units + other.units, self.scale)
+        scale = self.scale * other.scale // math.gcd(self.scale, other.scale)
+        return Money(self.units * (scale // self.scale) + other.units * (scale // other.scale),
+                     scale)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if other.__class__ is not Money:
+            other = _as_money(other)
+            if other is None:
+                return NotImplemented
+        return self + Money(-other.units, other.scale)
+
+    def __rsub__(self, other):
+        return Money(-self.units, self.scale) + other
+
+    def __mul__(self, other):
+        if isinstance(other, int):
+            return Money(self.units * other, self.scale)
+        if other.__class__ is not Money:
+            other = _as_money(other)
+            if other is None:
+                return NotImplemented
+        return Money(self.units * other.units, self.scale * other.scale)
+
+    __rmul__ = __mul__
+
+    def __round__(self, ndigits=None):
+        # rounds half to even, like round() of a Decimal
+        value = round(fractions.Fraction(self.units, self.scale), ndigits)
+        if ndigits is None:
+            return value
+        if ndigits <= 0:
+            return Money(int(value))
+        scale = 10 ** ndigits
+        return Money(value.numerator * (scale // value.denominator), scale)
+
+    def __truediv__(self, other):
+        if isinstance(other, Money):
+            other = other.to_decimal()
+        return self.to_decimal() / other
+
+    def __rtruediv__(self, other):
+        return other / self.to_decimal()
+
+    def _compare(self, other):
+        # (self, other) scaled to a common denominator, or None
+        if isinstance(other, Money):
+            return self.units * other.scale, other.units * self.scale
+        if isinstance(other, (int, decimal.Decimal, fractions.Fraction)):
+            numerator, denominator = other.as_integer_ratio()
+            return self.units * denominator, numerator * self.scale
+        return None
+
+    def __eq__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] == pair[1]
+
+    def __ne__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] != pair[1]
+
+    def __lt__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] < pair[1]
+
+    def __le__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] <= pair[1]
+
+    def __gt__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] > pair[1]
+
+    def __ge__(self, other):
+        pair = self._compare(other)
+        return NotImplemented if pair is None else pair[0] >= pair[1]
+
+
+# Powers of ten used as scale, and their number of decimal places
+_MONEY_DIGITS = dict((10 ** digits, digits) for digits in range(19))
+_HASH_MODULUS = sys.hash_info.modulus
+_money_units = operator.attrgetter('units')
+_money_scale = operator.attrgetter('scale')
+
+
+def _as_money(value):
+    if isinstance(value, int):
+        return Money(value, 1)
+    if isinstance(value, decimal.Decimal):
+        return Money.from_decimal(value)
+    return None
+
+
+def _month_days(year, month):
+    # calendar.monthrange(year, month)[1], without importing calendar
+    following = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return (following - datetime.timedelta(days=1)).day
+
+
+class Recurrence(object):
+    """
+    A recurring date pattern of a scheduled transaction.
+
+    period_type is one of "once", "day", "week", "month", "end of month",
+    "nth weekday", "last weekday" or "year", repeated every mult periods
+    counting from the date start. weekend_adj is "none", "back" or
+    "forward" and moves dates falling on a weekend to the Friday before
+    or the Monday after.
+    """
+
+    def __init__(self, mult=1, period_type=None, start=None, weekend_adj=None):
+        self.mult = mult
+        self.period_type = period_type
+        self.start = start
+        self.weekend_adj = weekend_adj or 'none'
+
+    def __repr__(self):
+        return "<Recurrence every {} {} from {}>".format(self.mult, self.period_type, self.start)
+
+    def occurrence(self, n):
+        """Return the date of occurrence n (counting from 0), or None."""
+        start = self.start
+        period_type = self.period_type
+        if period_type == 'once':
+            if n:
+                return None
+            date = start
+        elif period_type == 'day':
+            date = start + datetime.timedelta(days=n * self.mult)
+        elif period_type == 'week':
+            date = start + datetime.timedelta(weeks=n * self.mult)
+        else:
+            months = n * self.mult * (12 if period_type == 'year' else 1)
+            year, month = divmod(start.year * 12 + start.month - 1 + months, 12)
+            month += 1
+            last = _month_days(year, month)
+            if period_type in ('month', 'year'):
+                day = min(start.day, last)
+            elif period_type == 'end of month':
+                day = last
+            elif period_type == 'nth weekday':
+                first = datetime.date(year, month, 1).weekday()
+                day = 1 + (start.weekday() - first) % 7 + 7 * ((start.day - 1) // 7)
+                if day > last:
+                    day -= 7
+            elif period_type == 'last weekday':
+                day = last - (datetime.date(year, month, last).weekday() - start.weekday()) % 7
+            else:
+                raise ValueError("Unknown recurrence period type {}".format(period_type))
+            date = datetime.date(year, month, day)
+        weekday = date.weekday()
+        if weekday >= 5 and self.weekend_adj != 'none':
+            if self.weekend_adj == 'back':
+                date -= datetime.timedelta(days=weekday - 4)
+            elif self.weekend_adj == 'forward':
+                date += datetime.timedelta(days=7 - weekday)
+        return date
+
+    def dates(self, since=None):
+        """
+        Generate (n, date) for all occurrences on or after the date since.
+
+        Earlier occurrences are skipped arithmetically, not enumerated.
+        """
+        n = 0
+        if since is not None and since > self.start:
+            if self.period_type == 'day':
+                n = (since - self.start).days // self.mult
+            elif self.period_type == 'week':
+                n = (since - self.start).days // (7 * self.mult)
+            elif self.period_type != 'once':
+                months = (since.year - self.start.year) * 12 + since.month - self.start.month
+                n = months // (self.mult * (12 if self.period_type == 'year' else 1))
+            # weekend adjustment can move an occurrence by up to two days
+            n = max(0, n - 1)
+        while True:
+            date = self.occurrence(n)
+            if date is None:
+                return
+            if since is None or date >= since:
+                yield n, date
+            n += 1
+
+
+class ScheduledTransaction(object):
+    """
+    A scheduled transaction: template transactions that GNU Cash creates
+    on every date given by its recurrences.
+
+    start, end and last (the last date transactions were created for)
+    are dates; end and last may be None. num_occur limits the total
+    number of occurrences, rem_occur the number left after last. The
+    template transactions have splits in template_account, a child of
+    the template root account outside the account tree; the real account
+    and amount of each split are in its "sched-xaction" slot.
+    """
+
+    def __init__(self, guid=None, name=None, enabled=True, start=None, end=None,
+                 last=None, num_occur=None, rem_occur=None, instance_count=0,
+                 recurrences=None, transactions=None, slots=None, template_account=None):
+        self.guid = guid
+        self.name = name
+        self.enabled = enabled
+        self.start = start
+        self.end = end
+        self.last = last
+        self.num_occur = num_occur
+        self.rem_occur = rem_occur
+        self.instance_count = instance_count
+        self.recurrences = recurrences or []
+        self.transactions = transactions or []
+        self.slots = slots if slots is not None else {}
+        self.template_account = template_account
+
+    def __repr__(self):
+        return "<ScheduledTransaction '{}' {}...>".format(self.name, self.guid[:6])
+
+    def dates(self, start=None, end=None):
+        """
+        Generate the dates of future occurrences, optionally limited to
+        the dates start to end (inclusive).
+
+        Occurrences on or before last have already been created and are
+        not generated.
+        """
+        if not self.enabled or not self.recurrences:
+            return
+        begin = self.start
+        if self.last is not None and self.last >= begin:
+            begin = self.last + datetime.timedelta(days=1)
+        if start is not None and start > begin:
+            begin = start
+        if self.end is not None and (end is None or self.end < end):
+            end = self.end
+
+        # Counting occurrences means starting where the count starts.
+        if self.num_occur is not None:
+            since, remaining = self.start, self.num_occur
+        elif self.rem_occur is not None:
+            since, remaining = max(self.start, begin if self.last is None
+                                   else self.last + datetime.timedelta(days=1)), self.rem_occur
+        else:
+            since, remaining = begin, None
+
+        if len(self.recurrences) == 1:
+            stream = (date for n, date in self.recurrences[0].dates(since))
+        else:
+            stream = heapq.merge(*[(date for n, date in recurrence.dates(since))
+                                   for recurrence in self.recurrences])
+        previous = None
+        for date in stream:
+            if date == previous or date < since:
+                continue
+            previous = date
+            if end is not None and date > end:
+                return
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            if date >= begin:
+                yield date
+
+
+class ForecastSplit(object):
+    """
+    A split projected from a scheduled transaction by Book.forecast().
+
+    amount is positive for debits and negative for credits, like the
+    value of a split. It is None if the template only has a formula
+    that is not a plain number.
+    """
+
+    __slots__ = ('date', 'schedxaction', 'account', 'amount', 'description', 'memo')
+
+    def __init__(self, date, schedxaction, account, amount, description=None, memo=None):
+        self.date = date
+        self.schedxaction = schedxaction
+        self.account = account
+        self.amount = amount
+        self.description = description
+        self.memo = memo
+
+    def __repr__(self):
+        return "<ForecastSplit {} '{}' {} {}>".format(self.date, self.description,
+                                                       self.account, self.amount)
+
+
+class Budget(object):
+    """
+    A budget: an amount per account for each of num_periods periods.
+
+    The periods start on the dates of recurrence (a Recurrence), each
+    lasting until the next one starts. amounts maps account GUIDs to a
+    tuple with the amount of every period, None where nothing is
+    budgeted. Other budget data, such as notes, stays in slots.
+    """
+
+    def __init__(self, guid=None, name=None, description=None, num_periods=12,
+                 recurrence=None, amounts=None, slots=None):
+        self.guid = guid
+        self.name = name
+        self.description = description
+        self.num_periods = num_periods
+        self.recurrence = recurrence
+        self.amounts = amounts if amounts is not None else {}
+        self.slots = slots if slots is not None else {}
+
+    def __repr__(self):
+        return "<Budget '{}' {}...>".format(self.name, self.guid[:6])
+
+    @property
+    def periods(self):
+        """A list of (start, end) dates per period; end is the next start."""
+        dates = [self.recurrence.occurrence(n) for n in range(self.num_periods + 1)]
+        return list(zip(dates, dates[1:]))
+
+    def amount(self, account, period):
+        """Return the amount for account (or its GUID) in period, or None."""
+        amounts = self.amounts.get(getattr(account, 'guid', account))
+        if amounts is None or period >= len(amounts):
+            return None
+        return amounts[period]
+
+
+##################################################################
+# Reading files
+
+# Compressed files are read this many bytes at a time. Uncompressed data
+# is handed to the XML parser in pieces of at most _FEED_SIZE bytes,
+# without copying.
+_READ_SIZE = 1 << 20
+_FEED_SIZE = 16 << 20
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+class _BufferSource(object):
+    # XML data already in memory: bytes or a memory map.
+
+    def __init__(self, data, ctx=None):
+        self.buffer = data
+        self.progress = ctx and ctx.progress
+
+    def feed(self, feed):
+        with memoryview(self.buffer) as view:
+            size = len(view)
+            for start in range(0, size, _FEED_SIZE):
+                with view[start:start + _FEED_SIZE] as chunk:
+                    feed(chunk)
+                if self.progress is not None:
+                    self.progress.read(min(start + _FEED_SIZE, size))
+
+    def data(self):
+        return self.buffer
+
+
+class _StreamSource(object):
+    # XML data read from a file object.
+
+    def __init__(self, fobj, ctx):
+        self.fobj = fobj
+        self.stats = ctx.stats
+        self.progress = ctx.progress
+        self.position = 0
+
+    def _read(self, size=-1):
+        start = time.perf_counter()
+        data = self.fobj.read(size)
+        if self.stats is not None:
+            self.stats.add('read', time.perf_counter() - start, len(data))
+        if self.progress is not None:
+            self.position += len(data)
+            self.progress.read(self.position)
+        return data
+
+    def feed(self, feed):
+        while True:
+            data = self._read(_READ_SIZE)
+            if not data:
+                break
+            feed(data)
+
+    def data(self):
+        return self._read()
+
+
+class _FileSource(_StreamSource):
+    # The uncompressed XML of a GNU Cash file. Compression is detected from
+    # the magic bytes. gzip data is inflated with zlib in large pieces,
+    # plain files are memory mapped and parsed in place.
+
+    def __init__(self, fobj, ctx):
+        _StreamSource.__init__(self, fobj, ctx)
+        self.ctx = ctx
+        self.compressed = fobj.read(2) == _GZIP_MAGIC
+        fobj.seek(0)
+
+    def _map(self):
+        try:
+            return mmap.mmap(self.fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, io.UnsupportedOperation):
+            # empty files and file objects without a descriptor
+            return None
+
+    def _inflate(self):
+        stats = self.stats
+        clock = time.perf_counter
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = self._read(_READ_SIZE)
+            if not data:
+                break
+            start = clock()
+            try:
+                chunk = decompressor.decompress(data)
+                while decompressor.eof and decompressor.unused_data:
+                    # concatenated gzip members
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    chunk += decompressor.decompress(data)
+            except zlib.error as e:
+                raise ValueError("File is not a valid gzip file: {}".format(e))
+            if stats is not None:
+                stats.add('decompress', clock() - start, len(chunk))
+            if chunk:
+                yield chunk
+        if not decompressor.eof:
+            raise ValueError("Compressed file ended before the end-of-stream marker was reached")
+
+    def feed(self, feed):
+        if self.compressed:
+            for chunk in self._inflate():
+                feed(chunk)
+            return
+        mapped = self._map()
+        if mapped is None:
+            return _StreamSource.feed(self, feed)
+        with contextlib.closing(mapped):
+            _BufferSource(mapped, self.ctx).feed(feed)
+
+    def data(self):
+        if self.compressed:
+            return b''.join(self._inflate())
+        mapped = self._map()
+        if mapped is None:
+            return self._read()
+        if self.progress is not None:
+            self.progress.read(len(mapped))
+        return mapped
+
+
+##################################################################
+# Load statistics
+
+class LoadStats(object):
+    """
+    Wall time and object counts collected while loading a book.
+
+    Pass stats=True, or a LoadStats instance, to from_filename() or
+    parse() and inspect book.load_stats afterwards. Nothing is measured
+    unless asked for.
+
+    sections maps each load section (read, decompress, xml, commodities,
+    prices, accounts, account linking, transactions, ...) to its wall time
+    in seconds, in the order they ran. The leaf decoders (dates, numbers,
+    slots) are also listed there; their time is already included in the
+    section they were called from. counts maps the same names to the
+    number of objects processed (bytes for read and decompress). Slots are
+    only decoded when first accessed, so that time is not part of the load.
+    Uncompressed files are memory mapped, so their read time shows up as
+    part of xml.
+
+    If hook is given, it is called with the LoadStats instance once the
+    load has finished, e.g. to forward the numbers to a metrics system.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.sections = {}
+        self.counts = {}
+        self.total = 0.0
+        self._start = None
+
+    def __repr__(self):
+        return "<LoadStats {:.3f}s>".format(self.total)
+
+    def __str__(self):
+        lines = []
+        for name, seconds in self.sections.items():
+            lines.append("{:20} {:10.4f}s {:>10}".format(name, seconds,
+                                                         self.counts.get(name, '')))
+        for name, count in self.counts.items():
+            if name not in self.sections:
+                lines.append("{:20} {:11} {:>10}".format(name, '', count))
+        lines.append("{:20} {:10.4f}s".format('total', self.total))
+        return '\n'.join(lines)
+
+    def add(self, name, seconds, count=None):
+        """Add seconds (and optionally an object count) to a section."""
+        self.sections[name] = self.sections.get(name, 0.0) + seconds
+        if count is not None:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def section(self, name, count=None):
+        """Return a context manager timing the enclosed block as section name."""
+        return _StatsSection(self, name, count)
+
+    def timed(self, name, func):
+        """Wrap func so that every call is timed and counted as section name."""
+        sections = self.sections
+        counts = self.counts
+        sections.setdefault(name, 0.0)
+        counts.setdefault(name, 0)
+        clock = time.perf_counter
+
+        def wrapper(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                sections[name] += clock() - start
+                counts[name] += 1
+        return wrapper
+
+    def as_dict(self):
+        return {'sections': dict(self.sections),
+                'counts': dict(self.counts),
+                'total': self.total}
+
+    def _begin(self):
+        self._start = time.perf_counter()
+
+    def _finish(self):
+        self.total = time.perf_counter() - self._start
+        if self.hook is not None:
+            self.hook(self)
+
+
+class _StatsSection(object):
+    def __init__(self, stats, name, count):
+        self.stats = stats
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, time.perf_counter() - self.start, self.count)
+        return False
+
+
+class _NullSection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+##################################################################
+# Progress reporting
+
+class ParseCancelled(Exception):
+    """Raised when a progress callback cancelled a parse."""
+
+
+class Progress(object):
+    """
+    Snapshot of a running parse, passed to progress callbacks.
+
+    section is the name of the current load section ('xml' while the
+    file is being read and parsed). bytes_read is the number of
+    bytes consumed from the file so far, total_bytes the file size if
+    known. elements and total_elements count the objects processed in
+    the current section.
+    """
+
+    def __init__(self, total_bytes=None):
+        self.section = 'xml'
+        self.bytes_read = 0
+        self.total_bytes = total_bytes
+        self.elements = 0
+        self.total_elements = None
+
+    def __repr__(self):
+        return "<Progress {} {}/{} bytes, {}/{} elements>".format(
+            self.section, self.bytes_read, self.total_bytes,
+            self.elements, self.total_elements)
+
+
+class _ProgressReporter(object):
+    # Calls the user's callback with a Progress at most once per interval
+    # seconds, plus once at the start and end of every section. Element
+    # loops only look at the clock every 256 elements.
+
+    def __init__(self, callback, total_bytes=None, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.progress = Progress(total_bytes)
+        self.last = 0.0
+
+    def report(self):
+        self.last = time.perf_counter()
+        if self.callback(self.progress) is False:
+            raise ParseCancelled("Parse cancelled in section {}".format(self.progress.section))
+
+    def read(self, position):
+        self.progress.bytes_read = position
+        if time.perf_counter() - self.last >= self.interval:
+            self.report()
+
+    def start(self, section, total):
+        progress = self.progress
+        progress.section = section
+        progress.elements = 0
+        progress.total_elements = total
+        self.report()
+
+    def end(self):
+        if self.progress.total_elements is not None:
+            self.progress.elements = self.progress.total_elements
+        self.report()
+
+    def iterate(self, elements):
+        progress = self.progress
+        clock = time.perf_counter
+        for count, element in enumerate(elements, 1):
+            yield element
+            if not count & 0xff:
+                progress.elements = count
+                if clock() - self.last >= self.interval:
+                    self.report()
+
+
+class _ContextSection(object):
+    def __init__(self, ctx, name, count):
+        self.stats = ctx.stats
+        self.progress = ctx.progress
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        if self.progress is not None:
+            self.progress.start(self.name, self.count)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if self.stats is not None:
+            self.stats.add(self.name, time.perf_counter() - self.start, self.count)
+        if self.progress is not None and exc_type is None:
+            self.progress.end()
+        return False
+
+
+class _LoadContext(object):
+    # Per-load state handed to the _*_from_tree functions: the leaf
+    # decoders for dates, numbers and slots, the optional LoadStats and
+    # the optional progress reporter. Without either, the decoders are
+    # the plain functions and sections and iteration cost nothing. lots
+    # maps lot guids to the Lots of the book, for the splits to refer to,
+    # records holds the transactions already decoded by the expat backend.
+    # With exact=True numbers are decoded to Money, also after the load.
+
+    def __init__(self, stats=None, progress=None, intern=True, verify=False, exact=False):
+        self.stats = stats
+        self.progress = progress
+        self.verify = VerificationReport() if verify else None
+        self.intern_table = {}
+        self.intern = self._intern if intern else _identity
+        self.register_splits = True
+        self.lazy = None
+        self.lots = {}
+        self.records = ()
+        self.date = _parse_date
+        self.number = self._number = _parse_money if exact else _parse_number
+        self.slots = self._slots
+        if stats is not None:
+            self.date = stats.timed('dates', self.date)
+            self.number = stats.timed('numbers', self.number)
+            self.slots = stats.timed('slots', self.slots)
+
+    def _slots(self, tree):
+        if tree is None:
+            return {}
+        return _LazySlots(tree, self)
+
+    def _intern(self, text):
+        return self.intern_table.setdefault(text, text)
+
+    def finish(self):
+        # Slots decoded after the load still use this context. Drop what
+        # only matters while loading.
+        self.stats = None
+        self.progress = None
+        self.verify = None
+        self.intern_table = None
+        self.intern = _identity
+        self.date = _parse_date
+        self.number = self._number
+        self.slots = self._slots
+        self.records = ()
+
+    def section(self, name, count=None):
+        if self.stats is None and self.progress is None:
+            return _NULL_SECTION
+        return _ContextSection(self, name, count)
+
+    def iterate(self, elements):
+        if self.progress is None:
+            return elements
+        return self.progress.iterate(elements)
+
+
+def _identity(value):
+    return value
+
+
+def _intern_tree(root, table):
+    # The standard library ElementTree keeps a separate str object for the
+    # text and tail of every element, even though most of them repeat:
+    # indentation, reconciled flags, account GUIDs, slot keys, currency
+    # codes. Share them. lxml keeps text on the C side, so there this is
+    # only done for the values copied into the objects (see ctx.intern).
+    setdefault = table.setdefault
+    for elt in root.iter():
+        text = elt.text
+        if text is not None and len(text) <= _INTERN_MAX_LENGTH:
+            elt.text = setdefault(text, text)
+        tail = elt.tail
+        if tail is not None:
+            elt.tail = setdefault(tail, tail)
+
+
+# Longer texts, such as notes, are rarely repeated verbatim.
+_INTERN_MAX_LENGTH = 80
+
+
+def _find_commodity(commoditydict, space, name):
+    # All Commodity objects of a book go through here, so that there is
+    # exactly one instance per (space, name).
+    commodity = commoditydict.get((space, name))
+    if commodity is None:
+        commodity = commoditydict[(space, name)] = Commodity(name=name, space=space)
+    return commodity
+
+
+def _make_stats(stats):
+    if stats is True:
+        return LoadStats()
+    return stats or None
+
+
 ##################################################################
 # XML file parsing
 
-def from_filename(filename):
-    """Parse a GNU Cash file and return a Book object."""
-    try:
-        # try opening with gzip decompression
-        return parse(gzip.open(filename, "rb"))
-    except IOError:
-        # try opening without decompression
-        return parse(open(filename, "rb"))
+def from_filename(filename, stats=None, progress=None, intern=True,
+                  lazy=False, cache_size=10000, verify=False, text_index=False,
+                  backend='etree', exact=False):
+    """
+    Parse a GNU Cash file and return a Book object.
+
+    With stats=True (or a LoadStats instance), per-section timings and
+    counts are collected and available as book.load_stats.
+
+    progress is an optional callable receiving a Progress object while
+    the file is read and while each section is processed, at most about
+    ten times a second. If it returns False, the parse is abandoned and
+    ParseCancelled is raised.
+
+    With intern=True (the default), repeated strings such as reconciled
+    flags, actions, memos, slot keys and account GUIDs are shared between
+    all objects and the XML tree, which noticeably reduces memory use.
+
+    With lazy=True, only accounts, commodities, prices and the business
+    objects are loaded up front, together with a TransactionIndex
+    (book.transactions.index). Transactions and their splits are decoded
+    from the raw XML when accessed through book.transactions or
+    account.splits, and the last cache_size decoded transactions are
+    kept. Transactions evicted from that cache are decoded again into
+    new objects when next accessed.
+
+    With verify=True, the book is checked while it is loaded and a
+    VerificationReport is available as book.verification: declared
+    gnc:count-data against what was parsed, transactions whose splits do
+    not sum to zero, and splits whose account does not exist. Such
+    splits are left out instead of failing the load.
+
+    With text_index=True, book.text_index is built right away instead of
+    on the first search.
+
+    backend selects the XML parser: "etree" (the default) builds an
+    element tree with lxml or xml.etree and reads it, "expat" decodes the
+    transactions directly from the parser events in a single pass, which
+    is faster without lxml. Both produce the same Book.
+
+    With exact=True, amounts are Money objects holding the exact values
+    of the file, instead of Decimals rounded (away from zero) to cents.
+    """
+    stats = _make_stats(stats)
+    with open(filename, "rb") as fobj:
+        reporter = None
+        if progress is not None:
+            reporter = _ProgressReporter(progress, total_bytes=os.fstat(fobj.fileno()).st_size)
+        ctx = _LoadContext(stats, reporter, intern, verify, exact)
+        return _load(_FileSource(fobj, ctx), ctx, lazy, cache_size, text_index, backend)
 
 
 # Implemented:
 # - gnc:book
-#
-# Not implemented:
-# - gnc:count-data
-#   - This seems to be primarily for integrity checks?
-def parse(fobj):
-    """Parse GNU Cash XML data from a file object and return a Book object."""
-    try:
-        tree = ElementTree.parse(fobj)
-    except ParseError:
-        raise ValueError("File stream was not a valid GNU Cash v2 XML file")
+def parse(fobj, stats=None, progress=None, intern=True, lazy=False, cache_size=10000,
+          verify=False, text_index=False, backend='etree', exact=False):
+    """
+    Parse GNU Cash XML data from a file object and return a Book object.
+
+    See from_filename() for the other arguments.
+    """
+    ctx = _LoadContext(_make_stats(stats), progress and _ProgressReporter(progress), intern,
+                       verify, exact)
+    return _load(_StreamSource(fobj, ctx), ctx, lazy, cache_size, text_index, backend)
+
+
+def _load(source, ctx, lazy, cache_size, text_index=False, backend='etree'):
+    if backend not in _BACKENDS:
+        raise ValueError("Unknown backend {}".format(backend))
+    if lazy:
+        book = _parse_lazy(source, ctx, cache_size, backend)
+    else:
+        book = _parse(source, ctx, backend)
+    if text_index:
+        book.text_index = TextIndex(book)
+    return book
+
+
+# XML parsers selectable with the backend argument
+_BACKENDS = ('etree', 'expat')
+# Set by _etree()
+_LXML = None
+
+
+def _etree():
+    # lxml if it is installed, imported on first use
+    global ElementTree, _LXML
+    if _LXML is None:
+        try:
+            import lxml.etree as ElementTree
+            _LXML = True
+        except ImportError:
+            from xml.etree import ElementTree
+            _LXML = False
+    return ElementTree
+
+
+def _parse(source, ctx, backend='etree'):
+    stats = ctx.stats
+    if stats is not None and stats._start is None:
+        stats._begin()
+    if backend == 'expat':
+        parser = _ExpatBuilder(ctx)
+        feed = parser.feed
+        errors = expat.ExpatError
+    else:
+        etree = _etree()
+        parser = etree.XMLParser()
+        errors = (ParseError, etree.ParseError)
+        if _LXML:
+            # lxml only accepts bytes, not memory views
+            def feed(chunk):
+                parser.feed(bytes(chunk))
+        else:
+            feed = parser.feed
+    with ctx.section('xml'):
+        try:
+            source.feed(feed)
+            root = parser.close()
+        except errors:
+            raise ValueError("File stream was not a valid GNU Cash v2 XML file")
+    if stats is not None:
+        # reading and decompressing happen while feeding the parser
+        stats.sections['xml'] -= (stats.sections.get('read', 0.0) +
+                                  stats.sections.get('decompress', 0.0))
 
-    root = tree.getroot()
     if root.tag != 'gnc-v2':
         raise ValueError("File stream was not a valid GNU Cash v2 XML file")
-    return _book_from_tree(root.find("{http://www.gnucash.org/XML/gnc}book"))
+    if backend == 'expat':
+        ctx.records = parser.records
+    if ctx.intern is not _identity and (backend == 'expat' or not _LXML):
+        with ctx.section('intern'):
+            _intern_tree(root, ctx.intern_table)
+            if backend == 'expat':
+                for tree in parser.slot_trees():
+                    _intern_tree(tree, ctx.intern_table)
+    book = _book_from_tree(root.find("{http://www.gnucash.org/XML/gnc}book"), ctx)
+    if backend == 'expat':
+        book._skipped = parser.skipped
+    if stats is not None:
+        book.load_stats = stats
+        stats._finish()
+    ctx.finish()
+    return book
 
 
 # Implemented:
@@ -447,14 +1566,15 @@ def parse(fobj):
 # - gnc:commodity
 # - gnc:account
 # - gnc:transaction
-#
-# Not implemented:
 # - gnc:schedxaction
 # - gnc:template-transactions
-# - gnc:count-data
-#   - This seems to be primarily for integrity checks?
-def _book_from_tree(tree):
+# - gnc:budget
+# - gnc:count-data (only with verify=True)
+def _book_from_tree(tree, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     guid = tree.find('{http://www.gnucash.org/XML/book}id').text
+    ctx.lots = {}
 
     # Implemented:
     # - cmdty:id
@@ -473,20 +1593,22 @@ def _book_from_tree(tree):
         return Commodity(name=name, space=space)
 
     def _commodity_find(space, name):
-        return commoditydict.setdefault((space, name), Commodity(name=name, space=space))
+        return _find_commodity(commoditydict, space, name)
 
     commodities = []  # This will store the Gnucash root list of commodities
     commoditydict = {}  # This will store the list of commodities used
     # The above two may not be equal! eg prices may include commodities
     # that are not represented in the account tree
 
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}commodity'):
-        comm = _commodity_from_tree(child)
-        commodities.append(_commodity_find(comm.space, comm.name))
-        # COMPACT:
-        # name = child.find('{http://www.gnucash.org/XML/cmdty}id').text
-        # space = child.find('{http://www.gnucash.org/XML/cmdty}space').text
-        # commodities.append(_commodity_find(space, name))
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}commodity')
+    with ctx.section('commodities', len(children)):
+        for child in ctx.iterate(children):
+            comm = _commodity_from_tree(child)
+            commodities.append(_commodity_find(comm.space, comm.name))
+            # COMPACT:
+            # name = child.find('{http://www.gnucash.org/XML/cmdty}id').text
+            # space = child.find('{http://www.gnucash.org/XML/cmdty}space').text
+            # commodities.append(_commodity_find(space, name))
 
     # Implemented:
     # - price
@@ -501,8 +1623,8 @@ def _book_from_tree(tree):
         ts = "{http://www.gnucash.org/XML/ts}"
 
         guid = tree.find(price + 'id').text
-        value = _parse_number(tree.find(price + 'value').text)
-        date = parse_date(tree.find(price + 'time/' + ts + 'date').text)
+        value = ctx.number(tree.find(price + 'value').text)
+        date = ctx.date(tree.find(price + 'time/' + ts + 'date').text)
 
         currency_space = tree.find(price + "currency/" + cmdty + "space").text
         currency_name = tree.find(price + "currency/" + cmdty + "id").text
@@ -521,62 +1643,140 @@ def _book_from_tree(tree):
     prices = []
     t = tree.find('{http://www.gnucash.org/XML/gnc}pricedb')
     if t is not None:
-        for child in t.findall('price'):
-            price = _price_from_tree(child)
-            prices.append(price)
+        children = t.findall('price')
+        with ctx.section('prices', len(children)):
+            for child in ctx.iterate(children):
+                price = _price_from_tree(child)
+                prices.append(price)
 
     root_account = None
     accounts = []
     accountdict = {}
     parentdict = {}
 
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}account'):
-        parent_guid, acc = _account_from_tree(child, commoditydict)
-        if acc.actype == 'ROOT':
-            root_account = acc
-        accountdict[acc.guid] = acc
-        parentdict[acc.guid] = parent_guid
-    for acc in list(accountdict.values()):
-        if acc.parent is None and acc.actype != 'ROOT':
-            parent = accountdict[parentdict[acc.guid]]
-            acc.parent = parent
-            parent.children.append(acc)
-            accounts.append(acc)
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}account')
+    with ctx.section('accounts', len(children)):
+        for child in ctx.iterate(children):
+            parent_guid, acc = _account_from_tree(child, commoditydict, ctx)
+            if acc.actype == 'ROOT':
+                root_account = acc
+            accountdict[acc.guid] = acc
+            parentdict[acc.guid] = parent_guid
+    with ctx.section('account linking'):
+        for acc in list(accountdict.values()):
+            if acc.parent is None and acc.actype != 'ROOT':
+                parent = accountdict[parentdict[acc.guid]]
+                acc.parent = parent
+                parent.children.append(acc)
+                accounts.append(acc)
 
     transactions = []
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}'
-                              'transaction'):
-        transactions.append(_transaction_from_tree(child,
-                                                   accountdict,
-                                                   commoditydict))
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}'
+                            'transaction')
+    with ctx.section('transactions', len(children) + len(ctx.records)):
+        for child in ctx.iterate(children):
+            transactions.append(_transaction_from_tree(child,
+                                                       accountdict,
+                                                       commoditydict,
+                                                       ctx))
+        # already decoded by the expat backend
+        for record in ctx.iterate(ctx.records):
+            transactions.append(_transaction_from_record(record,
+                                                         accountdict,
+                                                         commoditydict,
+                                                         ctx))
+
+    # The template transactions of scheduled transactions have splits in
+    # template accounts of their own, outside the account tree.
+    templatedict = {}
+    template_accounts = {}
+    templates = tree.find('{http://www.gnucash.org/XML/gnc}template-transactions')
+    if templates is not None:
+        with ctx.section('template transactions'):
+            template_parents = {}
+            for child in templates.findall('{http://www.gnucash.org/XML/gnc}account'):
+                parent_guid, acc = _account_from_tree(child, commoditydict, ctx)
+                template_accounts[acc.guid] = acc
+                template_parents[acc.guid] = parent_guid
+            for acc in template_accounts.values():
+                parent = template_accounts.get(template_parents[acc.guid])
+                if parent is not None:
+                    acc.parent = parent
+                    parent.children.append(acc)
+            for child in templates.findall('{http://www.gnucash.org/XML/gnc}transaction'):
+                trn = _transaction_from_tree(child, template_accounts, commoditydict, ctx)
+                for account_guid in set(split.account.guid for split in trn.splits):
+                    templatedict.setdefault(account_guid, []).append(trn)
+
+    schedxactions = []
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}schedxaction')
+    with ctx.section('scheduled transactions', len(children)):
+        for child in ctx.iterate(children):
+            schedxactions.append(_schedxaction_from_tree(child, templatedict, ctx,
+                                                         template_accounts))
+
+    budgets = []
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}budget')
+    with ctx.section('budgets', len(children)):
+        for child in ctx.iterate(children):
+            budgets.append(_budget_from_tree(child, ctx))
 
     customersdict = {}
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}GncCustomer'):
-        customer = _customer_from_tree(child)
-        customersdict[customer.guid] = customer
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}GncCustomer')
+    with ctx.section('customers', len(children)):
+        for child in ctx.iterate(children):
+            customer = _customer_from_tree(child)
+            customersdict[customer.guid] = customer
 
     vendorsdict = {}
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}GncVendor'):
-        vendor = _vendor_from_tree(child)
-        vendorsdict[vendor.guid] = vendor
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}GncVendor')
+    with ctx.section('vendors', len(children)):
+        for child in ctx.iterate(children):
+            vendor = _vendor_from_tree(child)
+            vendorsdict[vendor.guid] = vendor
 
     taxtablesdict = {}
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}GncTaxTable'):
-        taxtable = _taxtable_from_tree(child)
-        taxtablesdict[taxtable.guid] = taxtable
-
-    entriesdict = {}
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}GncEntry'):
-        entry = _entry_from_tree(child, taxtablesdict)
-        entriesdict[entry.guid] = entry
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}GncTaxTable')
+    with ctx.section('taxtables', len(children)):
+        for child in ctx.iterate(children):
+            taxtable = _taxtable_from_tree(child, ctx)
+            taxtablesdict[taxtable.guid] = taxtable
+
+    invoiceentriesdict = {}
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}GncEntry')
+    with ctx.section('entries', len(children)):
+        for child in ctx.iterate(children):
+            entry = _entry_from_tree(child, taxtablesdict, ctx)
+            invoiceentriesdict.setdefault(entry.invoice_guid, []).append(entry)
 
     invoices = []
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}GncInvoice'):
-        invoices.append(_invoice_from_tree(child, customersdict, entriesdict, vendorsdict))
-
-    slots = _slots_from_tree(
-        tree.find('{http://www.gnucash.org/XML/book}slots'))
-    return Book(tree=tree,
+    children = tree.findall('{http://www.gnucash.org/XML/gnc}GncInvoice')
+    with ctx.section('invoices', len(children)):
+        for child in ctx.iterate(children):
+            invoices.append(_invoice_from_tree(child, customersdict, invoiceentriesdict, vendorsdict, ctx))
+
+    with ctx.section('book slots'):
+        slots = ctx.slots(tree.find('{http://www.gnucash.org/XML/book}slots'))
+    if ctx.lazy is not None:
+        ctx.lazy.update(accountdict=accountdict, commoditydict=commoditydict)
+    if ctx.stats is not None:
+        ctx.stats.counts['splits'] = sum(len(trn.splits) for trn in transactions)
+    if ctx.verify is not None:
+        with ctx.section('verify'):
+            ctx.verify._check_counts(tree, {
+                'commodity': len(commodities),
+                'account': len(accountdict),
+                'transaction': len(transactions),
+                'price': len(prices),
+                'gnc:GncCustomer': len(customersdict),
+                'gnc:GncVendor': len(vendorsdict),
+                'gnc:GncTaxTable': len(taxtablesdict),
+                'gnc:GncEntry': sum(len(entries) for entries in invoiceentriesdict.values()),
+                'gnc:GncInvoice': len(invoices),
+                'schedxaction': len(schedxactions),
+                'budget': len(budgets),
+            })
+    book = Book(tree=tree,
                 guid=guid,
                 prices=prices,
                 transactions=transactions,
@@ -584,7 +1784,12 @@ def _book_from_tree(tree):
                 accounts=accounts,
                 commodities=commodities,
                 slots=slots,
-                invoices=invoices)
+                invoices=invoices,
+                schedxactions=schedxactions,
+                budgets=budgets)
+    book.verification = ctx.verify
+    book.exact = ctx._number is _parse_money
+    return book
 
 
 # Implemented:
@@ -596,7 +1801,10 @@ def _book_from_tree(tree):
 # - act:commodity-scu
 # - act:parent
 # - act:slots
-def _account_from_tree(tree, commoditydict):
+# - act:lots
+def _account_from_tree(tree, commoditydict, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     act = '{http://www.gnucash.org/XML/act}'
     cmdty = '{http://www.gnucash.org/XML/cmdty}'
 
@@ -606,7 +1814,7 @@ def _account_from_tree(tree, commoditydict):
     description = tree.find(act + "description")
     if description is not None:
         description = description.text
-    slots = _slots_from_tree(tree.find(act + 'slots'))
+    slots = ctx.slots(tree.find(act + 'slots'))
     if actype == 'ROOT':
         parent_guid = None
         commodity = None
@@ -618,14 +1826,33 @@ def _account_from_tree(tree, commoditydict):
         commodity_name = tree.find(act + 'commodity/' +
                                    cmdty + 'id').text
         commodity_scu = tree.find(act + 'commodity-scu').text
-        commodity = commoditydict[(commodity_space, commodity_name)]
-    return parent_guid, Account(name=name,
-                                description=description,
-                                guid=guid,
-                                actype=actype,
-                                commodity=commodity,
-                                commodity_scu=commodity_scu,
-                                slots=slots)
+        commodity = _find_commodity(commoditydict, commodity_space, commodity_name)
+    account = Account(name=name,
+                      description=description,
+                      guid=guid,
+                      actype=actype,
+                      commodity=commodity,
+                      commodity_scu=commodity_scu,
+                      slots=slots)
+    lots = tree.find(act + 'lots')
+    if lots is not None:
+        for child in lots.findall('{http://www.gnucash.org/XML/gnc}lot'):
+            lot = _lot_from_tree(child, account, ctx)
+            account.lots.append(lot)
+            ctx.lots[lot.guid] = lot
+    return parent_guid, account
+
+
+# Implemented:
+# - lot:id
+# - lot:slots
+def _lot_from_tree(tree, account, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
+    lot = '{http://www.gnucash.org/XML/lot}'
+    return Lot(guid=tree.find(lot + 'id').text,
+               account=account,
+               slots=ctx.slots(tree.find(lot + 'slots')))
 
 
 # Implemented:
@@ -636,7 +1863,9 @@ def _account_from_tree(tree, commoditydict):
 # - trn:description
 # - trn:splits / trn:split
 # - trn:slots
-def _transaction_from_tree(tree, accountdict, commoditydict):
+def _transaction_from_tree(tree, accountdict, commoditydict, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     trn = '{http://www.gnucash.org/XML/trn}'
     cmdty = '{http://www.gnucash.org/XML/cmdty}'
     ts = '{http://www.gnucash.org/XML/ts}'
@@ -646,19 +1875,19 @@ def _transaction_from_tree(tree, accountdict, commoditydict):
                                cmdty + "space").text
     currency_name = tree.find(trn + "currency/" +
                               cmdty + "id").text
-    currency = commoditydict[(currency_space, currency_name)]
-    date = parse_date(tree.find(trn + "date-posted/" +
-                                ts + "date").text)
-    date_entered = parse_date(tree.find(trn + "date-entered/" +
-                                        ts + "date").text)
-    description = tree.find(trn + "description").text
+    currency = _find_commodity(commoditydict, currency_space, currency_name)
+    date = ctx.date(tree.find(trn + "date-posted/" +
+                              ts + "date").text)
+    date_entered = ctx.date(tree.find(trn + "date-entered/" +
+                                      ts + "date").text)
+    description = ctx.intern(tree.find(trn + "description").text)
 
     # rarely used
     num = tree.find(trn + "num")
     if num is not None:
         num = num.text
 
-    slots = _slots_from_tree(tree.find(trn + "slots"))
+    slots = ctx.slots(tree.find(trn + "slots"))
     transaction = Transaction(guid=guid,
                               currency=currency,
                               date=date,
@@ -668,12 +1897,119 @@ def _transaction_from_tree(tree, accountdict, commoditydict):
                               slots=slots)
 
     for subtree in tree.findall(trn + "splits/" + trn + "split"):
-        split = _split_from_tree(subtree, accountdict, transaction)
-        transaction.splits.append(split)
+        split = _split_from_tree(subtree, accountdict, transaction, ctx)
+        if split is not None:
+            transaction.splits.append(split)
+    if ctx.verify is not None:
+        ctx.verify._check_transaction(tree, transaction)
 
     return transaction
 
 
+def _gdate(tree):
+    # <gdate>2020-01-31</gdate> inside tree, or None
+    if tree is None:
+        return None
+    year, month, day = tree.find('gdate').text.split('-')
+    return datetime.date(int(year), int(month), int(day))
+
+
+# Implemented:
+# - recurrence:mult
+# - recurrence:period_type
+# - recurrence:start
+# - recurrence:weekend_adj
+def _recurrence_from_tree(tree):
+    recurrence = '{http://www.gnucash.org/XML/recurrence}'
+    weekend_adj = tree.find(recurrence + 'weekend_adj')
+    return Recurrence(mult=int(tree.find(recurrence + 'mult').text),
+                      period_type=tree.find(recurrence + 'period_type').text,
+                      start=_gdate(tree.find(recurrence + 'start')),
+                      weekend_adj=weekend_adj.text if weekend_adj is not None else None)
+
+
+# Implemented:
+# - sx:id
+# - sx:name
+# - sx:enabled
+# - sx:start
+# - sx:last
+# - sx:end
+# - sx:num-occur
+# - sx:rem-occur
+# - sx:instanceCount
+# - sx:templ-acct
+# - sx:schedule
+# - sx:slots
+#
+# Not implemented:
+# - sx:autoCreate, sx:autoCreateNotify
+# - sx:advanceCreateDays, sx:advanceRemindDays
+# - sx:deferredInstance
+def _schedxaction_from_tree(tree, templatedict, ctx=None, template_accounts=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
+    sx = '{http://www.gnucash.org/XML/sx}'
+
+    def _int(tag):
+        elt = tree.find(sx + tag)
+        return int(elt.text) if elt is not None else None
+
+    enabled = tree.find(sx + 'enabled')
+    instance_count = _int('instanceCount')
+    template_guid = tree.find(sx + 'templ-acct').text
+    schedule = tree.find(sx + 'schedule')
+    recurrences = []
+    if schedule is not None:
+        recurrences = [_recurrence_from_tree(child) for child in
+                       schedule.findall('{http://www.gnucash.org/XML/gnc}recurrence')]
+    return ScheduledTransaction(
+        guid=tree.find(sx + 'id').text,
+        name=tree.find(sx + 'name').text,
+        enabled=enabled is None or enabled.text == 'y',
+        start=_gdate(tree.find(sx + 'start')),
+        end=_gdate(tree.find(sx + 'end')),
+        last=_gdate(tree.find(sx + 'last')),
+        num_occur=_int('num-occur'),
+        rem_occur=_int('rem-occur'),
+        instance_count=instance_count or 0,
+        recurrences=recurrences,
+        transactions=templatedict.get(template_guid, []),
+        slots=ctx.slots(tree.find(sx + 'slots')),
+        template_account=(template_accounts or {}).get(template_guid))
+
+
+# Implemented:
+# - bgt:id
+# - bgt:name
+# - bgt:description
+# - bgt:num-periods
+# - bgt:recurrence
+# - bgt:slots (the amounts are taken out as Budget.amounts)
+def _budget_from_tree(tree, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
+    bgt = '{http://www.gnucash.org/XML/bgt}'
+    num_periods = int(tree.find(bgt + 'num-periods').text)
+    description = tree.find(bgt + 'description')
+    # amounts are kept per account GUID and period number, apart from
+    # the other slots
+    amounts = {}
+    slots = {}
+    for key, value in _slots_from_tree(tree.find(bgt + 'slots'), ctx).items():
+        if _GUID_RE.match(key) and isinstance(value, Mapping):
+            amounts[key] = tuple(value.get(str(period)) for period in range(num_periods))
+        else:
+            slots[key] = value
+    return Budget(guid=tree.find(bgt + 'id').text,
+                  name=tree.find(bgt + 'name').text,
+                  description=description.text if description is not None else None,
+                  num_periods=num_periods,
+                  recurrence=_recurrence_from_tree(tree.find(bgt + 'recurrence')),
+                  amounts=amounts,
+                  slots=slots)
+
+
 # Implemented:
 # - entry:guid
 # - entry:action
@@ -683,21 +2019,23 @@ def _transaction_from_tree(tree, accountdict, commoditydict):
 # - entry:invoice
 # - entry:i-taxable
 # - entry:i-taxtable
-def _entry_from_tree(tree, taxtabledict):
+def _entry_from_tree(tree, taxtabledict, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     xml_entry = '{http://www.gnucash.org/XML/entry}'
     guid = tree.find(xml_entry + "guid").text
     action = None
     if tree.find(xml_entry + "action") is not None:
-        action = tree.find(xml_entry + "action").text
+        action = ctx.intern(tree.find(xml_entry + "action").text)
     description = None
     if tree.find(xml_entry + "description") is not None:
         description = tree.find(xml_entry + "description").text
     qty = None
     if tree.find(xml_entry + "qty") is not None:
-        qty = _parse_number(tree.find(xml_entry + "qty").text)
+        qty = ctx.number(tree.find(xml_entry + "qty").text)
     price = None
     if tree.find(xml_entry + "i-price") is not None:
-        price = _parse_number(tree.find(xml_entry + "i-price").text)
+        price = ctx.number(tree.find(xml_entry + "i-price").text)
     invoice_guid = None
     if tree.find(xml_entry + "invoice") is not None:
         invoice_guid = tree.find(xml_entry + "invoice").text
@@ -756,9 +2094,11 @@ def _vendor_from_tree(tree):
 # Implemented:
 # - tte:amount
 # - tte:type
-def _taxtableentry_from_tree(tree):
+def _taxtableentry_from_tree(tree, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     tte = '{http://www.gnucash.org/XML/tte}'
-    tte_amount = _parse_number(tree.find(tte + "amount").text)
+    tte_amount = ctx.number(tree.find(tte + "amount").text)
     tte_type = tree.find(tte + "type").text
     taxtableentry = Taxtableentry(amount=tte_amount, ttetype=tte_type)
     return taxtableentry
@@ -768,14 +2108,14 @@ def _taxtableentry_from_tree(tree):
 # - taxtable:guid
 # - taxtable:name
 # - taxtable:vendor
-def _taxtable_from_tree(tree):
+def _taxtable_from_tree(tree, ctx=None):
     taxtable = '{http://www.gnucash.org/XML/taxtable}'
     guid = tree.find(taxtable + "guid").text
     name = tree.find(taxtable + "name").text
     taxtable_entries_tree = tree.find(taxtable + "entries")
     taxtable_entries = []
     for child in taxtable_entries_tree:
-        taxtable_entry = _taxtableentry_from_tree(child)
+        taxtable_entry = _taxtableentry_from_tree(child, ctx)
         taxtable_entries.append(taxtable_entry)
 
     # amount
@@ -805,7 +2145,9 @@ def _taxtable_from_tree(tree):
 # - invoice:id
 # - invoice:owner
 # - invoice:posted / ts:date
-def _invoice_from_tree(tree, customersdict, entriesdict, vendorsdict):
+def _invoice_from_tree(tree, customersdict, invoiceentriesdict, vendorsdict, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     invoice = '{http://www.gnucash.org/XML/invoice}'
     ts = '{http://www.gnucash.org/XML/ts}'
     owner = '{http://www.gnucash.org/XML/owner}'
@@ -816,7 +2158,7 @@ def _invoice_from_tree(tree, customersdict, entriesdict, vendorsdict):
 
     guid = tree.find(invoice + "guid").text
     id = tree.find(invoice + "id").text
-    date = parse_date((tree.find(invoice + "opened/" + ts + "date")).text)
+    date = ctx.date((tree.find(invoice + "opened/" + ts + "date")).text)
 
     owner_tree = tree.find(invoice + "owner")
     owner_type = owner_tree.find(owner + "type").text
@@ -835,11 +2177,7 @@ def _invoice_from_tree(tree, customersdict, entriesdict, vendorsdict):
 
     active = tree.find(invoice + "active").text
 
-    entries = []
-    for key in entriesdict.keys():
-        entry = entriesdict[key]
-        if entry.invoice_guid == guid:
-            entries.append(entry)
+    entries = list(invoiceentriesdict.get(guid, ()))
 
     # posttxn = tree.find(invoice + "posttxn").text
     # print "posttxn {}".format(posttxn)
@@ -873,27 +2211,38 @@ def _invoice_from_tree(tree, customersdict, entriesdict, vendorsdict):
 # - split:value
 # - split:quantity
 # - split:account
+# - split:lot
 # - split:slots
-def _split_from_tree(tree, accountdict, transaction):
+def _split_from_tree(tree, accountdict, transaction, ctx=None):
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     split = '{http://www.gnucash.org/XML/split}'
     ts = "{http://www.gnucash.org/XML/ts}"
 
     guid = tree.find(split + "id").text
     memo = tree.find(split + "memo")
     if memo is not None:
-        memo = memo.text
-    reconciled_state = tree.find(split + "reconciled-state").text
+        memo = ctx.intern(memo.text)
+    reconciled_state = ctx.intern(tree.find(split + "reconciled-state").text)
     reconcile_date = tree.find(split + "reconcile-date/" + ts + "date")
     if reconcile_date is not None:
-        reconcile_date = parse_date(reconcile_date.text)
-    value = _parse_number(tree.find(split + "value").text)
-    quantity = _parse_number(tree.find(split + "quantity").text)
+        reconcile_date = ctx.date(reconcile_date.text)
+    value = ctx.number(tree.find(split + "value").text)
+    quantity = ctx.number(tree.find(split + "quantity").text)
     account_guid = tree.find(split + "account").text
-    account = accountdict[account_guid]
-    slots = _slots_from_tree(tree.find(split + "slots"))
+    account = accountdict.get(account_guid)
+    if account is None:
+        if ctx.verify is None:
+            raise KeyError(account_guid)
+        ctx.verify.unresolved.append((transaction.guid, guid, account_guid))
+        return None
+    slots = ctx.slots(tree.find(split + "slots"))
     action = tree.find(split + "action")
     if action is not None:
-        action = action.text
+        action = ctx.intern(action.text)
+    lot = tree.find(split + "lot")
+    if lot is not None:
+        lot = ctx.lots.get(lot.text)
 
     split = Split(guid=guid,
                   memo=memo,
@@ -904,39 +2253,110 @@ def _split_from_tree(tree, accountdict, transaction):
                   account=account,
                   transaction=transaction,
                   action=action,
-                  slots=slots)
-    account.splits.append(split)
+                  slots=slots,
+                  lot=lot)
+    if ctx.register_splits:
+        account.splits.append(split)
+        if lot is not None:
+            lot.splits.append(split)
     return split
 
 
+_slots_lock = threading.Lock()
+
+
+class _LazySlots(MutableMapping):
+    """
+    The slots of an object, decoded from their XML on first access.
+
+    Most reports never look at slots, so decoding them (dates, numbers,
+    nested frames) is deferred until needed and then cached. Behaves like
+    the dictionary it replaces.
+    """
+
+    __slots__ = ('_tree', '_ctx', '_data')
+
+    def __init__(self, tree, ctx):
+        self._tree = tree
+        self._ctx = ctx
+        self._data = None
+
+    def _decoded(self):
+        data = self._data
+        if data is None:
+            # books are shared between threads; decode and publish once
+            with _slots_lock:
+                data = self._data
+                if data is None:
+                    data = _slots_from_tree(self._tree, self._ctx)
+                    self._data = data
+                    # the tree stays, for write() to keep the slot types
+                    self._ctx = None
+        return data
+
+    def __getitem__(self, key):
+        return self._decoded()[key]
+
+    def __setitem__(self, key, value):
+        self._decoded()[key] = value
+
+    def __delitem__(self, key):
+        del self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __contains__(self, key):
+        return key in self._decoded()
+
+    def get(self, key, default=None):
+        return self._decoded().get(key, default)
+
+    def copy(self):
+        return dict(self._decoded())
+
+    def __repr__(self):
+        return repr(self._decoded())
+
+    def __reduce__(self):
+        return (dict, (self._decoded(),))
+
+
 # Implemented:
 # - slot
 # - slot:key
 # - slot:value
 # - ts:date
 # - gdate
-def _slots_from_tree(tree):
+def _slots_from_tree(tree, ctx=None):
     if tree is None:
         return {}
+    if ctx is None:
+        ctx = _DEFAULT_CONTEXT
     slot = "{http://www.gnucash.org/XML/slot}"
     ts = "{http://www.gnucash.org/XML/ts}"
     slots = {}
     for elt in tree.findall("slot"):
-        key = elt.find(slot + "key").text
+        key = sys.intern(elt.find(slot + "key").text)
         value = elt.find(slot + "value")
         type_ = value.get('type', 'string')
-        if type_ in ('integer', 'double'):
+        if type_ == 'integer':
             slots[key] = int(value.text)
+        elif type_ == 'double':
+            slots[key] = float(value.text)
         elif type_ == 'numeric':
-            slots[key] = _parse_number(value.text)
+            slots[key] = ctx.number(value.text)
         elif type_ in ('string', 'guid'):
-            slots[key] = value.text
+            slots[key] = ctx.intern(value.text)
         elif type_ == 'gdate':
-            slots[key] = parse_date(value.find("gdate").text)
+            slots[key] = ctx.date(value.find("gdate").text)
         elif type_ == 'timespec':
-            slots[key] = parse_date(value.find(ts + "date").text)
+            slots[key] = ctx.date(value.find(ts + "date").text)
         elif type_ == 'frame':
-            slots[key] = _slots_from_tree(value)
+            slots[key] = _slots_from_tree(value, ctx)
         else:
             raise RuntimeError("Unknown slot type {}".format(type_))
     return slots
@@ -949,10 +2369,3757 @@ def _parse_number(numstring):
     return amount_dec
 
 
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            return o.isoformat()
-        if isinstance(o, decimal.Decimal):
-            return float(o)
-        return o.__dict__
+def _parse_money(numstring):
+    num, denum = numstring.split("/")
+    return Money(int(num), int(denum))
+
+
+# The date formats GNU Cash writes: "2020-01-31 10:59:00 +0100" for
+# timestamps and "2020-01-31" for gdate slots.
+_DATE_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?: (\d\d):(\d\d):(\d\d)(?: ([+-]\d\d)(\d\d))?)?\Z')
+_TIMEZONES = {}
+
+
+def _parse_date(text):
+    match = _DATE_RE.match(text)
+    if match is None:
+        # anything else is left to dateutil
+        return __getattr__('parse_date')(text)
+    year, month, day, hour, minute, second, hours, minutes = match.groups()
+    if hour is None:
+        return datetime.datetime(int(year), int(month), int(day))
+    tzinfo = None
+    if hours is not None:
+        tzinfo = _TIMEZONES.get(hours + minutes)
+        if tzinfo is None:
+            sign = -1 if hours[0] == '-' else 1
+            offset = datetime.timedelta(hours=int(hours), minutes=sign * int(minutes))
+            tzinfo = _TIMEZONES[hours + minutes] = datetime.timezone(offset)
+    return datetime.datetime(int(year), int(month), int(day),
+                             int(hour), int(minute), int(second), tzinfo=tzinfo)
+
+
+_DEFAULT_CONTEXT = _LoadContext()
+
+
+##################################################################
+# Expat backend
+
+# expat reports names as "namespace local" (see namespace_separator)
+_X_GNC = 'http://www.gnucash.org/XML/gnc '
+_X_TRN = 'http://www.gnucash.org/XML/trn '
+_X_SPLIT = 'http://www.gnucash.org/XML/split '
+
+# End tags inside a transaction whose text is stored in the current
+# transaction or split record, by field name
+_EXPAT_FIELDS = {
+    _X_TRN + 'id': 'id',
+    'http://www.gnucash.org/XML/cmdty space': 'currency_space',
+    'http://www.gnucash.org/XML/cmdty id': 'currency_id',
+    'http://www.gnucash.org/XML/ts date': 'date_text',
+    _X_TRN + 'description': 'description',
+    _X_TRN + 'num': 'num',
+    _X_SPLIT + 'id': 'id',
+    _X_SPLIT + 'memo': 'memo',
+    _X_SPLIT + 'action': 'action',
+    _X_SPLIT + 'reconciled-state': 'reconciled_state',
+    _X_SPLIT + 'value': 'value',
+    _X_SPLIT + 'quantity': 'quantity',
+    _X_SPLIT + 'account': 'account',
+    _X_SPLIT + 'lot': 'lot',
+}
+
+# End tags of the elements wrapping a ts:date, and the field it goes to
+_EXPAT_DATES = {
+    _X_TRN + 'date-posted': 'date',
+    _X_TRN + 'date-entered': 'date_entered',
+    _X_SPLIT + 'reconcile-date': 'reconcile_date',
+}
+
+_EXPAT_SLOTS = frozenset((_X_TRN + 'slots', _X_SPLIT + 'slots'))
+
+# All elements inside a transaction that end up in its record
+_EXPAT_KNOWN = _EXPAT_SLOTS.union(_EXPAT_FIELDS, _EXPAT_DATES, (
+    _X_TRN + 'currency', _X_TRN + 'splits', _X_TRN + 'split'))
+
+
+class _ExpatBuilder(object):
+    # A state machine over the expat events of a whole file. Transactions
+    # (outside the template transactions) are decoded into flat records
+    # through the tables above, in the same pass; only their slots are
+    # kept as small element trees, for _LazySlots. Everything else is
+    # passed on to an ElementTree TreeBuilder, so the remaining sections
+    # are read by the usual _*_from_tree functions.
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.records = []
+        self.skipped = 0
+        self.builder = TreeBuilder()
+        self.tags = {}
+        self.text = []
+        self.record = None
+        self.current = None
+        self.slots = None
+        self.depth = 0
+        self.templates = False
+        self.parser = parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.buffer_size = _FEED_SIZE
+        self._tree_mode()
+
+    def _tree_mode(self):
+        parser = self.parser
+        parser.StartElementHandler = self._tree_start
+        parser.EndElementHandler = self._tree_end
+        parser.CharacterDataHandler = self.builder.data
+
+    def _transaction_mode(self):
+        parser = self.parser
+        parser.StartElementHandler = self._trn_start
+        parser.EndElementHandler = self._trn_end
+        parser.CharacterDataHandler = self.text.append
+
+    def _slots_mode(self):
+        parser = self.parser
+        parser.StartElementHandler = self._slots_start
+        parser.EndElementHandler = self._slots_end
+        parser.CharacterDataHandler = self.slots.data
+
+    def _tag(self, name):
+        # "namespace local" to ElementTree's "{namespace}local"
+        tag = self.tags.get(name)
+        if tag is None:
+            namespace, _, local = name.rpartition(' ')
+            tag = self.tags[name] = '{' + namespace + '}' + local if namespace else local
+        return tag
+
+    def _attrs(self, attrs):
+        # attribute names are namespaced the same way, e.g. cd:type
+        if attrs:
+            attrs = dict((self._tag(key), value) for key, value in attrs.items())
+        return attrs
+
+    def _tree_start(self, name, attrs):
+        if name == _X_GNC + 'transaction' and not self.templates:
+            self.record = self.current = {'splits': []}
+            self.records.append(self.record)
+            self._transaction_mode()
+            return
+        if name == _X_GNC + 'template-transactions':
+            self.templates = True
+        self.builder.start(self._tag(name), self._attrs(attrs))
+
+    def _tree_end(self, name):
+        if name == _X_GNC + 'template-transactions':
+            self.templates = False
+        self.builder.end(self._tag(name))
+
+    def _trn_start(self, name, attrs):
+        del self.text[:]
+        if name == _X_TRN + 'split':
+            self.current = {}
+            self.record['splits'].append(self.current)
+        elif name in _EXPAT_SLOTS:
+            self.slots = TreeBuilder()
+            self.slots.start(self._tag(name), self._attrs(attrs))
+            self.depth = 0
+            self._slots_mode()
+        elif name not in _EXPAT_KNOWN:
+            self.skipped += 1
+
+    def _trn_end(self, name):
+        field = _EXPAT_FIELDS.get(name)
+        if field is not None:
+            self.current[field] = ''.join(self.text) or None
+        elif name in _EXPAT_DATES:
+            self.current[_EXPAT_DATES[name]] = self.current.pop('date_text')
+        elif name == _X_TRN + 'split':
+            self.current = self.record
+        elif name == _X_GNC + 'transaction':
+            self.record = self.current = None
+            self._tree_mode()
+        del self.text[:]
+
+    def _slots_start(self, name, attrs):
+        self.depth += 1
+        self.slots.start(self._tag(name), self._attrs(attrs))
+
+    def _slots_end(self, name):
+        if self.depth:
+            self.depth -= 1
+            self.slots.end(self._tag(name))
+            return
+        self.current['slots'] = self.slots.end(self._tag(name))
+        self.slots = None
+        self._transaction_mode()
+
+    def feed(self, chunk):
+        self.parser.Parse(chunk, False)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        return self.builder.close()
+
+    def slot_trees(self):
+        for record in self.records:
+            if 'slots' in record:
+                yield record['slots']
+            for fields in record['splits']:
+                if 'slots' in fields:
+                    yield fields['slots']
+
+
+# The same fields as _transaction_from_tree, from an _ExpatBuilder record
+def _transaction_from_record(record, accountdict, commoditydict, ctx):
+    currency = _find_commodity(commoditydict, record['currency_space'], record['currency_id'])
+    slots = record.get('slots')
+    transaction = Transaction(guid=record['id'],
+                              currency=currency,
+                              date=ctx.date(record['date']),
+                              date_entered=ctx.date(record['date_entered']),
+                              description=ctx.intern(record.get('description')),
+                              num=record.get('num'),
+                              slots=ctx.slots(slots))
+    for fields in record['splits']:
+        split = _split_from_record(fields, accountdict, transaction, ctx)
+        if split is not None:
+            transaction.splits.append(split)
+    if ctx.verify is not None:
+        ctx.verify._check_amounts([fields['value'] for fields in record['splits']],
+                                  transaction)
+    return transaction
+
+
+# The same fields as _split_from_tree, from an _ExpatBuilder record
+def _split_from_record(fields, accountdict, transaction, ctx):
+    guid = fields['id']
+    account_guid = fields['account']
+    account = accountdict.get(account_guid)
+    if account is None:
+        if ctx.verify is None:
+            raise KeyError(account_guid)
+        ctx.verify.unresolved.append((transaction.guid, guid, account_guid))
+        return None
+    memo = fields.get('memo')
+    if memo is not None:
+        memo = ctx.intern(memo)
+    action = fields.get('action')
+    if action is not None:
+        action = ctx.intern(action)
+    reconcile_date = fields.get('reconcile_date')
+    if reconcile_date is not None:
+        reconcile_date = ctx.date(reconcile_date)
+    lot = fields.get('lot')
+    if lot is not None:
+        lot = ctx.lots.get(lot)
+
+    split = Split(guid=guid,
+                  memo=memo,
+                  reconciled_state=ctx.intern(fields['reconciled_state']),
+                  reconcile_date=reconcile_date,
+                  value=ctx.number(fields['value']),
+                  quantity=ctx.number(fields['quantity']),
+                  account=account,
+                  transaction=transaction,
+                  action=action,
+                  slots=ctx.slots(fields.get('slots')),
+                  lot=lot)
+    if ctx.register_splits:
+        account.splits.append(split)
+        if lot is not None:
+            lot.splits.append(split)
+    return split
+
+
+##################################################################
+# Lazy loading
+
+# GNU Cash always writes these prefixes; the lazy loader relies on them
+# to find transactions in the raw data without parsing it.
+_LAZY_NAMESPACES = (b'xmlns:gnc="http://www.gnucash.org/XML/gnc"',
+                    b'xmlns:trn="http://www.gnucash.org/XML/trn"',
+                    b'xmlns:split="http://www.gnucash.org/XML/split"',
+                    b'xmlns:ts="http://www.gnucash.org/XML/ts"')
+_ROOT_TAG_RE = re.compile(br'<gnc-v2\b[^>]*>')
+_TRANSACTION_START = b'<gnc:transaction '
+_TRANSACTION_END = b'</gnc:transaction>'
+_TEMPLATES_RE = re.compile(br'<gnc:template-transactions\b.*?</gnc:template-transactions>', re.S)
+_TRN_ID_RE = re.compile(br'<trn:id\b[^>]*>([^<]+)</trn:id>')
+_TRN_DATE_RE = re.compile(br'<trn:date-posted>\s*<ts:date>([^<]+)</ts:date>')
+_SPLIT_ACCOUNT_RE = re.compile(br'<split:account\b[^>]*>([^<]+)</split:account>')
+
+
+class TransactionIndex(object):
+    """
+    Index of the transactions of a lazily loaded book.
+
+    One entry per transaction, in file order: guids, posted dates (the
+    raw GNU Cash date strings, not parsed), the account GUIDs of its
+    splits, and the start and end byte offsets of its XML in the
+    uncompressed data.
+    """
+
+    def __init__(self):
+        self.guids = []
+        self.dates = []
+        self.accounts = []
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+        self._positions = None
+
+    def __len__(self):
+        return len(self.guids)
+
+    def position(self, guid):
+        """Return the index of the transaction with this GUID, or None."""
+        positions = self._positions
+        if positions is None:
+            positions = self._positions = dict((g, i) for i, g in enumerate(self.guids))
+        return positions.get(guid)
+
+
+class _LazyStore(object):
+    # Decodes transactions of a lazily loaded book from the raw data on
+    # demand, keeping the most recently used cache_size of them.
+
+    def __init__(self, data, root_tag, index, accountdict, commoditydict, ctx, cache_size):
+        self.data = data
+        self.root_tag = root_tag
+        self.index = index
+        self.accountdict = accountdict
+        self.commoditydict = commoditydict
+        self.ctx = ctx
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.splitcounts = {}
+        self.positions = {}
+        for position, guids in enumerate(index.accounts):
+            for guid in guids:
+                self.splitcounts[guid] = self.splitcounts.get(guid, 0) + 1
+            for guid in set(guids):
+                self.positions.setdefault(guid, array.array('q')).append(position)
+
+    def transaction(self, position):
+        cache = self.cache
+        transaction = cache.get(position)
+        if transaction is not None:
+            cache.move_to_end(position)
+            return transaction
+        transaction = _transaction_from_tree(self.element(position), self.accountdict,
+                                             self.commoditydict, self.ctx)
+        cache[position] = transaction
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return transaction
+
+    def element(self, position):
+        # The gnc:transaction element, parsed from the raw data
+        index = self.index
+        fragment = b''.join((self.root_tag,
+                             self.data[index.starts[position]:index.ends[position]],
+                             b'</gnc-v2>'))
+        return _etree().fromstring(fragment)[0]
+
+
+class _LazyTransactions(Sequence):
+    """The transactions of a lazily loaded book, decoded on access."""
+
+    def __init__(self, store):
+        self._store = store
+
+    @property
+    def index(self):
+        return self._store.index
+
+    def __len__(self):
+        return len(self._store.index)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self._store.transaction(i) for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("transaction index out of range")
+        return self._store.transaction(position)
+
+    def __iter__(self):
+        transaction = self._store.transaction
+        for position in range(len(self)):
+            yield transaction(position)
+
+    def find(self, guid):
+        position = self._store.index.position(guid)
+        if position is not None:
+            return self._store.transaction(position)
+
+    def __repr__(self):
+        return "<lazy transactions ({})>".format(len(self))
+
+
+class _LazySplits(Sequence):
+    """The splits of an account in a lazily loaded book, decoded on access."""
+
+    def __init__(self, store, account):
+        self._store = store
+        self._account = account
+        self._where = None
+
+    def __len__(self):
+        return self._store.splitcounts.get(self._account.guid, 0)
+
+    def _locate(self):
+        # (transaction position, split offset) of every split, taken from
+        # the index on first indexed access so lookups need not scan.
+        where = self._where
+        if where is None:
+            guid = self._account.guid
+            accounts = self._store.index.accounts
+            where = []
+            for position in self._store.positions.get(guid, ()):
+                where.extend((position, offset) for offset, split_account
+                             in enumerate(accounts[position]) if split_account == guid)
+            self._where = where
+        return where
+
+    def __iter__(self):
+        transaction = self._store.transaction
+        account = self._account
+        for position in self._store.positions.get(account.guid, ()):
+            for split in transaction(position).splits:
+                if split.account is account:
+                    yield split
+
+    def __getitem__(self, position):
+        where = self._locate()
+        if isinstance(position, slice):
+            transaction = self._store.transaction
+            return [transaction(p).splits[offset] for p, offset in where[position]]
+        try:
+            position, offset = where[position]
+        except IndexError:
+            raise IndexError("split index out of range")
+        return self._store.transaction(position).splits[offset]
+
+    def __repr__(self):
+        return "<lazy splits of {!r} ({})>".format(self._account, len(self))
+
+
+def _transaction_spans(data, templates):
+    # Yields (start, end) of every book-level <gnc:transaction> element,
+    # skipping the template transactions of scheduled transactions.
+    find = data.find
+    start = find(_TRANSACTION_START)
+    while start != -1:
+        for t_start, t_end in templates:
+            if t_start < start < t_end:
+                start = find(_TRANSACTION_START, t_end)
+                break
+        else:
+            end = find(_TRANSACTION_END, start)
+            if end == -1:
+                raise ValueError("File stream was not a valid GNU Cash v2 XML file")
+            end += len(_TRANSACTION_END)
+            yield start, end
+            start = find(_TRANSACTION_START, end)
+
+
+def _parse_lazy(source, ctx, cache_size, backend='etree'):
+    stats = ctx.stats
+    if stats is not None:
+        stats._begin()
+    data = source.data()
+    root = _ROOT_TAG_RE.search(data)
+    if root is None or not all(ns in root.group(0) for ns in _LAZY_NAMESPACES):
+        # Not written the way GNU Cash writes files; load it eagerly.
+        return _parse(_BufferSource(data), ctx, backend)
+    root_tag = root.group(0)
+
+    index = TransactionIndex()
+    gaps = []
+    templates = [m.span() for m in _TEMPLATES_RE.finditer(data)]
+    with ctx.section('index'):
+        previous = 0
+        for start, end in ctx.iterate(_transaction_spans(data, templates)):
+            guid = _TRN_ID_RE.search(data, start, end)
+            date = _TRN_DATE_RE.search(data, start, end)
+            if guid is None or date is None:
+                raise ValueError("File stream was not a valid GNU Cash v2 XML file")
+            index.guids.append(guid.group(1).decode('ascii'))
+            index.dates.append(date.group(1).decode('ascii'))
+            index.accounts.append(tuple(ctx.intern(account_guid.decode('ascii')) for account_guid
+                                        in _SPLIT_ACCOUNT_RE.findall(data, start, end)))
+            index.starts.append(start)
+            index.ends.append(end)
+            if start > previous:
+                gaps.append(data[previous:start])
+            previous = end
+        gaps.append(data[previous:])
+    if stats is not None:
+        stats.counts['index'] = len(index)
+
+    # Everything but the transactions is loaded as usual.
+    ctx.register_splits = False
+    ctx.lazy = {}
+    book = _parse(_BufferSource(b''.join(gaps)), ctx, backend)
+    del gaps
+
+    accountdict, commoditydict = ctx.lazy['accountdict'], ctx.lazy['commoditydict']
+    report = book.verification
+    if report is not None:
+        # Transactions were not parsed; check what the index knows.
+        report.balance_checked = False
+        if 'transaction' in report.counts:
+            report.counts['transaction'] = (report.counts['transaction'][0], len(index))
+        for guid, account_guids in zip(index.guids, index.accounts):
+            for account_guid in account_guids:
+                if account_guid not in accountdict:
+                    report.unresolved.append((guid, None, account_guid))
+    store = _LazyStore(data, root_tag, index, accountdict, commoditydict, ctx, cache_size)
+    for account in accountdict.values():
+        account.splits = _LazySplits(store, account)
+    book.transactions = _LazyTransactions(store)
+    ctx.lazy = None
+    return book
+
+
+##################################################################
+# Verification
+
+class VerificationReport(object):
+    """
+    The result of the checks done while loading with verify=True.
+
+    counts maps every gnc:count-data type declared in the file to a
+    (declared, parsed) tuple. unbalanced lists (transaction GUID,
+    imbalance) for transactions whose split values, taken exactly as
+    stored in the file, do not sum to zero. unresolved lists
+    (transaction GUID, split GUID, account GUID) for splits whose
+    account does not exist; those splits are not part of the book.
+
+    Lazily loaded books do not decode their transactions while loading,
+    so balance_checked is False for them, and the split GUIDs in
+    unresolved are None.
+    """
+
+    def __init__(self):
+        self.counts = collections.OrderedDict()
+        self.unbalanced = []
+        self.unresolved = []
+        self.balance_checked = True
+
+    def __repr__(self):
+        return "<VerificationReport {}>".format("ok" if self.ok else "with errors")
+
+    def __str__(self):
+        lines = []
+        for cdtype, declared, parsed in self.count_mismatches:
+            lines.append("{} declared {}, parsed {}".format(cdtype, declared, parsed))
+        for guid, imbalance in self.unbalanced:
+            lines.append("transaction {} does not balance, off by {}".format(guid, imbalance))
+        for guid, split_guid, account_guid in self.unresolved:
+            lines.append("transaction {} refers to unknown account {}".format(guid, account_guid))
+        if not self.balance_checked:
+            lines.append("transaction balances not checked")
+        return '\n'.join(lines) or "ok"
+
+    @property
+    def count_mismatches(self):
+        """List of (type, declared, parsed) for the counts that differ."""
+        return [(cdtype, declared, parsed)
+                for cdtype, (declared, parsed) in self.counts.items()
+                if declared != parsed]
+
+    @property
+    def ok(self):
+        return not (self.count_mismatches or self.unbalanced or self.unresolved)
+
+    def _check_counts(self, tree, parsed):
+        gnc = '{http://www.gnucash.org/XML/gnc}'
+        for elt in tree.findall(gnc + 'count-data'):
+            cdtype = elt.get('{http://www.gnucash.org/XML/cd}type')
+            count = parsed.get(cdtype)
+            if count is None:
+                # not parsed by this library; count the elements
+                count = len(tree.findall(gnc + cdtype.split(':')[-1]))
+            self.counts[cdtype] = (int(elt.text), count)
+
+    def _check_transaction(self, tree, transaction):
+        trn = '{http://www.gnucash.org/XML/trn}'
+        values = tree.findall(trn + 'splits/' + trn + 'split/{http://www.gnucash.org/XML/split}value')
+        self._check_amounts([value.text for value in values], transaction)
+
+    def _check_amounts(self, values, transaction):
+        # values are the raw "num/denom" strings of the splits
+        amounts = [value.split('/') for value in values]
+        denominators = set(denom for num, denom in amounts)
+        if len(denominators) == 1:
+            # the usual case: all splits in the currency's smallest unit
+            total = fractions.Fraction(sum(int(num) for num, denom in amounts),
+                                       int(denominators.pop()))
+        else:
+            total = sum(fractions.Fraction(int(num), int(denom)) for num, denom in amounts)
+        if total:
+            self.unbalanced.append((transaction.guid,
+                                    decimal.Decimal(total.numerator) / total.denominator))
+
+
+##################################################################
+# Forecasting
+
+def _template_splits(schedxaction, accountdict):
+    # (account, amount, description, memo) for every template split
+    result = []
+    for trn in schedxaction.transactions:
+        for split in trn.splits:
+            data = (split.slots or {}).get('sched-xaction') or {}
+            account = accountdict.get(data.get('account'))
+            debit = data.get('debit-numeric')
+            credit = data.get('credit-numeric')
+            if debit is None and credit is None:
+                debit = _formula_amount(data.get('debit-formula'))
+                credit = _formula_amount(data.get('credit-formula'))
+            if debit is None and credit is None:
+                amount = None
+            else:
+                amount = (debit or 0) - (credit or 0)
+            result.append((account, amount, trn.description, split.memo))
+    return result
+
+
+def _formula_amount(formula):
+    if not formula:
+        return None
+    try:
+        return decimal.Decimal(formula.replace(',', ''))
+    except decimal.InvalidOperation:
+        return None
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _occurrences(schedxaction, order, splits, start, end):
+    for date in schedxaction.dates(start, end):
+        yield date, order, schedxaction, splits
+
+
+def _forecast(book, start, end):
+    start = _as_date(start)
+    end = _as_date(end)
+    accountdict = dict((account.guid, account) for account in book.accounts)
+    streams = []
+    for order, schedxaction in enumerate(book.schedxactions):
+        splits = _template_splits(schedxaction, accountdict)
+        if splits:
+            streams.append(_occurrences(schedxaction, order, splits, start, end))
+    for date, order, schedxaction, splits in heapq.merge(*streams):
+        for account, amount, description, memo in splits:
+            yield ForecastSplit(date, schedxaction, account, amount, description, memo)
+
+
+def _forecast_columns(book, start, end):
+    columns = collections.OrderedDict((name, []) for name in ForecastSplit.__slots__)
+    date_column = columns['date']
+    sx_column = columns['schedxaction']
+    account_column = columns['account']
+    amount_column = columns['amount']
+    description_column = columns['description']
+    memo_column = columns['memo']
+    start = _as_date(start)
+    end = _as_date(end)
+    accountdict = dict((account.guid, account) for account in book.accounts)
+    for schedxaction in book.schedxactions:
+        splits = _template_splits(schedxaction, accountdict)
+        if not splits:
+            continue
+        dates = list(schedxaction.dates(start, end))
+        for account, amount, description, memo in splits:
+            date_column.extend(dates)
+            count = len(dates)
+            sx_column.extend([schedxaction] * count)
+            account_column.extend([account] * count)
+            amount_column.extend([amount] * count)
+            description_column.extend([description] * count)
+            memo_column.extend([memo] * count)
+    return columns
+
+
+##################################################################
+# Cost basis
+
+class LotGain(object):
+    """
+    One position of a CostBasisReport: the shares bought (or sold short)
+    by one split, and what happened to them up to the as-of date.
+
+    quantity and cost are what the split opened, remaining and
+    remaining_cost what is still held. realized is the gain of the part
+    that was closed, unrealized the gain of the remainder at the price
+    of the as-of date (None without a price). lot is the GNU Cash Lot of
+    the opening split, if any.
+    """
+
+    __slots__ = ('split', 'lot', 'date', 'quantity', 'cost', 'remaining',
+                 'remaining_cost', 'realized', 'unrealized')
+
+    def __init__(self, split, lot, date, quantity, cost, remaining, remaining_cost,
+                 realized, unrealized):
+        self.split = split
+        self.lot = lot
+        self.date = date
+        self.quantity = quantity
+        self.cost = cost
+        self.remaining = remaining
+        self.remaining_cost = remaining_cost
+        self.realized = realized
+        self.unrealized = unrealized
+
+    def __repr__(self):
+        return "<LotGain {} {} of {}: realized {} unrealized {}>".format(
+            self.date, self.remaining, self.quantity, self.realized, self.unrealized)
+
+
+class CostBasisReport(object):
+    """
+    Holdings and gains of an account as of a date, see CostBasis.report().
+
+    lots lists a LotGain per position, in the order they were opened.
+    quantity, cost, realized and unrealized are the totals; price is the
+    price used for the unrealized gains, or None if there is none.
+    """
+
+    def __init__(self, account, method, as_of, price, lots):
+        zero = decimal.Decimal(0)
+        self.account = account
+        self.method = method
+        self.as_of = as_of
+        self.price = price
+        self.lots = lots
+        self.quantity = sum((lot.remaining for lot in lots), zero)
+        self.cost = sum((lot.remaining_cost for lot in lots), zero)
+        self.realized = sum((lot.realized for lot in lots), zero)
+        if price is None:
+            self.unrealized = None
+        else:
+            self.unrealized = sum((lot.unrealized for lot in lots), zero)
+
+    def __repr__(self):
+        return "<CostBasisReport {} {} as of {}: {} held, realized {}, unrealized {}>".format(
+            self.account.name, self.method, self.as_of, self.quantity,
+            self.realized, self.unrealized)
+
+
+class _BasisState(object):
+    # Everything the engine needs to continue after a given split: the
+    # open positions as [position, quantity, cost], their total quantity
+    # and the realized gain of every position opened so far.
+
+    __slots__ = ('open', 'holding', 'realized', 'index')
+
+    def __init__(self):
+        self.open = collections.deque()
+        self.holding = 0
+        self.realized = []
+        self.index = 0
+
+    def copy(self):
+        state = _BasisState()
+        state.open = collections.deque([list(entry) for entry in self.open])
+        state.holding = self.holding
+        state.realized = list(self.realized)
+        state.index = self.index
+        return state
+
+
+class CostBasis(object):
+    """
+    Cost basis engine for the splits of one account.
+
+    method is "fifo", "lifo" or "average". Splits are taken in date
+    order; a split with a quantity of the same sign as the current
+    holding opens a new position, one with the opposite sign closes
+    positions (first or last opened, or all of them proportionally for
+    average cost) and realizes the difference between its value and their
+    cost. Splits with a zero quantity, such as GNU Cash's own realized
+    gain splits, are ignored.
+
+    Every split is processed once. The state is saved every checkpoint
+    splits, so a report for another as-of date replays only the splits
+    after the nearest saved state. prices (e.g. book.prices) provide the
+    price for unrealized gains.
+    """
+
+    def __init__(self, account, method='fifo', prices=None, checkpoint=256):
+        if method not in ('fifo', 'lifo', 'average'):
+            raise ValueError("Unknown cost basis method {}".format(method))
+        self.account = account
+        self.method = method
+        self.checkpoint = checkpoint
+        self._splits = sorted((split for split in account.splits if split.quantity),
+                              key=lambda split: split.transaction.date)
+        self._dates = [split.transaction.date.date() for split in self._splits]
+        self._positions = []
+        self._states = [_BasisState()]
+        self._prices = self._price_list(prices or ())
+        # what the engine was built from, see Book.cost_basis()
+        self._sizes = (len(account.splits), len(prices or ()))
+
+    def __repr__(self):
+        return "<CostBasis {} {}>".format(self.account.name, self.method)
+
+    def _price_list(self, prices):
+        currencies = set(split.transaction.currency for split in self._splits)
+        result = sorted((price.date.date(), price.value) for price in prices
+                        if price.commodity is self.account.commodity
+                        and (not currencies or price.currency in currencies))
+        return [date for date, value in result], [value for date, value in result]
+
+    def price(self, as_of):
+        """Return the last known price on or before as_of, or None."""
+        dates, values = self._prices
+        position = bisect.bisect_right(dates, as_of)
+        return values[position - 1] if position else None
+
+    def report(self, as_of=None):
+        """Return a CostBasisReport as of the date as_of (default: all splits)."""
+        as_of = _as_date(as_of)
+        if as_of is None:
+            end = len(self._splits)
+        else:
+            end = bisect.bisect_right(self._dates, as_of)
+        state = self._state(end)
+        price = self.price(as_of) if as_of is not None else (
+            self._prices[1][-1] if self._prices[1] else None)
+
+        held = dict((entry[0], entry) for entry in state.open)
+        zero = decimal.Decimal(0)
+        lots = []
+        for position, realized in enumerate(state.realized):
+            split, quantity, cost = self._positions[position]
+            entry = held.get(position)
+            remaining, remaining_cost = (entry[1], entry[2]) if entry else (zero, zero)
+            unrealized = None
+            if price is not None:
+                unrealized = remaining * price - remaining_cost
+            lots.append(LotGain(split, split.lot, split.transaction.date, quantity, cost,
+                                remaining, remaining_cost, realized, unrealized))
+        return CostBasisReport(self.account, self.method, as_of, price, lots)
+
+    def _state(self, end):
+        # The state after the first end splits, continuing from the
+        # nearest saved state and saving new ones on the way.
+        states = self._states
+        checkpoint = self.checkpoint
+        position = min(end // checkpoint, len(states) - 1)
+        state = states[position].copy()
+        while state.index < end:
+            self._apply(state, self._splits[state.index])
+            state.index += 1
+            if state.index % checkpoint == 0 and state.index // checkpoint == len(states):
+                states.append(state.copy())
+        return state
+
+    def _apply(self, state, split):
+        quantity = split.quantity
+        value = split.value
+        holding = state.holding
+        state.holding += quantity
+        if holding and (holding > 0) != (quantity > 0):
+            quantity, value = self._close(state, quantity, value, holding)
+        if quantity:
+            position = len(state.realized)
+            if position == len(self._positions):
+                self._positions.append((split, quantity, value))
+            state.open.append([position, quantity, value])
+            state.realized.append(decimal.Decimal(0))
+
+    def _close(self, state, quantity, value, holding):
+        # Returns the quantity and value left over after closing positions.
+        # Whole positions and the last part of the split are taken as they
+        # are, so that only partial closes divide.
+        open_ = state.open
+        realized = state.realized
+        remaining = abs(quantity)
+        proceeds = -value
+        if self.method == 'average':
+            taken = min(remaining, abs(holding))
+            share = proceeds if taken == remaining else proceeds * taken / remaining
+            ratio = taken / abs(holding)
+            for entry in open_:
+                cost = entry[2] if taken == abs(holding) else entry[2] * ratio
+                realized[entry[0]] += share * entry[1] / holding - cost
+                entry[1] = 0 if taken == abs(holding) else entry[1] - entry[1] * ratio
+                entry[2] -= cost
+            if taken == abs(holding):
+                open_.clear()
+            remaining -= taken
+            proceeds -= share
+        else:
+            fifo = self.method == 'fifo'
+            while remaining and open_:
+                entry = open_[0] if fifo else open_[-1]
+                size = abs(entry[1])
+                taken = min(remaining, size)
+                share = proceeds if taken == remaining else proceeds * taken / remaining
+                if taken == size:
+                    cost = entry[2]
+                    if fifo:
+                        open_.popleft()
+                    else:
+                        open_.pop()
+                else:
+                    cost = entry[2] * taken / size
+                    entry[1] += taken if entry[1] < 0 else -taken
+                    entry[2] -= cost
+                realized[entry[0]] += share - cost
+                remaining -= taken
+                proceeds -= share
+        if not remaining:
+            return 0, 0
+        # closed everything and reversed direction
+        return (remaining if quantity > 0 else -remaining), -proceeds
+
+
+##################################################################
+# Budgets
+
+class BudgetLine(object):
+    """
+    The row of one account in a BudgetReport. budgeted and actual are
+    lists with the amount of every period for the account including its
+    subaccounts; budgeted is None for periods without a budget.
+    """
+
+    __slots__ = ('account', 'budgeted', 'actual')
+
+    def __init__(self, account, budgeted, actual):
+        self.account = account
+        self.budgeted = budgeted
+        self.actual = actual
+
+    def __repr__(self):
+        return "<BudgetLine {} {} {}>".format(self.account.fullname(), self.budgeted, self.actual)
+
+    @property
+    def variance(self):
+        """Actual minus budgeted per period, None without a budget."""
+        return [None if budgeted is None else actual - budgeted
+                for budgeted, actual in zip(self.budgeted, self.actual)]
+
+
+class BudgetReport(object):
+    """
+    Budgeted against actual amounts of a book, from Book.budget_vs_actual().
+
+    periods are the (start, end) dates of the budget periods. Iterating
+    gives a BudgetLine per account, in the order of book.accounts;
+    report[account] (or its GUID) the line of one account.
+
+    GNU Cash rules apply to parent accounts: their own budget for a
+    period if they have one, otherwise the sum of their subaccounts'.
+    Amounts are added up without converting between commodities.
+    """
+
+    def __init__(self, budget, periods, lines):
+        self.budget = budget
+        self.periods = periods
+        self.lines = lines
+
+    def __repr__(self):
+        return "<BudgetReport '{}' {} accounts, {} periods>".format(
+            self.budget.name, len(self.lines), len(self.periods))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def __getitem__(self, account):
+        return self.lines[getattr(account, 'guid', account)]
+
+
+def _budget_vs_actual(book, budget, field):
+    periods = budget.periods
+    count = len(periods)
+    starts = [start.toordinal() for start, end in periods]
+    first = starts[0] if periods else 0
+    last = periods[-1][1].toordinal() if periods else 0
+    accounts = book.accounts
+    numbers = dict((account.guid, number) for number, account in enumerate(accounts))
+
+    # a single pass over the transactions, each split is added to its
+    # own account's period total; subaccounts are added in afterwards
+    zero = Money(0) if book.exact else decimal.Decimal(0)
+    actual = [[zero] * count for account in accounts]
+    amount = operator.attrgetter(field)
+    for trn in book.transactions:
+        day = trn.date.date().toordinal()
+        if first <= day < last:
+            period = bisect.bisect_right(starts, day) - 1
+            for split in trn.splits:
+                actual[numbers[split.account.guid]][period] += amount(split)
+
+    parents = [numbers.get(account.parent.guid, -1) if account.parent is not None else -1
+               for account in accounts]
+    depths = []
+    for number in range(len(accounts)):
+        depth = 0
+        parent = parents[number]
+        while parent >= 0:
+            depth += 1
+            parent = parents[parent]
+        depths.append(depth)
+
+    # amounts may be shorter than num_periods if that was changed later
+    none = [None] * count
+    budgeted = [(list(budget.amounts.get(account.guid, ())) + none)[:count]
+                for account in accounts]
+    children = [[None] * count for account in accounts]
+    # deepest accounts first, so subaccounts are complete before their parents
+    for number in sorted(range(len(accounts)), key=depths.__getitem__, reverse=True):
+        own = budgeted[number]
+        below = children[number]
+        for period in range(count):
+            if own[period] is None:
+                own[period] = below[period]
+        parent = parents[number]
+        if parent >= 0:
+            rows = actual[parent]
+            above = children[parent]
+            for period, value in enumerate(actual[number]):
+                rows[period] += value
+            for period, value in enumerate(own):
+                if value is not None:
+                    above[period] = value if above[period] is None else above[period] + value
+
+    lines = collections.OrderedDict()
+    for number, account in enumerate(accounts):
+        lines[account.guid] = BudgetLine(account, budgeted[number], actual[number])
+    return BudgetReport(budget, periods, lines)
+
+
+##################################################################
+# XML file writing
+
+# The namespaces GNU Cash declares in its files
+_NAMESPACES = ("gnc", "act", "book", "cd", "cmdty", "price", "slot", "split",
+               "sx", "trn", "ts", "fs", "bgt", "recurrence", "lot", "addr",
+               "billterm", "bt-days", "bt-prox", "cust", "employee", "entry",
+               "invoice", "job", "order", "owner", "taxtable", "tte", "vendor")
+_NAMESPACE_URI = 'http://www.gnucash.org/XML/'
+_GUID_RE = re.compile(r'[0-9a-f]{32}\Z')
+# Output is collected in this many pieces before it is written out.
+_WRITE_PARTS = 4096
+
+
+def _escape(text):
+    # xml.sax.saxutils.escape, which takes long to import
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _qualified(name):
+    # "act:name" to ElementTree's "{http://www.gnucash.org/XML/act}name"
+    prefix, _, local = name.partition(':')
+    return '{' + _NAMESPACE_URI + prefix + '}' + local
+
+
+def _prefixed(tag):
+    # The reverse of _qualified. Elements of other namespaces cannot be
+    # written with the prefixes declared by write().
+    if not tag.startswith('{'):
+        return tag
+    namespace, _, local = tag[1:].partition('}')
+    prefix = namespace[len(_NAMESPACE_URI):]
+    if not namespace.startswith(_NAMESPACE_URI) or prefix not in _NAMESPACES:
+        raise ValueError("Cannot write element {} of namespace {}".format(local, namespace))
+    return prefix + ':' + local
+
+
+def to_filename(book, filename, compress=True):
+    """
+    Write a Book as a GNU Cash XML file, gzip compressed unless compress=False.
+
+    See write() for what is written.
+    """
+    if compress:
+        import gzip
+        fobj = gzip.open(filename, "wb", compresslevel=6)
+    else:
+        fobj = open(filename, "wb")
+    with fobj:
+        write(book, fobj)
+
+
+def write(book, fobj):
+    """
+    Write a Book as gnc-v2 XML to the binary file object fobj.
+
+    The XML is generated element by element and written out in pieces, so
+    memory use does not grow with the size of the book. The count-data
+    elements are regenerated from the book.
+
+    The fields the parser reads are written from the objects of the book,
+    so changes to them are saved. Everything else of the file the book
+    was loaded from is written back unchanged: the elements the parser
+    skips (such as price sources, invoice terms and currencies and the
+    autoCreate flags of scheduled transactions), the types of the slots,
+    and the book-level elements that have no objects in a Book, such as
+    bill terms, jobs and customers no invoice refers to. Amounts and
+    dates keep their text while they have the value read from it; a
+    changed amount of a book loaded without exact=True is rounded to
+    cents. Books loaded with backend="expat" do not keep elements of
+    transactions the parser skips, so write() warns when there were any.
+
+    New slots get their type from the Python value: int as integer,
+    float as double, Decimal and Money as numeric, naive datetimes at
+    midnight and dates as gdate, other datetimes as timespec, mappings as
+    frame and strings (and None) as string.
+    """
+    if book._skipped:
+        warnings.warn("{} elements of transactions were not kept by the expat backend "
+                      "and are not written".format(book._skipped), stacklevel=2)
+    w = _XMLWriter(fobj)
+    originals = _Originals(book)
+
+    customers = collections.OrderedDict()
+    vendors = collections.OrderedDict()
+    taxtables = collections.OrderedDict()
+    entries = collections.OrderedDict()
+    for invoice in book.invoices:
+        if invoice.customer is not None:
+            customers.setdefault(invoice.customer.guid, invoice.customer)
+        if invoice.vendor is not None:
+            vendors.setdefault(invoice.vendor.guid, invoice.vendor)
+        for entry in invoice.entries or ():
+            entries[entry.guid] = (entry, invoice)
+            if entry.taxtable is not None:
+                taxtables.setdefault(entry.taxtable.guid, entry.taxtable)
+
+    # The business objects with their original elements, in file order.
+    # Customers, vendors and tax tables are only objects of the book when
+    # an invoice uses them, entries when they belong to an invoice; the
+    # others are written as they were. Invoices removed from the book,
+    # and their entries, are not written.
+    invoice_guids = originals.guids('GncInvoice')
+    business = {
+        'GncCustomer': (_write_customer, _in_file_order(
+            customers, originals.business('GncCustomer'), lambda element: True)),
+        'GncEntry': (_write_entry, _in_file_order(
+            entries, originals.business('GncEntry'),
+            lambda element: _child_text(element, 'entry:invoice') not in invoice_guids)),
+        'GncInvoice': (_write_invoice, _in_file_order(
+            collections.OrderedDict((invoice.guid, invoice) for invoice in book.invoices),
+            originals.business('GncInvoice'), lambda element: False)),
+        'GncTaxTable': (_write_taxtable, _in_file_order(
+            taxtables, originals.business('GncTaxTable'), lambda element: True)),
+        'GncVendor': (_write_vendor, _in_file_order(
+            vendors, originals.business('GncVendor'), lambda element: True)),
+    }
+    others = []
+    for element in originals.other:
+        kind = element.tag.rpartition('}')[2]
+        if kind.startswith('Gnc'):
+            business.setdefault(kind, (None, []))[1].append((None, element))
+        else:
+            others.append(element)
+
+    accounts = list(book.accounts)
+    if book.root_account is not None:
+        accounts.insert(0, book.root_account)
+
+    counts = collections.OrderedDict((cdtype, None) for cdtype in originals.counts)
+    counts.update((
+        ("commodity", len(book.commodities)),
+        ("account", len(accounts)),
+        ("transaction", len(book.transactions)),
+        ("schedxaction", len(book.schedxactions)),
+        ("budget", len(book.budgets))))
+    counts.update(('gnc:' + kind, len(business[kind][1])) for kind in sorted(business))
+    counts["price"] = len(book.prices or ())
+    for cdtype, element in originals.counts.items():
+        if counts[cdtype] is None:
+            # of elements the writer knows nothing of
+            counts[cdtype] = element.text
+
+    w('<?xml version="1.0" encoding="utf-8" ?>\n<gnc-v2\n')
+    w('\n'.join('     xmlns:{0}="{1}{0}"'.format(ns, _NAMESPACE_URI) for ns in _NAMESPACES))
+    w('>\n<gnc:count-data cd:type="book">1</gnc:count-data>\n'
+      '<gnc:book version="2.0.0">\n'
+      '<book:id type="guid">{}</book:id>\n'.format(book.guid))
+    _write_slots(w, 'book:slots', book.slots, '', originals.slots)
+    for cdtype, count in counts.items():
+        if count:
+            w('<gnc:count-data cd:type="{}">{}</gnc:count-data>\n'.format(cdtype, count))
+
+    for commodity in book.commodities:
+        _write_merged(w, 'gnc:commodity', ' version="2.0.0"', [
+            ('cmdty:space', '  <cmdty:space>{}</cmdty:space>\n'.format(_escape(commodity.space))),
+            ('cmdty:id', '  <cmdty:id>{}</cmdty:id>\n'.format(_escape(commodity.name))),
+        ], originals.get((commodity.space, commodity.name)), '')
+
+    if book.prices:
+        w('<gnc:pricedb version="1">\n')
+        for price in book.prices:
+            original = originals.get(price.guid)
+            _write_merged(w, 'price', '', [
+                ('price:id', '  <price:id type="guid">{}</price:id>\n'.format(price.guid)),
+                ('price:commodity', _commodity_xml('price:commodity', price.commodity)),
+                ('price:currency', _commodity_xml('price:currency', price.currency)),
+                ('price:time', _date_xml('price:time', price.date, original)),
+                ('price:value', '  <price:value>{}</price:value>\n'.format(
+                    _number_text(price.value, _child(original, 'price:value')))),
+            ], original, '')
+        w('</gnc:pricedb>\n')
+
+    for account in accounts:
+        _write_account(w, account, originals.get(account.guid))
+
+    for trn in book.transactions:
+        _write_transaction(w, trn, originals.transaction(trn.guid))
+
+    _write_schedxactions(w, book.schedxactions, originals)
+
+    for budget in book.budgets:
+        _write_budget(w, budget, originals.get(budget.guid))
+
+    for element in others:
+        w(_element_xml(element) + '\n')
+
+    # the kinds of business objects in the order of the file, new ones
+    # in the order GNU Cash writes them
+    kinds = [kind for kind in originals.kinds if kind in business]
+    kinds.extend(sorted(kind for kind in business if kind not in originals.kinds))
+    for kind in kinds:
+        write_object, items = business[kind]
+        for obj, original in items:
+            if obj is None:
+                w(_element_xml(original) + '\n')
+            else:
+                write_object(w, obj, original)
+
+    w('</gnc:book>\n</gnc-v2>\n')
+    w.flush()
+
+
+class _Originals(object):
+    # The elements of the file a book was loaded from (book.tree), for
+    # write() to keep what the parser does not read. Objects are found
+    # by GUID, commodities by (space, id). Book-level elements that are
+    # not written from the objects of a Book are listed in other.
+
+    # Book-level elements written from the objects of a Book
+    written = frozenset(_qualified(name) for name in (
+        'book:id', 'book:slots', 'gnc:count-data', 'gnc:commodity', 'gnc:pricedb',
+        'gnc:account', 'gnc:transaction', 'gnc:template-transactions',
+        'gnc:schedxaction', 'gnc:budget', 'gnc:GncCustomer', 'gnc:GncEntry',
+        'gnc:GncInvoice', 'gnc:GncTaxTable', 'gnc:GncVendor'))
+
+    # The GUID element of each kind of object
+    ids = dict((_qualified('gnc:' + kind), _qualified(guid)) for kind, guid in (
+        ('account', 'act:id'), ('transaction', 'trn:id'), ('schedxaction', 'sx:id'),
+        ('budget', 'bgt:id'), ('GncCustomer', 'cust:guid'), ('GncEntry', 'entry:guid'),
+        ('GncInvoice', 'invoice:guid'), ('GncTaxTable', 'taxtable:guid'),
+        ('GncVendor', 'vendor:guid')))
+
+    def __init__(self, book):
+        self.elements = {}
+        self.kinds = collections.OrderedDict()
+        self.other = []
+        self.counts = collections.OrderedDict()
+        self.slots = None
+        self.store = None
+        if isinstance(book.transactions, _LazyTransactions):
+            self.store = book.transactions._store
+        if book.tree is None:
+            return
+        commodity = _qualified('gnc:commodity')
+        pricedb = _qualified('gnc:pricedb')
+        templates = _qualified('gnc:template-transactions')
+        count = _qualified('gnc:count-data')
+        cdtype = _qualified('cd:type')
+        for child in book.tree:
+            tag = child.tag
+            if tag in self.ids:
+                self._add(child)
+            elif tag == commodity:
+                key = (_child_text(child, 'cmdty:space'), _child_text(child, 'cmdty:id'))
+                self.elements[key] = child
+            elif tag == pricedb:
+                for price in child.findall('price'):
+                    self.elements[_child_text(price, 'price:id')] = price
+            elif tag == templates:
+                for element in child:
+                    if element.tag in self.ids:
+                        self._add(element)
+            elif tag == count:
+                self.counts[child.get(cdtype)] = child
+            elif tag == _qualified('book:slots'):
+                self.slots = child
+            elif tag not in self.written and isinstance(tag, str):
+                self.other.append(child)
+                self.kinds.setdefault(tag.rpartition('}')[2], [])
+
+    def _add(self, element):
+        guid = element.findtext(self.ids[element.tag])
+        self.elements[guid] = element
+        self.kinds.setdefault(element.tag.rpartition('}')[2], []).append((guid, element))
+
+    def get(self, key):
+        return self.elements.get(key)
+
+    def transaction(self, guid):
+        # lazily loaded books keep their transactions in the raw data
+        element = self.elements.get(guid)
+        if element is None and self.store is not None:
+            position = self.store.index.position(guid)
+            if position is not None:
+                element = self.store.element(position)
+        return element
+
+    def business(self, kind):
+        # (guid, element) of the book-level elements gnc:<kind>
+        return self.kinds.get(kind, ())
+
+    def guids(self, kind):
+        return frozenset(guid for guid, element in self.business(kind))
+
+
+def _in_file_order(objects, originals, keep):
+    # (object, element) of the objects, a mapping by GUID, and of the
+    # (guid, element) originals in their order, then the new objects.
+    # Elements without an object are left out unless keep(element);
+    # their object is None.
+    objects = collections.OrderedDict(objects)
+    items = []
+    for guid, element in originals:
+        obj = objects.pop(guid, None)
+        if obj is not None or keep(element):
+            items.append((obj, element))
+    items.extend((obj, None) for obj in objects.values())
+    return items
+
+
+def _write_merged(w, tag, attributes, fields, original, indent):
+    # Writes the element tag with the children in fields, a list of
+    # (child tag, XML or None) in GNU Cash order. Children of original
+    # that fields does not name are written back unchanged, in their
+    # place; the named ones are replaced, or left out if their XML is None.
+    w('{}<{}{}>\n'.format(indent, tag, attributes))
+    if original is None:
+        for name, xml in fields:
+            if xml:
+                w(xml)
+        w('{}</{}>\n'.format(indent, tag))
+        return
+    xmls = dict(fields)
+    order = []
+    for child in original:
+        if not isinstance(child.tag, str):
+            continue
+        name = _prefixed(child.tag)
+        if name not in xmls:
+            order.append(child)
+        elif name not in order:
+            order.append(name)
+    # fields the original lacks go after the field before them
+    for position, (name, xml) in enumerate(fields):
+        if xml and name not in order:
+            previous = [n for n, x in fields[:position] if n in order]
+            order.insert(order.index(previous[-1]) + 1 if previous else 0, name)
+    for item in order:
+        if not isinstance(item, str):
+            w('{}  {}\n'.format(indent, _element_xml(item)))
+        elif xmls[item]:
+            w(xmls[item])
+    w('{}</{}>\n'.format(indent, tag))
+
+
+def _write_account(w, account, original):
+    fields = [
+        ('act:name', '  <act:name>{}</act:name>\n'.format(_escape(account.name))),
+        ('act:id', '  <act:id type="guid">{}</act:id>\n'.format(account.guid)),
+        ('act:type', '  <act:type>{}</act:type>\n'.format(account.actype)),
+    ]
+    if account.actype != 'ROOT':
+        # the parser does not read these for root accounts
+        fields.extend([
+            ('act:commodity', _commodity_xml('act:commodity', account.commodity)),
+            ('act:commodity-scu', '  <act:commodity-scu>{}</act:commodity-scu>\n'.format(
+                account.commodity_scu)),
+        ])
+    description = parent = lots = None
+    if account.description is not None:
+        description = '  <act:description>{}</act:description>\n'.format(
+            _escape(account.description))
+    if account.parent is not None:
+        parent = '  <act:parent type="guid">{}</act:parent>\n'.format(account.parent.guid)
+    if account.lots:
+        lot_originals = _children_by_id(_child(original, 'act:lots'), 'lot:id')
+        lots = _Collector()
+        lots('  <act:lots>\n')
+        for lot in account.lots:
+            lot_original = lot_originals.get(lot.guid)
+            _write_merged(lots, 'gnc:lot', ' version="2.0.0"', [
+                ('lot:id', '      <lot:id type="guid">{}</lot:id>\n'.format(lot.guid)),
+                ('lot:slots', _slots_xml('lot:slots', lot.slots, '      ',
+                                         _child(lot_original, 'lot:slots'))),
+            ], lot_original, '    ')
+        lots('  </act:lots>\n')
+        lots = lots.text()
+    fields.extend([
+        ('act:description', description),
+        ('act:slots', _slots_xml('act:slots', account.slots, '  ', _child(original, 'act:slots'))),
+        ('act:parent', parent),
+        ('act:lots', lots),
+    ])
+    _write_merged(w, 'gnc:account', ' version="2.0.0"', fields, original, '')
+
+
+def _write_transaction(w, trn, original):
+    split_originals = _children_by_id(_child(original, 'trn:splits'), 'split:id')
+    splits = _Collector()
+    splits('  <trn:splits>\n')
+    for split in trn.splits:
+        split_original = split_originals.get(split.guid)
+        memo = action = reconcile_date = lot = None
+        if split.memo is not None:
+            memo = '      <split:memo>{}</split:memo>\n'.format(_escape(split.memo))
+        if split.action is not None:
+            action = '      <split:action>{}</split:action>\n'.format(_escape(split.action))
+        if split.reconcile_date is not None:
+            reconcile_date = _date_xml('split:reconcile-date', split.reconcile_date,
+                                       split_original, '      ')
+        if split.lot is not None:
+            lot = '      <split:lot type="guid">{}</split:lot>\n'.format(split.lot.guid)
+        _write_merged(splits, 'trn:split', '', [
+            ('split:id', '      <split:id type="guid">{}</split:id>\n'.format(split.guid)),
+            ('split:memo', memo),
+            ('split:action', action),
+            ('split:reconciled-state',
+             '      <split:reconciled-state>{}</split:reconciled-state>\n'.format(
+                 split.reconciled_state)),
+            ('split:reconcile-date', reconcile_date),
+            ('split:value', '      <split:value>{}</split:value>\n'.format(
+                _number_text(split.value, _child(split_original, 'split:value')))),
+            ('split:quantity', '      <split:quantity>{}</split:quantity>\n'.format(
+                _number_text(split.quantity, _child(split_original, 'split:quantity'),
+                             split.account.commodity_scu and int(split.account.commodity_scu)))),
+            ('split:account', '      <split:account type="guid">{}</split:account>\n'.format(
+                split.account.guid)),
+            ('split:lot', lot),
+            ('split:slots', _slots_xml('split:slots', split.slots, '      ',
+                                       _child(split_original, 'split:slots'))),
+        ], split_original, '    ')
+    splits('  </trn:splits>\n')
+
+    num = None
+    if trn.num is not None:
+        num = '  <trn:num>{}</trn:num>\n'.format(_escape(trn.num))
+    _write_merged(w, 'gnc:transaction', ' version="2.0.0"', [
+        ('trn:id', '  <trn:id type="guid">{}</trn:id>\n'.format(trn.guid)),
+        ('trn:currency', _commodity_xml('trn:currency', trn.currency)),
+        ('trn:num', num),
+        ('trn:date-posted', _date_xml('trn:date-posted', trn.date, original)),
+        ('trn:date-entered', _date_xml('trn:date-entered', trn.date_entered, original)),
+        ('trn:description', '  <trn:description>{}</trn:description>\n'.format(
+            _escape(trn.description or ''))),
+        ('trn:slots', _slots_xml('trn:slots', trn.slots, '  ', _child(original, 'trn:slots'))),
+        ('trn:splits', splits.text()),
+    ], original, '')
+
+
+def _write_schedxactions(w, schedxactions, originals):
+    # The template accounts and transactions, then the schedules
+    templates = [sx.template_account for sx in schedxactions
+                 if sx.template_account is not None]
+    roots = collections.OrderedDict((account.parent.guid, account.parent)
+                                    for account in templates if account.parent is not None)
+    if templates:
+        w('<gnc:template-transactions>\n')
+        for account in itertools.chain(roots.values(), templates):
+            _write_account(w, account, originals.get(account.guid))
+        for sx in schedxactions:
+            for trn in sx.transactions:
+                _write_transaction(w, trn, originals.get(trn.guid))
+        w('</gnc:template-transactions>\n')
+
+    for sx in schedxactions:
+        original = originals.get(sx.guid)
+        fields = [
+            ('sx:id', '  <sx:id type="guid">{}</sx:id>\n'.format(sx.guid)),
+            ('sx:name', '  <sx:name>{}</sx:name>\n'.format(_escape(sx.name or ''))),
+            ('sx:enabled', '  <sx:enabled>{}</sx:enabled>\n'.format(
+                'y' if sx.enabled else 'n')),
+            ('sx:instanceCount', '  <sx:instanceCount>{}</sx:instanceCount>\n'.format(
+                sx.instance_count)),
+            ('sx:start', _gdate_xml('sx:start', sx.start)),
+            ('sx:last', _gdate_xml('sx:last', sx.last)),
+        ]
+        for tag, count in (('num-occur', sx.num_occur), ('rem-occur', sx.rem_occur)):
+            fields.append(('sx:' + tag, None if count is None else
+                           '  <sx:{0}>{1}</sx:{0}>\n'.format(tag, count)))
+        template = None
+        if sx.template_account is not None:
+            template = '  <sx:templ-acct type="guid">{}</sx:templ-acct>\n'.format(
+                sx.template_account.guid)
+        # recurrences have no GUID; they are matched by position
+        recurrence_originals = [child for child in _child(original, 'sx:schedule') or ()
+                                if isinstance(child.tag, str)]
+        schedule = _Collector()
+        schedule('  <sx:schedule>\n')
+        for number, recurrence in enumerate(sx.recurrences):
+            _write_recurrence(schedule, 'gnc:recurrence', recurrence, '    ',
+                              _nth(recurrence_originals, number))
+        schedule('  </sx:schedule>\n')
+        fields.extend([
+            ('sx:end', _gdate_xml('sx:end', sx.end)),
+            ('sx:templ-acct', template),
+            ('sx:schedule', schedule.text()),
+            ('sx:slots', _slots_xml('sx:slots', sx.slots, '  ', _child(original, 'sx:slots'))),
+        ])
+        _write_merged(w, 'gnc:schedxaction', ' version="2.0.0"', fields, original, '')
+
+
+def _write_budget(w, budget, original):
+    description = None
+    if budget.description is not None:
+        description = '  <bgt:description>{}</bgt:description>\n'.format(
+            _escape(budget.description))
+    recurrence = _Collector()
+    _write_recurrence(recurrence, 'bgt:recurrence', budget.recurrence, '  ',
+                      _child(original, 'bgt:recurrence'))
+    # the amounts go back into the slots, a frame per account
+    slots = collections.OrderedDict()
+    for guid, amounts in budget.amounts.items():
+        slots[guid] = collections.OrderedDict(
+            (str(period), amount) for period, amount in enumerate(amounts) if amount is not None)
+    slots.update(budget.slots)
+    _write_merged(w, 'gnc:budget', ' version="2.0.0"', [
+        ('bgt:id', '  <bgt:id type="guid">{}</bgt:id>\n'.format(budget.guid)),
+        ('bgt:name', '  <bgt:name>{}</bgt:name>\n'.format(_escape(budget.name or ''))),
+        ('bgt:description', description),
+        ('bgt:num-periods', '  <bgt:num-periods>{}</bgt:num-periods>\n'.format(
+            budget.num_periods)),
+        ('bgt:recurrence', recurrence.text()),
+        ('bgt:slots', _slots_xml('bgt:slots', slots, '  ', _child(original, 'bgt:slots'))),
+    ], original, '')
+
+
+def _write_recurrence(w, tag, recurrence, indent, original=None):
+    fields = [
+        ('recurrence:mult', '{}  <recurrence:mult>{}</recurrence:mult>\n'.format(
+            indent, recurrence.mult)),
+        ('recurrence:period_type', '{}  <recurrence:period_type>{}</recurrence:period_type>\n'.format(
+            indent, recurrence.period_type)),
+        ('recurrence:start', '{0}  <recurrence:start>\n'
+                             '{0}    <gdate>{1:%Y-%m-%d}</gdate>\n'
+                             '{0}  </recurrence:start>\n'.format(indent, recurrence.start)),
+    ]
+    # a missing weekend_adj reads as "none", which GNU Cash leaves out
+    if recurrence.weekend_adj != (_child_text(original, 'recurrence:weekend_adj') or 'none'):
+        fields.append(('recurrence:weekend_adj', None if recurrence.weekend_adj == 'none' else
+                       '{}  <recurrence:weekend_adj>{}</recurrence:weekend_adj>\n'.format(
+                           indent, recurrence.weekend_adj)))
+    _write_merged(w, tag, ' version="1.0.0"', fields, original, indent)
+
+
+def _write_customer(w, customer, original):
+    fields = [
+        ('cust:guid', '  <cust:guid type="guid">{}</cust:guid>\n'.format(customer.guid)),
+        ('cust:name', '  <cust:name>{}</cust:name>\n'.format(_escape(customer.name))),
+    ]
+    # the address lines are read without their numbers; while they are
+    # unchanged, the address is kept as it was
+    addr_original = _child(original, 'cust:addr')
+    address = list(customer.address or ())
+    lines = [line.text for line in (_child(addr_original, 'addr:addr{}'.format(i))
+                                    for i in range(1, 5)) if line is not None]
+    if addr_original is None or address != lines:
+        addr = _Collector()
+        _write_merged(addr, 'cust:addr', ' version="2.0.0"', [
+            ('addr:addr{}'.format(i), None if i > len(address) else
+             '    <addr:addr{0}>{1}</addr:addr{0}>\n'.format(i, _escape(address[i - 1] or '')))
+            for i in range(1, 5)
+        ], addr_original, '  ')
+        fields.append(('cust:addr', addr.text()))
+    _write_merged(w, 'gnc:GncCustomer', ' version="2.0.0"', fields, original, '')
+
+
+def _write_entry(w, entry_invoice, original):
+    entry, invoice = entry_invoice
+    fields = [('entry:guid', '  <entry:guid type="guid">{}</entry:guid>\n'.format(entry.guid))]
+    for tag, value in (('description', entry.description), ('action', entry.action)):
+        fields.append(('entry:' + tag, None if value is None else
+                       '  <entry:{0}>{1}</entry:{0}>\n'.format(tag, _escape(value))))
+    for tag, value in (('qty', entry.qty), ('i-price', entry.price)):
+        fields.append(('entry:' + tag, None if value is None else
+                       '  <entry:{0}>{1}</entry:{0}>\n'.format(
+                           tag, _number_text(value, _child(original, 'entry:' + tag)))))
+    taxable = taxtable = None
+    if entry.taxtable is not None:
+        taxable = '  <entry:i-taxable>{}</entry:i-taxable>\n'.format(entry.taxable)
+        taxtable = '  <entry:i-taxtable type="guid">{}</entry:i-taxtable>\n'.format(
+            entry.taxtable.guid)
+    fields.extend([
+        ('entry:invoice', '  <entry:invoice type="guid">{}</entry:invoice>\n'.format(
+            invoice.guid)),
+        ('entry:i-taxable', taxable),
+        ('entry:i-taxtable', taxtable),
+    ])
+    _write_merged(w, 'gnc:GncEntry', ' version="2.0.0"', fields, original, '')
+
+
+def _write_invoice(w, invoice, original):
+    fields = [
+        ('invoice:guid', '  <invoice:guid type="guid">{}</invoice:guid>\n'.format(invoice.guid)),
+        ('invoice:id', '  <invoice:id>{}</invoice:id>\n'.format(_escape(invoice.id))),
+    ]
+    # owners other than customers and vendors, such as jobs, are kept
+    if invoice.customer is not None or invoice.vendor is not None:
+        if invoice.customer is not None:
+            owner_type, owner = 'gncCustomer', invoice.customer
+        else:
+            owner_type, owner = 'gncVendor', invoice.vendor
+        fields.append(('invoice:owner', '  <invoice:owner version="2.0.0">\n'
+                                        '    <owner:type>{}</owner:type>\n'
+                                        '    <owner:id type="guid">{}</owner:id>\n'
+                                        '  </invoice:owner>\n'.format(owner_type, owner.guid)))
+    fields.extend([
+        ('invoice:opened', _date_xml('invoice:opened', invoice.date, original)),
+        ('invoice:active', '  <invoice:active>{}</invoice:active>\n'.format(invoice.active)),
+    ])
+    _write_merged(w, 'gnc:GncInvoice', ' version="2.0.0"', fields, original, '')
+
+
+def _write_taxtable(w, taxtable, original):
+    # entries have no GUID; they are matched by position
+    tte_originals = [child for child in _child(original, 'taxtable:entries') or ()
+                     if isinstance(child.tag, str)]
+    entries = _Collector()
+    entries('  <taxtable:entries>\n')
+    for number, tte in enumerate(taxtable.taxtable_entries or ()):
+        tte_original = _nth(tte_originals, number)
+        _write_merged(entries, 'gnc:GncTaxTableEntry', '', [
+            ('tte:amount', '      <tte:amount>{}</tte:amount>\n'.format(
+                _number_text(tte.amount, _child(tte_original, 'tte:amount')))),
+            ('tte:type', '      <tte:type>{}</tte:type>\n'.format(tte.ttetype)),
+        ], tte_original, '    ')
+    entries('  </taxtable:entries>\n')
+    _write_merged(w, 'gnc:GncTaxTable', ' version="2.0.0"', [
+        ('taxtable:guid', '  <taxtable:guid type="guid">{}</taxtable:guid>\n'.format(
+            taxtable.guid)),
+        ('taxtable:name', '  <taxtable:name>{}</taxtable:name>\n'.format(
+            _escape(taxtable.name))),
+        ('taxtable:entries', entries.text()),
+    ], original, '')
+
+
+def _write_vendor(w, vendor, original):
+    _write_merged(w, 'gnc:GncVendor', ' version="2.0.0"', [
+        ('vendor:guid', '  <vendor:guid type="guid">{}</vendor:guid>\n'.format(vendor.guid)),
+        ('vendor:name', '  <vendor:name>{}</vendor:name>\n'.format(_escape(vendor.name))),
+    ], original, '')
+
+
+class _XMLWriter(object):
+    # Collects output text and writes it to fobj as UTF-8 in large pieces.
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.parts = []
+
+    def __call__(self, text):
+        self.parts.append(text)
+        if len(self.parts) >= _WRITE_PARTS:
+            self.flush()
+
+    def flush(self):
+        self.fobj.write(''.join(self.parts).encode('utf-8'))
+        self.parts = []
+
+
+class _Collector(object):
+    # Collects the XML of a child element for _write_merged().
+
+    def __init__(self):
+        self.parts = []
+
+    def __call__(self, text):
+        self.parts.append(text)
+
+    def text(self):
+        return ''.join(self.parts)
+
+
+def _child(element, name):
+    if element is None:
+        return None
+    return element.find(_qualified(name))
+
+
+def _child_text(element, path):
+    # path is "prefix:tag", or several of them separated by "/"
+    if element is None:
+        return None
+    return element.findtext('/'.join(_qualified(name) for name in path.split('/')))
+
+
+def _nth(elements, number):
+    return elements[number] if number < len(elements) else None
+
+
+def _children_by_id(element, name):
+    # The children of element by the text of their child name
+    if element is None:
+        return {}
+    tag = _qualified(name)
+    return dict((child.findtext(tag), child) for child in element
+                if isinstance(child.tag, str))
+
+
+def _element_xml(element):
+    # An element of the original file as XML, with the prefixes of write()
+    parts = []
+    _element_parts(element, parts)
+    return ''.join(parts)
+
+
+def _element_parts(element, parts):
+    tag = _prefixed(element.tag)
+    parts.append('<' + tag)
+    for name, value in element.attrib.items():
+        parts.append(' {}="{}"'.format(_prefixed(name), _escape(value).replace('"', '&quot;')))
+    if not element.text and not len(element):
+        parts.append('/>')
+        return
+    parts.append('>')
+    if element.text:
+        parts.append(_escape(element.text))
+    for child in element:
+        # lxml also has comments and processing instructions
+        if isinstance(child.tag, str):
+            _element_parts(child, parts)
+        if child.tail:
+            parts.append(_escape(child.tail))
+    parts.append('</' + tag + '>')
+
+
+def _format_number(value, scale=None):
+    # GNU Cash stores numbers as exact fractions; amounts are in units of
+    # 1/scale, the smallest unit of their commodity, when that is exact
+    if isinstance(value, Money):
+        return "{}/{}".format(value.units, value.scale)
+    value = decimal.Decimal(value)
+    if scale:
+        units = value * scale
+        if units == units.to_integral_value():
+            return "{}/{}".format(int(units), scale)
+    exponent = value.as_tuple().exponent
+    if exponent >= 0:
+        return "{}/1".format(int(value))
+    return "{}/{}".format(int(value.scaleb(-exponent)), 10 ** -exponent)
+
+
+def _number_text(value, original, scale=None):
+    # The text of the original element while it reads as value, exactly
+    # or rounded to cents
+    if original is not None and original.text:
+        try:
+            if value == _parse_money(original.text) or value == _parse_number(original.text):
+                return original.text
+        except (ValueError, ArithmeticError):
+            pass
+    return _format_number(value, scale)
+
+
+def _format_date(date):
+    if date.tzinfo is None:
+        # GNU Cash requires an offset; naive times are taken to be UTC
+        return "{:%Y-%m-%d %H:%M:%S} +0000".format(date)
+    return "{:%Y-%m-%d %H:%M:%S %z}".format(date)
+
+
+def _date_xml(tag, date, original, indent='  '):
+    # tag holding a ts:date; the text of the tag in original is kept
+    # while it reads as date
+    text = _child_text(original, tag + '/ts:date')
+    try:
+        if text is None or _parse_date(text) != date:
+            text = _format_date(date)
+    except ValueError:
+        text = _format_date(date)
+    return '{0}<{1}>\n{0}  <ts:date>{2}</ts:date>\n{0}</{1}>\n'.format(indent, tag, text)
+
+
+def _gdate_xml(tag, date):
+    if date is None:
+        return None
+    return '  <{0}>\n    <gdate>{1:%Y-%m-%d}</gdate>\n  </{0}>\n'.format(tag, date)
+
+
+def _commodity_xml(tag, commodity):
+    return ('  <{0}>\n'
+            '    <cmdty:space>{1}</cmdty:space>\n'
+            '    <cmdty:id>{2}</cmdty:id>\n'
+            '  </{0}>\n'.format(tag, _escape(commodity.space), _escape(commodity.name)))
+
+
+def _write_slots(w, tag, slots, indent, original=None):
+    xml = _slots_xml(tag, slots, indent, original)
+    if xml:
+        w(xml)
+
+
+def _slots_xml(tag, slots, indent, original):
+    # The slots element, None without slots. Slots keep the type they
+    # have in original, by default the element _LazySlots were read from.
+    if not slots:
+        return None
+    if original is None:
+        original = getattr(slots, '_tree', None)
+    parts = _Collector()
+    parts('{}<{}>\n'.format(indent, tag))
+    _write_slot_list(parts, slots, indent + '  ', original)
+    parts('{}</{}>\n'.format(indent, tag))
+    return parts.text()
+
+
+def _write_slot_list(w, slots, indent, original):
+    values = {}
+    if original is not None:
+        key, value = _qualified('slot:key'), _qualified('slot:value')
+        for slot in original.findall('slot'):
+            values[slot.findtext(key)] = slot.find(value)
+    for key, value in slots.items():
+        w('{0}<slot>\n{0}  <slot:key>{1}</slot:key>\n'.format(indent, _escape(key)))
+        value_original = values.get(key)
+        if isinstance(value, Mapping):
+            if value_original is not None and value_original.get('type') != 'frame':
+                value_original = None
+            w('{}  <slot:value type="frame">\n'.format(indent))
+            _write_slot_list(w, value, indent + '    ', value_original)
+            w('{}  </slot:value>\n'.format(indent))
+        else:
+            w('{}  <slot:value type="{}">{}</slot:value>\n'.format(
+                indent, *_slot_value(value, value_original)))
+        w('{}</slot>\n'.format(indent))
+
+
+def _slot_value(value, original=None):
+    # Returns the slot type and the XML content for a Python value: the
+    # type and content of original (a slot:value) while it reads as value
+    if original is not None:
+        type_ = original.get('type', 'string')
+        if _slot_reads_as(original, type_, value):
+            parts = [_escape(original.text or '')]
+            parts.extend(_element_xml(child) for child in original if isinstance(child.tag, str))
+            return type_, ''.join(parts)
+        if type_ == 'guid' and isinstance(value, str) and _GUID_RE.match(value):
+            return type_, value
+        if type_ == 'double' and isinstance(value, (int, float, decimal.Decimal, Money)):
+            return type_, repr(float(value))
+    if value is None:
+        # empty string slots are read as None
+        return 'string', ''
+    if isinstance(value, bool):
+        return 'string', 'true' if value else 'false'
+    if isinstance(value, int):
+        return 'integer', str(value)
+    if isinstance(value, float):
+        return 'double', repr(value)
+    if isinstance(value, (decimal.Decimal, Money)):
+        return 'numeric', _format_number(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None and value.time() == datetime.time():
+            return 'gdate', '<gdate>{:%Y-%m-%d}</gdate>'.format(value)
+        return 'timespec', '<ts:date>{}</ts:date>'.format(_format_date(value))
+    if isinstance(value, datetime.date):
+        return 'gdate', '<gdate>{:%Y-%m-%d}</gdate>'.format(value)
+    if isinstance(value, str):
+        return 'string', _escape(value)
+    raise TypeError("Cannot write slot value of type {}".format(type(value).__name__))
+
+
+def _slot_reads_as(original, type_, value):
+    # Whether the slot:value original of this type decodes to value
+    text = original.text
+    try:
+        if type_ in ('string', 'guid'):
+            return value == text or (value is None and not text)
+        if type_ == 'integer':
+            return not isinstance(value, bool) and value == int(text)
+        if type_ == 'double':
+            return not isinstance(value, bool) and value == float(text)
+        if type_ == 'numeric':
+            return value == _parse_money(text) or value == _parse_number(text)
+        if type_ == 'gdate':
+            return value == _parse_date(original.findtext('gdate'))
+        if type_ == 'timespec':
+            return value == _parse_date(original.findtext(_qualified('ts:date')))
+    except (TypeError, ValueError, ArithmeticError):
+        pass
+    return False
+
+
+##################################################################
+# Bulk import
+
+# Columns understood by add_transactions()
+_IMPORT_COLUMNS = frozenset(('transaction', 'date', 'description', 'num',
+                             'currency', 'account', 'transfer', 'value',
+                             'quantity', 'transfer_quantity', 'memo', 'action',
+                             'reconciled_state'))
+
+
+def _new_guids(count):
+    # One call into the OS for all of them instead of one uuid4() each
+    data = os.urandom(16 * count).hex()
+    return [data[i:i + 32] for i in range(0, 32 * count, 32)]
+
+
+class RowError(object):
+    """
+    A problem with one input row of add_transactions().
+
+    row is the index of the row in the input, transaction its
+    transaction key, and message describes the problem.
+    """
+
+    def __init__(self, row, transaction, message):
+        self.row = row
+        self.transaction = transaction
+        self.message = message
+
+    def __repr__(self):
+        return "<RowError row {}: {}>".format(self.row, self.message)
+
+
+class ImportReport(object):
+    """
+    The result of add_transactions().
+
+    transactions lists the Transaction objects that were added to the
+    book, errors the RowError objects for the rows that were rejected.
+    """
+
+    def __init__(self):
+        self.transactions = []
+        self.errors = []
+
+    def __repr__(self):
+        return "<ImportReport {} transactions, {} errors>".format(
+            len(self.transactions), len(self.errors))
+
+    def __str__(self):
+        lines = ["{} transactions added, {} rows rejected".format(
+            len(self.transactions), len(set(error.row for error in self.errors)))]
+        for error in self.errors:
+            lines.append("row {}: {}".format(error.row, error.message))
+        return '\n'.join(lines)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def _import_rows(rows):
+    # Rows may be given as an iterable of mappings or as a mapping of columns
+    if isinstance(rows, Mapping):
+        columns = list(rows)
+        lengths = set(len(rows[column]) for column in columns)
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same length")
+        return (dict(zip(columns, values))
+                for values in zip(*[rows[column] for column in columns]))
+    return rows
+
+
+def _import_date(date):
+    # Transaction dates carry a time zone, like the ones GNU Cash writes
+    if date is None:
+        raise ValueError("Missing date")
+    if isinstance(date, str):
+        date = _parse_date(date)
+    elif not isinstance(date, datetime.date):
+        raise ValueError("Invalid date {!r}".format(date))
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime.combine(date, datetime.time())
+    if date.tzinfo is None:
+        date = date.astimezone()
+    return date
+
+
+def add_transactions(book, rows, currency=None):
+    """
+    Create transactions from rows of splits and add them to book.
+
+    rows is either an iterable of mappings or a mapping of equal-length
+    columns. Each row is one split and uses these keys:
+
+    - transaction: key grouping the rows of one transaction
+    - date, description, num, currency: taken from the first row of each
+      transaction; date is a datetime, date or string (dates and times
+      without a time zone are taken as local time), currency a Commodity
+      or currency name and defaults to the currency argument or the
+      commodity of the first account
+    - account: Account, account GUID or full account name
+    - value: the amount in the transaction currency
+    - quantity: the amount in the account commodity; required if that is
+      not the transaction currency, otherwise it defaults to value
+    - memo, action, reconciled_state (defaults to "n")
+    - transfer: optional second account; the row then also creates the
+      balancing split in that account, so a bank line needs a single row
+    - transfer_quantity: the amount of the balancing split in the
+      transfer account's commodity, as for quantity; defaults to -value
+
+    Rows without a transaction key form a transaction of their own.
+
+    All rows are checked in one pass: unknown accounts, invalid numbers
+    or dates, and transactions whose values do not sum to zero. The
+    pass is plain Python summing per transaction; numpy is not used. Rows of
+    a transaction with any error are reported and nothing of that
+    transaction is added. The others get new GUIDs and are appended to
+    book.transactions and the splits lists of their accounts. Returns
+    an ImportReport.
+    """
+    if isinstance(book.transactions, _LazyTransactions):
+        raise ValueError("Cannot add transactions to a lazily loaded book")
+    accounts = {}
+    for account in book.accounts:
+        accounts[account.guid] = account
+        accounts[account.fullname()] = account
+    currencies = dict((commodity.name, commodity) for commodity in book.commodities)
+    zero = decimal.Decimal(0)
+
+    def _account(value):
+        if isinstance(value, Account):
+            return value
+        account = accounts.get(value)
+        if account is None:
+            raise ValueError("Unknown account {!r}".format(value))
+        return account
+
+    def _amount(value):
+        if isinstance(value, decimal.Decimal):
+            return value
+        try:
+            return decimal.Decimal(str(value))
+        except decimal.InvalidOperation:
+            raise ValueError("Invalid amount {!r}".format(value))
+
+    def _quantity(quantity, value, account, trn_currency):
+        if quantity is not None:
+            return _amount(quantity)
+        if trn_currency is not None and account.commodity not in (None, trn_currency):
+            raise ValueError("Missing quantity in {} for account {}".format(
+                account.commodity.name, account.fullname()))
+        return value
+
+    report = ImportReport()
+    groups = collections.OrderedDict()
+    totals = {}
+    bad = set()
+    for index, row in enumerate(_import_rows(rows)):
+        key = row.get('transaction')
+        if key is None:
+            key = ('row', index)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = []
+            totals[key] = zero
+        try:
+            unknown = set(row) - _IMPORT_COLUMNS
+            if unknown:
+                raise ValueError("Unknown columns {}".format(', '.join(sorted(unknown))))
+            account = _account(row.get('account'))
+            value = _amount(row.get('value'))
+            transfer = row.get('transfer')
+            if transfer is not None:
+                transfer = _account(transfer)
+            if not group:
+                date = _import_date(row.get('date'))
+                trn_currency = row.get('currency', currency)
+                if trn_currency is None:
+                    trn_currency = account.commodity
+                elif not isinstance(trn_currency, Commodity):
+                    if trn_currency not in currencies:
+                        raise ValueError("Unknown currency {!r}".format(trn_currency))
+                    trn_currency = currencies[trn_currency]
+                group.append((date, row.get('description'), row.get('num'), trn_currency))
+            trn_currency = group[0] and group[0][3]
+            quantity = _quantity(row.get('quantity'), value, account, trn_currency)
+            if transfer is not None:
+                transfer_quantity = _quantity(row.get('transfer_quantity'), -value,
+                                              transfer, trn_currency)
+                transfer = (transfer, transfer_quantity)
+            else:
+                totals[key] += value
+            group.append((index, row, account, value, quantity, transfer))
+        except (ValueError, TypeError, OverflowError) as e:
+            report.errors.append(RowError(index, key, str(e)))
+            bad.add(key)
+            if not group:
+                # keep the group shape: header first, then splits
+                group.append(None)
+
+    for key, total in totals.items():
+        if total != zero and key not in bad:
+            bad.add(key)
+            for index, row, account, value, quantity, transfer in groups[key][1:]:
+                report.errors.append(RowError(
+                    index, key, "Transaction does not balance, off by {}".format(total)))
+    report.errors.sort(key=lambda error: error.row)
+
+    count = 0
+    for key, group in groups.items():
+        if key not in bad:
+            count += 1 + sum(2 if item[5] is not None else 1 for item in group[1:])
+    guids = iter(_new_guids(count))
+    entered = datetime.datetime.now().astimezone()
+    for key, group in groups.items():
+        if key in bad:
+            continue
+        date, description, num, trn_currency = group[0]
+        trn = Transaction(guid=next(guids), currency=trn_currency, date=date,
+                          date_entered=entered, description=description, num=num)
+        for index, row, account, value, quantity, transfer in group[1:]:
+            splits = [(account, value, quantity)]
+            if transfer is not None:
+                splits.append((transfer[0], -value, transfer[1]))
+            for split_account, split_value, split_quantity in splits:
+                split = Split(guid=next(guids), memo=row.get('memo'),
+                              reconciled_state=row.get('reconciled_state', 'n'),
+                              value=split_value, quantity=split_quantity,
+                              account=split_account, transaction=trn,
+                              action=row.get('action'), slots={})
+                trn.splits.append(split)
+                split_account.splits.append(split)
+        book.transactions.append(trn)
+        report.transactions.append(trn)
+        if book._text_index is not None:
+            book._text_index.add(trn)
+    if report.transactions:
+        # cost basis engines only know the splits they were built from
+        book._cost_basis.clear()
+    return report
+
+
+##################################################################
+# Reconciliation
+
+class StatementLine(object):
+    """
+    One line of a bank statement passed to reconcile().
+
+    row is the index of the line in the input. status is "matched" with
+    the matching split in splits, "ambiguous" with the equally good
+    candidates in splits, or "unmatched" with no splits.
+    """
+
+    __slots__ = ('row', 'date', 'amount', 'reference', 'status', 'splits')
+
+    def __init__(self, row, date, amount, reference=None):
+        self.row = row
+        self.date = date
+        self.amount = amount
+        self.reference = reference
+        self.status = 'unmatched'
+        self.splits = []
+
+    def __repr__(self):
+        return "<StatementLine row {} {} {} {}>".format(self.row, self.date, self.amount,
+                                                       self.status)
+
+    @property
+    def split(self):
+        return self.splits[0] if self.status == 'matched' else None
+
+
+class ReconcileReport(object):
+    """
+    The result of reconcile().
+
+    lines lists a StatementLine per valid input row, errors a RowError
+    per row that could not be read. missing lists the unreconciled splits
+    in the period of the statement that no line matched.
+    """
+
+    def __init__(self, account, window):
+        self.account = account
+        self.window = window
+        self.lines = []
+        self.errors = []
+        self.missing = []
+
+    def __repr__(self):
+        return "<ReconcileReport {} matched, {} ambiguous, {} unmatched, {} missing>".format(
+            len(self.matched), len(self.ambiguous), len(self.unmatched), len(self.missing))
+
+    def __str__(self):
+        lines = ["{} lines matched, {} ambiguous, {} unmatched, {} rows rejected, "
+                 "{} splits missing from the statement".format(
+                     len(self.matched), len(self.ambiguous), len(self.unmatched),
+                     len(self.errors), len(self.missing))]
+        for line in self.ambiguous:
+            lines.append("row {}: {} {} matches {} splits".format(
+                line.row, line.date, line.amount, len(line.splits)))
+        for line in self.unmatched:
+            lines.append("row {}: {} {} not found".format(line.row, line.date, line.amount))
+        for error in self.errors:
+            lines.append("row {}: {}".format(error.row, error.message))
+        return '\n'.join(lines)
+
+    @property
+    def matched(self):
+        return [line for line in self.lines if line.status == 'matched']
+
+    @property
+    def ambiguous(self):
+        return [line for line in self.lines if line.status == 'ambiguous']
+
+    @property
+    def unmatched(self):
+        return [line for line in self.lines if line.status == 'unmatched']
+
+    def mark(self, state='c', date=None):
+        """
+        Set the reconciled_state (and reconcile_date, if given) of the
+        matched splits. Returns the number of splits changed.
+        """
+        matched = self.matched
+        for line in matched:
+            line.split.reconciled_state = state
+            if date is not None:
+                line.split.reconcile_date = date
+        return len(matched)
+
+    def write(self, fobj):
+        """
+        Write the report as CSV to the text file fobj: a row per statement
+        line, per candidate split, per rejected row and per missing split.
+        """
+        import csv
+        writer = csv.writer(fobj)
+        writer.writerow(['row', 'status', 'date', 'amount', 'reference', 'split',
+                         'split_date', 'description'])
+        for line in self.lines:
+            for split in line.splits or [None]:
+                writer.writerow([line.row, line.status, line.date, line.amount,
+                                 line.reference] + _report_split(split))
+        for error in self.errors:
+            writer.writerow([error.row, 'error', '', '', error.message] + _report_split(None))
+        for split in self.missing:
+            writer.writerow(['', 'missing', '', '', ''] + _report_split(split))
+
+
+def _report_split(split):
+    if split is None:
+        return ['', '', '']
+    return [split.guid, split.transaction.date.date(), split.transaction.description]
+
+
+def _statement_lines(rows, report):
+    for index, row in enumerate(_import_rows(rows)):
+        try:
+            date = row.get('date')
+            if isinstance(date, str):
+                date = _parse_date(date)
+            date = _as_date(date)
+            if not isinstance(date, datetime.date):
+                raise ValueError("Invalid date {!r}".format(date))
+            amount = row.get('amount')
+            if not isinstance(amount, decimal.Decimal):
+                try:
+                    amount = decimal.Decimal(str(amount))
+                except decimal.InvalidOperation:
+                    raise ValueError("Invalid amount {!r}".format(amount))
+            reference = row.get('reference')
+            report.lines.append(StatementLine(index, date, amount,
+                                              str(reference) if reference else None))
+        except (ValueError, TypeError, OverflowError) as e:
+            report.errors.append(RowError(index, None, str(e)))
+
+
+def _refers_to(split, reference):
+    reference = reference.lower()
+    transaction = split.transaction
+    return (reference == (transaction.num or '').lower()
+            or reference in (transaction.description or '').lower()
+            or reference in (split.memo or '').lower())
+
+
+def reconcile(account, rows, window=3):
+    """
+    Match bank statement rows against the unreconciled splits of account.
+
+    rows is either an iterable of mappings or a mapping of equal-length
+    columns, with the keys date (a date or a string), amount (in the
+    account commodity) and optionally reference, compared with the
+    transaction number, description and split memo. Other keys are
+    ignored.
+
+    A split is a candidate for a line if its quantity equals the amount
+    and its date is at most window days away. Candidates that mention the
+    reference come first, then the closest dates. Pairs are assigned
+    best first over the whole statement, so every split matches at most
+    one line; a line whose best free candidates are equally good is
+    ambiguous and gets none of them. Splits with reconciled_state "y"
+    are not considered. Returns a ReconcileReport; its mark() method
+    records the matches in the splits.
+    """
+    report = ReconcileReport(account, window)
+    _statement_lines(rows, report)
+    lines = report.lines
+
+    # amount -> parallel lists of day ordinals and split numbers, by date.
+    # The amounts are hashed as floats, which is several times faster
+    # than hashing Decimals; candidates are compared exactly below.
+    splits = [split for split in account.splits if split.reconciled_state != 'y']
+    days = [split.transaction.date.date().toordinal() for split in splits]
+    amounts = [split.quantity for split in splits]
+    index = {}
+    for number in sorted(range(len(splits)), key=days.__getitem__):
+        entries = index.get(float(amounts[number]))
+        if entries is None:
+            entries = index[float(amounts[number])] = ([], [])
+        entries[0].append(days[number])
+        entries[1].append(number)
+
+    # Every candidate pair is ranked by a single integer: first whether
+    # the split mentions the reference, then the days apart, the line and
+    # the split. Sorting plain integers is much faster than tuples.
+    count = len(splits) or 1
+    per_distance = len(lines) * count
+    per_mention = (window + 1) * per_distance
+    ranks = []
+    for position, line in enumerate(lines):
+        entries = index.get(float(line.amount))
+        if entries is None:
+            continue
+        line_days, numbers = entries
+        day = line.date.toordinal()
+        base = position * count
+        amount = line.amount
+        reference = line.reference
+        for i in range(bisect.bisect_left(line_days, day - window),
+                       bisect.bisect_right(line_days, day + window)):
+            number = numbers[i]
+            if amounts[number] != amount:
+                continue
+            rank = abs(line_days[i] - day) * per_distance + base + number
+            if reference is None or not _refers_to(splits[number], reference):
+                rank += per_mention
+            ranks.append(rank)
+    ranks.sort()
+
+    taken = bytearray(len(splits))
+    done = bytearray(len(lines))
+    for group, candidates in itertools.groupby(ranks, key=lambda rank: rank // count):
+        position = group % len(lines)
+        if done[position]:
+            continue
+        free = [rank % count for rank in candidates]
+        free = [number for number in free if not taken[number]]
+        if not free:
+            continue
+        line = lines[position]
+        done[position] = 1
+        line.splits = [splits[number] for number in free]
+        if len(free) == 1:
+            line.status = 'matched'
+            taken[free[0]] = 1
+        else:
+            line.status = 'ambiguous'
+
+    if lines:
+        first = min(line.date for line in lines) - datetime.timedelta(days=window)
+        last = max(line.date for line in lines) + datetime.timedelta(days=window)
+        first, last = first.toordinal(), last.toordinal()
+        report.missing = [split for number, split in enumerate(splits)
+                          if not taken[number] and first <= days[number] <= last]
+    return report
+
+
+##################################################################
+# Text search
+
+_TOKEN_RE = re.compile(r'\w+')
+_TEXT_INDEX_VERSION = 1
+
+
+def _document_text(obj):
+    # The text indexed for each kind of object
+    if isinstance(obj, Transaction):
+        parts = [obj.description, obj.slots.get('notes')]
+        parts.extend(split.memo for split in obj.splits)
+        return parts
+    if isinstance(obj, Entry):
+        return [obj.description]
+    return [obj.name]
+
+
+class TextIndex(object):
+    """
+    An inverted index of the words in transaction descriptions, notes
+    and split memos, invoice entry descriptions and customer names.
+
+    Words are the runs of letters and digits, compared in lower case.
+    search() finds the objects containing all words of a query; a word
+    ending in "*" matches every word starting with it. Matches are
+    returned in the order the objects were added: transactions, then
+    entries, then customers.
+
+    The index can be stored with save() next to the book and read back
+    with TextIndex.load(). For a lazily loaded book only the GUIDs of
+    the transactions are kept; matches are decoded through the book.
+    """
+
+    def __init__(self, book=None):
+        self.book_guid = None
+        self._book = None
+        self._guids = []
+        self._objects = {}
+        self._postings = {}
+        self._tokens = None
+        if book is not None:
+            self.book_guid = book.guid
+            self._book = book
+            for obj in _text_documents(book):
+                self.add(obj)
+
+    def __repr__(self):
+        return "<TextIndex {} objects, {} words>".format(len(self._guids), len(self._postings))
+
+    def __len__(self):
+        return len(self._guids)
+
+    def _lazy(self):
+        return self._book is not None and isinstance(self._book.transactions, _LazyTransactions)
+
+    def add(self, obj):
+        """Index a Transaction, Entry or Customer."""
+        number = len(self._guids)
+        self._guids.append(obj.guid)
+        if not (isinstance(obj, Transaction) and self._lazy()):
+            self._objects[obj.guid] = obj
+        postings = self._postings
+        words = set()
+        for text in _document_text(obj):
+            if text:
+                words.update(_TOKEN_RE.findall(text.lower()))
+        for word in words:
+            posting = postings.get(word)
+            if posting is None:
+                posting = postings[word] = array.array('I')
+                self._tokens = None
+            posting.append(number)
+
+    def search(self, query, guids=False):
+        """
+        Return the objects (or with guids=True, their GUIDs) containing
+        every word of query, e.g. "rent jan*".
+        """
+        matches = []
+        for term in query.split():
+            words = _TOKEN_RE.findall(term.lower())
+            prefix = term.endswith('*') and words
+            for word in words[:-1] if prefix else words:
+                matches.append(self._postings.get(word, ()))
+            if prefix:
+                matches.append(self._prefix(words[-1]))
+        if not matches:
+            return []
+        matches.sort(key=len)
+        result = set(matches[0])
+        for posting in matches[1:]:
+            if not result:
+                break
+            result.intersection_update(posting)
+        matched = [self._guids[number] for number in sorted(result)]
+        if guids:
+            return matched
+        return [self._object(guid) for guid in matched]
+
+    def _object(self, guid):
+        obj = self._objects.get(guid)
+        if obj is None:
+            # a transaction of a lazily loaded book
+            obj = self._book.transactions.find(guid)
+        return obj
+
+    def _prefix(self, prefix):
+        if self._tokens is None:
+            self._tokens = sorted(self._postings)
+        tokens = self._tokens
+        position = bisect.bisect_left(tokens, prefix)
+        numbers = set()
+        while position < len(tokens) and tokens[position].startswith(prefix):
+            numbers.update(self._postings[tokens[position]])
+            position += 1
+        return numbers
+
+    def save(self, fobj):
+        """Write the index to the binary file object fobj."""
+        import json
+        words = sorted(self._postings)
+        header = {'version': _TEXT_INDEX_VERSION,
+                  'book': self.book_guid,
+                  'objects': self._guids,
+                  'words': [(word, len(self._postings[word])) for word in words]}
+        fobj.write(json.dumps(header, separators=(',', ':')).encode('utf-8'))
+        fobj.write(b'\n')
+        for word in words:
+            posting = self._postings[word]
+            if sys.byteorder != 'little':
+                posting = array.array('I', posting)
+                posting.byteswap()
+            fobj.write(posting.tobytes())
+
+    @classmethod
+    def load(cls, fobj, book):
+        """
+        Read an index written by save() for book. Raises ValueError if it
+        was made for another book or refers to objects book does not have.
+        """
+        import json
+        header = json.loads(fobj.readline().decode('utf-8'))
+        if header.get('version') != _TEXT_INDEX_VERSION:
+            raise ValueError("Unsupported text index version {}".format(header.get('version')))
+        if header['book'] != book.guid:
+            raise ValueError("Text index belongs to book {}".format(header['book']))
+        index = cls()
+        index.book_guid = book.guid
+        index._book = book
+        lazy = index._lazy()
+        objects = dict((obj.guid, obj) for obj in _text_documents(book, not lazy))
+        for guid in header['objects']:
+            obj = objects.get(guid)
+            if obj is not None:
+                index._objects[guid] = obj
+            elif not lazy or book.transactions.index.position(guid) is None:
+                raise ValueError("Text index refers to unknown object {}".format(guid))
+        index._guids = header['objects']
+        for word, count in header['words']:
+            posting = array.array('I')
+            posting.frombytes(fobj.read(count * posting.itemsize))
+            if sys.byteorder != 'little':
+                posting.byteswap()
+            index._postings[word] = posting
+        return index
+
+
+def _text_documents(book, transactions=True):
+    if transactions:
+        for trn in book.transactions:
+            yield trn
+    customers = collections.OrderedDict()
+    for invoice in book.invoices:
+        for entry in invoice.entries:
+            yield entry
+        if invoice.customer is not None:
+            customers[invoice.customer.guid] = invoice.customer
+    for customer in customers.values():
+        yield customer
+
+
+##################################################################
+# Comparing books
+
+# The fields compared per kind of object, in the order they are reported
+_DIFF_FIELDS = collections.OrderedDict([
+    ('account', ('name', 'actype', 'parent', 'commodity', 'commodity_scu',
+                 'description', 'slots')),
+    ('transaction', ('currency', 'date', 'date_entered', 'description', 'num', 'slots')),
+    ('split', ('transaction', 'account', 'memo', 'action', 'reconciled_state',
+               'reconcile_date', 'value', 'quantity', 'lot', 'slots')),
+    ('price', ('commodity', 'currency', 'date', 'value')),
+    ('invoice', ('id', 'date', 'active', 'owner', 'entries')),
+])
+
+
+class ObjectChange(object):
+    """
+    An object that was added, removed or modified between two books.
+
+    kind is "account", "transaction", "split", "price" or "invoice" and
+    status "added", "removed" or "modified". fields maps the name of
+    each changed field to its (old, new) values; for added and removed
+    objects all fields are listed, with None for the missing side.
+    References to other objects are given as GUIDs.
+    """
+
+    __slots__ = ('kind', 'guid', 'status', 'fields')
+
+    def __init__(self, kind, guid, status, fields):
+        self.kind = kind
+        self.guid = guid
+        self.status = status
+        self.fields = fields
+
+    def __repr__(self):
+        return "<ObjectChange {} {} {}>".format(self.status, self.kind, self.guid)
+
+    def __str__(self):
+        if self.status != 'modified':
+            return "{} {} {}".format(self.status, self.kind, self.guid)
+        return "modified {} {}: {}".format(self.kind, self.guid, ', '.join(
+            "{} {!r} -> {!r}".format(name, old, new) for name, (old, new) in self.fields.items()))
+
+
+class BookDiff(object):
+    """
+    The result of diff_books(): a list of ObjectChanges, in the order of
+    the second book followed by the removed objects.
+    """
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __repr__(self):
+        return "<BookDiff {} added, {} removed, {} modified>".format(
+            len(self.added), len(self.removed), len(self.modified))
+
+    def __str__(self):
+        return '\n'.join(str(change) for change in self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    @property
+    def added(self):
+        return [change for change in self.changes if change.status == 'added']
+
+    @property
+    def removed(self):
+        return [change for change in self.changes if change.status == 'removed']
+
+    @property
+    def modified(self):
+        return [change for change in self.changes if change.status == 'modified']
+
+
+def _guid_of(obj):
+    return None if obj is None else obj.guid
+
+
+def _commodity_key(commodity):
+    return None if commodity is None else "{}:{}".format(commodity.space, commodity.name)
+
+
+def _slots_key(slots):
+    # Slots as nested sorted tuples, so that equal slots compare and
+    # print the same however they were decoded
+    if not slots:
+        return ()
+    return tuple(sorted((key, _slots_key(value) if isinstance(value, Mapping) else value)
+                        for key, value in slots.items()))
+
+
+def _diff_records(book):
+    # (kind, guid, values) for every compared object, one at a time. For a
+    # lazily loaded book only the transaction being compared is decoded.
+    for account in book.accounts:
+        yield 'account', account.guid, (
+            account.name, account.actype, _guid_of(account.parent),
+            _commodity_key(account.commodity), account.commodity_scu,
+            account.description, _slots_key(account.slots))
+    for trn in book.transactions:
+        yield 'transaction', trn.guid, (
+            _commodity_key(trn.currency), trn.date, trn.date_entered, trn.description,
+            trn.num, _slots_key(trn.slots))
+        for split in trn.splits:
+            yield 'split', split.guid, (
+                trn.guid, _guid_of(split.account), split.memo, split.action,
+                split.reconciled_state, split.reconcile_date, split.value, split.quantity,
+                _guid_of(split.lot), _slots_key(split.slots or {}))
+    for price in book.prices or ():
+        yield 'price', price.guid, (
+            _commodity_key(price.commodity), _commodity_key(price.currency),
+            price.date, price.value)
+    for invoice in book.invoices:
+        yield 'invoice', invoice.guid, (
+            invoice.id, invoice.date, invoice.active,
+            _guid_of(invoice.customer or invoice.vendor),
+            tuple((entry.guid, entry.action, entry.description, entry.qty, entry.price)
+                  for entry in invoice.entries))
+
+
+def _digest(values):
+    import hashlib
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=16).digest()
+
+
+def diff_books(a, b, cache_size=1000):
+    """
+    Compare two books and return a BookDiff of their accounts,
+    transactions, splits, prices and invoices, matched by GUID.
+
+    a and b are Book objects or file names. Files are loaded lazily with
+    the given cache_size, so only the transactions currently being
+    compared are decoded rather than both complete books.
+
+    Each object is reduced to a content hash. The first book is read to
+    collect the hashes, the second is compared against them, and the
+    first is read once more for the old values of the objects that
+    changed, so the time is linear in the size of the books.
+    """
+    if not isinstance(a, Book):
+        a = from_filename(a, lazy=True, cache_size=cache_size)
+    if not isinstance(b, Book):
+        b = from_filename(b, lazy=True, cache_size=cache_size)
+
+    old = {}
+    for kind, guid, values in _diff_records(a):
+        old[(kind, guid)] = _digest(values)
+
+    changes = []
+    pending = {}
+    for kind, guid, values in _diff_records(b):
+        digest = old.pop((kind, guid), None)
+        if digest is None:
+            names = _DIFF_FIELDS[kind]
+            changes.append(ObjectChange(kind, guid, 'added', collections.OrderedDict(
+                (name, (None, value)) for name, value in zip(names, values))))
+        elif digest != _digest(values):
+            change = ObjectChange(kind, guid, 'modified', values)
+            changes.append(change)
+            pending[(kind, guid)] = change
+
+    removed = []
+    for kind, guid, values in _diff_records(a) if old or pending else ():
+        key = (kind, guid)
+        names = _DIFF_FIELDS[kind]
+        if key in old:
+            removed.append(ObjectChange(kind, guid, 'removed', collections.OrderedDict(
+                (name, (value, None)) for name, value in zip(names, values))))
+        elif key in pending:
+            change = pending.pop(key)
+            change.fields = collections.OrderedDict(
+                (name, (before, after)) for name, before, after in zip(names, values, change.fields)
+                if before != after)
+    # equal values may still print differently, e.g. Decimals 1.0 and 1.00
+    changes = [change for change in changes if change.fields]
+    return BookDiff(changes + removed)
+
+
+##################################################################
+# Consolidated books
+
+class ConsolidatedAccount(Account):
+    """
+    An account of a ConsolidatedBook: the accounts with the same full
+    name (or GUID) in each of the books.
+
+    members lists those accounts. splits iterates over their splits in
+    date order, leaving out the splits of transactions already seen in an
+    earlier book; the Split objects are those of the member books.
+    """
+
+    def __init__(self, book, account, parent=None):
+        self.name = account.name
+        self.guid = account.guid
+        self.actype = account.actype
+        self.description = account.description
+        self.parent = parent
+        self.children = []
+        self.commodity = account.commodity
+        self.commodity_scu = account.commodity_scu
+        self.slots = account.slots
+        self.members = []
+        self._book = book
+
+    def __repr__(self):
+        return "<ConsolidatedAccount '{}[{}]' {}... in {} books>".format(
+            self.name, self.commodity, self.guid[:10], len(self.members))
+
+    @property
+    def splits(self):
+        return _MergedSplits(self._book, self.members)
+
+    @property
+    def lots(self):
+        return [lot for member in self.members for lot in member.lots]
+
+
+class _MergedSplits(object):
+    # The splits of the member accounts as one date-ordered iterable.
+    # Nothing is copied; every iteration merges the member lists anew.
+
+    def __init__(self, book, members):
+        self.book = book
+        self.members = members
+
+    def __iter__(self):
+        return heapq.merge(*[self.book._unique(account) for account in self.members],
+                           key=_split_date)
+
+    def __len__(self):
+        return sum(1 for split in self)
+
+    def __repr__(self):
+        return "<MergedSplits of {} accounts>".format(len(self.members))
+
+
+def _split_date(split):
+    return split.transaction.date
+
+
+def _transaction_date(transaction):
+    return transaction.date
+
+
+class ConsolidatedBook(object):
+    """
+    Several books, e.g. one per year, viewed as one.
+
+    books are Book objects or file names, loaded with from_filename and
+    the keyword arguments given (e.g. lazy=True). Accounts are unified by
+    full name, or with key="guid" by GUID, into ConsolidatedAccounts.
+    A transaction whose GUID was already in an earlier book, such as one
+    carried over into the next year's file, is left out; the first book
+    given wins.
+
+    transactions, prices and the splits of each account are iterated in
+    date order by merging those of the books, without copying them.
+    walk(), find_account(), find_guid() and ledger() work as for a Book.
+    """
+
+    def __init__(self, books, key='fullname', **kwargs):
+        if key not in ('fullname', 'guid'):
+            raise ValueError("Unknown account key {}".format(key))
+        self.books = [book if isinstance(book, Book) else from_filename(book, **kwargs)
+                      for book in books]
+        self.key = key
+        self._orders = {}
+        self._times = {}
+        self._book_numbers = {}
+
+        # GUIDs of the transactions of each book already in an earlier one
+        seen = set()
+        self._duplicates = []
+        for book in self.books:
+            transactions = book.transactions
+            if isinstance(transactions, _LazyTransactions):
+                guids = transactions.index.guids
+            else:
+                guids = [trn.guid for trn in transactions]
+            self._duplicates.append(seen.intersection(guids))
+            seen.update(guids)
+        del seen
+
+        self.root_account = None
+        self.accounts = []
+        self._accounts = {}
+        for number, book in enumerate(self.books):
+            root = book.root_account
+            self._book_numbers[id(root)] = number
+            if self.root_account is None:
+                self.root_account = ConsolidatedAccount(self, root)
+            self.root_account.members.append(root)
+            self._accounts[root.guid] = self.root_account
+            for account in book.accounts:
+                name = account.fullname() if key == 'fullname' else account.guid
+                consolidated = self._accounts.get(name)
+                if consolidated is None:
+                    consolidated = ConsolidatedAccount(self, account)
+                    self.accounts.append(consolidated)
+                    self._accounts[name] = consolidated
+                consolidated.members.append(account)
+                self._book_numbers[id(account)] = number
+                # children are looked up by the GUID of their parent
+                self._accounts[account.guid] = consolidated
+
+        # a child may come before its parent in the file, so parents are
+        # only looked up once all accounts are known
+        for consolidated in self.accounts:
+            parent = consolidated.members[0].parent
+            parent = self._accounts.get(parent.guid, self.root_account)
+            consolidated.parent = parent
+            parent.children.append(consolidated)
+
+        self.commodities = []
+        commodities = set()
+        for book in self.books:
+            for commodity in book.commodities:
+                if (commodity.space, commodity.name) not in commodities:
+                    commodities.add((commodity.space, commodity.name))
+                    self.commodities.append(commodity)
+
+    def __repr__(self):
+        return "<ConsolidatedBook of {} books>".format(len(self.books))
+
+    @property
+    def transactions(self):
+        """The transactions of all books in date order, without duplicates."""
+        return heapq.merge(*[self._unique_transactions(number, book)
+                             for number, book in enumerate(self.books)],
+                           key=_transaction_date)
+
+    @property
+    def prices(self):
+        """The prices of all books in date order, without duplicates."""
+        seen = set()
+        for price in heapq.merge(*[sorted(book.prices or (), key=lambda price: price.date)
+                                   for book in self.books], key=lambda price: price.date):
+            if price.guid not in seen:
+                seen.add(price.guid)
+                yield price
+
+    @property
+    def invoices(self):
+        seen = set()
+        result = []
+        for book in self.books:
+            for invoice in book.invoices:
+                if invoice.guid not in seen:
+                    seen.add(invoice.guid)
+                    result.append(invoice)
+        return result
+
+    walk = Book.walk
+    find_account = Book.find_account
+    ledger = Book.ledger
+
+    def find_guid(self, guid):
+        """Find an account (by its own or a member's GUID) or a transaction."""
+        account = self._accounts.get(guid)
+        if account is not None:
+            return account
+        for book in self.books:
+            item = book.find_guid(guid)
+            if item is not None:
+                return item
+
+    def _unique_transactions(self, number, book):
+        duplicates = self._duplicates[number]
+        for trn in self._ordered(book, book.transactions, _transaction_date):
+            if not duplicates or trn.guid not in duplicates:
+                yield trn
+
+    def _unique(self, account):
+        # The splits of a member account in date order, leaving out those
+        # of transactions from an earlier book
+        splits = self._ordered(account, account.splits, _split_date)
+        duplicates = self._duplicates[self._book_numbers[id(account)]]
+        if not duplicates:
+            return iter(splits)
+        return (split for split in splits if split.transaction.guid not in duplicates)
+
+    def _ordered(self, owner, items, key):
+        # items in date order. Usually they already are; otherwise the
+        # sorted order is kept for the next time.
+        cached = self._orders.get(id(owner))
+        if cached is None:
+            cached = self._orders[id(owner)] = (owner,) + self._order(items, key)
+        order, fetch = cached[1:]
+        if fetch is None:
+            return order
+        return map(fetch, order)
+
+    def _order(self, items, key):
+        # (order, None) for items to be iterated as they are, or
+        # (positions, fetch) for lazy ones. These are ordered by the dates
+        # in the transaction index, so nothing is decoded and only the
+        # positions are kept.
+        if isinstance(items, _LazyTransactions):
+            store = items._store
+            times = self._index_times(store)
+            positions = range(len(items))
+            fetch = store.transaction
+            date = times.__getitem__
+        elif isinstance(items, _LazySplits):
+            store = items._store
+            times = self._index_times(store)
+            positions = items._locate()
+            fetch = lambda where: store.transaction(where[0]).splits[where[1]]
+            date = lambda where: times[where[0]]
+        else:
+            dates = [key(item) for item in items]
+            if all(a <= b for a, b in zip(dates, dates[1:])):
+                return items, None
+            return [item for date, number, item in sorted(
+                zip(dates, range(len(dates)), items))], None
+        dates = [date(where) for where in positions]
+        if all(a <= b for a, b in zip(dates, dates[1:])):
+            return items, None
+        return sorted(positions, key=date), fetch
+
+    def _index_times(self, store):
+        # Posted dates of a lazy book's transactions as POSIX times
+        cached = self._times.get(id(store))
+        if cached is None:
+            times = array.array('d', (_parse_date(text).timestamp()
+                                      for text in store.index.dates))
+            cached = self._times[id(store)] = (store, times)
+        return cached[1]
+
+
+##################################################################
+# Shared memory
+
+# The tables published by share_book() and their columns, as array
+# type codes. String columns hold numbers into the string table (-1 for
+# None), account and transaction columns row numbers, days are date
+# ordinals, and amounts are kept exactly as units and scale (see Money).
+_SHARED_TABLES = collections.OrderedDict([
+    ('accounts', (('guid', 'i'), ('name', 'i'), ('fullname', 'i'), ('actype', 'i'),
+                  ('parent', 'i'), ('commodity', 'i'))),
+    ('transactions', (('guid', 'i'), ('date', 'q'), ('day', 'i'), ('currency', 'i'),
+                      ('description', 'i'), ('num', 'i'))),
+    ('splits', (('guid', 'i'), ('transaction', 'i'), ('account', 'i'), ('day', 'i'),
+                ('value_units', 'q'), ('value_scale', 'q'),
+                ('quantity_units', 'q'), ('quantity_scale', 'q'),
+                ('reconciled_state', 'i'), ('memo', 'i'))),
+    ('prices', (('guid', 'i'), ('commodity', 'i'), ('currency', 'i'), ('day', 'i'),
+                ('value_units', 'q'), ('value_scale', 'q'))),
+])
+_SHARED_VERSION = 1
+
+
+def _shared_rows(book, string):
+    # Yields (table, row values) for every row of every table
+    accounts = {}
+    for account in book.accounts:
+        accounts[account.guid] = len(accounts)
+    for account in book.accounts:
+        yield 'accounts', (string(account.guid), string(account.name),
+                           string(account.fullname()), string(account.actype),
+                           accounts.get(account.parent.guid, -1) if account.parent else -1,
+                           string(account.commodity and account.commodity.name))
+    for number, trn in enumerate(book.transactions):
+        yield 'transactions', (string(trn.guid), int(trn.date.timestamp()),
+                               trn.date.date().toordinal(),
+                               string(trn.currency and trn.currency.name),
+                               string(trn.description), string(trn.num))
+        day = trn.date.date().toordinal()
+        for split in trn.splits:
+            value = _as_exact(split.value)
+            quantity = _as_exact(split.quantity)
+            yield 'splits', (string(split.guid), number, accounts[split.account.guid], day,
+                             value.units, value.scale, quantity.units, quantity.scale,
+                             string(split.reconciled_state), string(split.memo))
+    for price in book.prices or ():
+        value = _as_exact(price.value)
+        yield 'prices', (string(price.guid), string(price.commodity.name),
+                         string(price.currency.name), price.date.date().toordinal(),
+                         value.units, value.scale)
+
+
+def _as_exact(value):
+    return value if isinstance(value, Money) else Money.from_decimal(value)
+
+
+def _shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("Shared memory needs Python 3.8 or later")
+    return shared_memory
+
+
+def share_book(book, name=None):
+    """
+    Publish the accounts, transactions, splits and prices of book in
+    shared memory, for worker processes to query without parsing the
+    file or unpickling the Book.
+
+    Returns the owning SharedBook. Pass its name to SharedBook.attach()
+    in the workers; call unlink() when all are done. Needs Python 3.8
+    or later.
+    """
+    import json
+    shared_memory = _shared_memory()
+    strings = {}
+
+    def string(text):
+        if text is None:
+            return -1
+        number = strings.get(text)
+        if number is None:
+            number = strings[text] = len(strings)
+        return number
+
+    columns = dict((table, [array.array(code) for column, code in spec])
+                   for table, spec in _SHARED_TABLES.items())
+    for table, row in _shared_rows(book, string):
+        for column, value in zip(columns[table], row):
+            column.append(value)
+
+    blob = bytearray()
+    offsets = array.array('q', [0])
+    for text in strings:
+        blob += text.encode('utf-8')
+        offsets.append(len(blob))
+
+    # header, then every column and the string table, 8-byte aligned
+    layout = {'version': _SHARED_VERSION, 'book': book.guid, 'tables': {}}
+    pieces = []
+    position = 0
+    for table, spec in _SHARED_TABLES.items():
+        entry = layout['tables'][table] = {'length': len(columns[table][0]), 'columns': {}}
+        for (column, code), values in zip(spec, columns[table]):
+            entry['columns'][column] = [code, position]
+            pieces.append((position, values))
+            position += -(-len(values) * values.itemsize // 8) * 8
+    layout['strings'] = [len(strings), position, position + len(offsets) * 8, len(blob)]
+    pieces.append((position, offsets))
+    pieces.append((position + len(offsets) * 8, blob))
+    position += len(offsets) * 8 + len(blob)
+
+    header = json.dumps(layout, separators=(',', ':')).encode('utf-8')
+    start = 8 + -(-len(header) // 8) * 8
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, start + position))
+    try:
+        buf = shm.buf
+        buf[:8] = len(header).to_bytes(8, 'little')
+        buf[8:8 + len(header)] = header
+        for offset, values in pieces:
+            data = memoryview(values).cast('B')
+            buf[start + offset:start + offset + len(data)] = data
+        del buf
+        return SharedBook(shm, owner=True)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+
+class SharedBook(object):
+    """
+    Book data published in shared memory by share_book().
+
+    accounts, transactions, splits and prices are tables: mappings of
+    column name to a read-only memoryview into the shared memory, which
+    is not copied. See _SHARED_TABLES for the columns. string() turns
+    the numbers in string columns back into text.
+
+    balances() and rollup() answer the usual balance queries from the
+    columns. Call close() when done; the owner calls unlink() as well.
+    """
+
+    def __init__(self, shm, owner=False):
+        import json
+        self._shm = shm
+        self.owner = owner
+        self._views = []
+        buf = shm.buf
+        size = int.from_bytes(buf[:8], 'little')
+        layout = json.loads(bytes(buf[8:8 + size]).decode('utf-8'))
+        if layout.get('version') != _SHARED_VERSION:
+            raise ValueError("Unsupported shared book version {}".format(layout.get('version')))
+        self.book_guid = layout['book']
+        start = 8 + -(-size // 8) * 8
+        for table, entry in layout['tables'].items():
+            columns = collections.OrderedDict()
+            length = entry['length']
+            for column, (code, offset) in entry['columns'].items():
+                itemsize = array.array(code).itemsize
+                columns[column] = self._view(buf, start + offset, length * itemsize, code)
+            setattr(self, table, columns)
+        count, offsets, blob, blob_size = layout['strings']
+        self._offsets = self._view(buf, start + offsets, (count + 1) * 8, 'q')
+        self._blob = self._view(buf, start + blob, blob_size, 'B')
+        self._strings = {}
+
+    def _view(self, buf, offset, size, code):
+        view = buf[offset:offset + size].toreadonly().cast(code)
+        self._views.append(view)
+        return view
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to the shared book published under name."""
+        return cls(_shared_memory().SharedMemory(name=name))
+
+    def __repr__(self):
+        return "<SharedBook {} {} splits>".format(self.name, len(self.splits['account']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def string(self, number):
+        """Return the text of a string column value (None for -1)."""
+        if number < 0:
+            return None
+        text = self._strings.get(number)
+        if text is None:
+            text = self._strings[number] = bytes(
+                self._blob[self._offsets[number]:self._offsets[number + 1]]).decode('utf-8')
+        return text
+
+    def balances(self, as_of=None, field='quantity'):
+        """
+        Return a dict of account full name to the sum of the quantity (or
+        with field="value", the value) of its splits, as Decimals, up to
+        and including the date as_of.
+        """
+        splits = self.splits
+        rows = zip(splits['account'], splits[field + '_units'], splits[field + '_scale'])
+        if as_of is not None:
+            rows = itertools.compress(rows, map(_as_date(as_of).toordinal().__ge__,
+                                                splits['day']))
+        totals = {}
+        for account, units, scale in rows:
+            key = (account, scale)
+            totals[key] = totals.get(key, 0) + units
+        names = self.accounts['fullname']
+        result = dict((self.string(names[account]), Money(0))
+                      for account in range(len(names)))
+        for (account, scale), units in totals.items():
+            name = self.string(names[account])
+            result[name] += Money(units, scale)
+        return dict((name, total.to_decimal()) for name, total in result.items())
+
+    def rollup(self, as_of=None, field='quantity'):
+        """Like balances(), with each account including its subaccounts."""
+        balances = self.balances(as_of, field)
+        names = self.accounts['fullname']
+        parents = self.accounts['parent']
+        result = dict(balances)
+        for account in range(len(names)):
+            total = balances[self.string(names[account])]
+            parent = parents[account]
+            while parent >= 0:
+                name = self.string(names[parent])
+                result[name] += total
+                parent = parents[parent]
+        return result
+
+    def close(self):
+        """Release the views and detach from the shared memory."""
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._shm.close()
+
+    def unlink(self):
+        """Free the shared memory; only the owner should do this."""
+        self._shm.unlink()
+
+
+##################################################################
+# Asynchronous loading
+
+# Number of books kept by load_book(), keyed by file identity.
+_BOOK_CACHE_SIZE = 4
+_book_cache = collections.OrderedDict()
+_book_loads = {}
+_book_lock = threading.Lock()
+
+
+def _file_identity(path):
+    # A file is the same as long as it is the same inode with the same
+    # size and modification time; the path is resolved through symlinks.
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+async def load_book(path, executor=None):
+    """
+    Load a GNU Cash file without blocking the event loop.
+
+    The file is parsed by from_filename() in executor, or the loop's
+    default thread pool if it is None. A ProcessPoolExecutor works as
+    well; the Book is then pickled back to this process.
+
+    Concurrent calls for the same file share a single parse, and the
+    last few loaded books are kept, keyed by the path, inode, size and
+    modification time of the file, so unchanged files are not parsed
+    again. The returned Book is shared between callers and should not
+    be modified.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    identity = _file_identity(path)
+    with _book_lock:
+        book = _book_cache.get(identity)
+        if book is not None:
+            _book_cache.move_to_end(identity)
+            return book
+        # futures belong to one event loop
+        key = (loop, identity)
+        future = _book_loads.get(key)
+        if future is None:
+            future = loop.run_in_executor(executor, from_filename, identity[0])
+            _book_loads[key] = future
+            future.add_done_callback(lambda f: _book_loaded(key, f))
+    # a cancelled caller must not cancel the load for the others
+    return await asyncio.shield(future)
+
+
+def _book_loaded(key, future):
+    with _book_lock:
+        _book_loads.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        _book_cache[key[1]] = future.result()
+        while len(_book_cache) > _BOOK_CACHE_SIZE:
+            _book_cache.popitem(last=False)
+
+
+##################################################################
+# Invoice totals
+
+def _taxtable_rates(taxtable):
+    # Returns (percentage factor, fixed amount) for a tax table, summed over
+    # its entries.
+    rate = decimal.Decimal(0)
+    fixed = decimal.Decimal(0)
+    for tte in taxtable.taxtable_entries or []:
+        if tte.ttetype == 'VALUE':
+            fixed += tte.amount
+        else:
+            rate += tte.amount / 100
+    return rate, fixed
+
+
+def compute_invoice_totals(invoices):
+    """
+    Compute subtotal, tax per tax table and total for many invoices at once.
+
+    Tax table rates are resolved once per table instead of once per entry,
+    and the results are cached on each Invoice, so subsequent access to
+    Invoice.subtotal, Invoice.tax_by_table and Invoice.total is free.
+    Accepts a Book or an iterable of invoices. Without numpy to lean on,
+    the batch is a single loop over the entries, not array arithmetic.
+    """
+    if isinstance(invoices, Book):
+        invoices = invoices.invoices
+    rates = {}
+    zero = decimal.Decimal(0)
+    for inv in invoices:
+        subtotal = zero
+        taxes = {}
+        for entry in inv.entries or []:
+            qty = entry.qty or zero
+            price = entry.price or zero
+            line = qty * price
+            subtotal += line
+            taxtable = entry.taxtable
+            if taxtable is None or not entry.taxable or int(entry.taxable) != 1:
+                continue
+            rate = rates.get(taxtable)
+            if rate is None:
+                rate = rates[taxtable] = _taxtable_rates(taxtable)
+            taxes[taxtable] = taxes.get(taxtable, zero) + line * rate[0] + rate[1]
+        inv._totals = (subtotal, taxes, subtotal + sum(taxes.values(), zero))
+
+
+def _json_encoder():
+    # Defines CustomJSONEncoder on first use, see __getattr__
+    global CustomJSONEncoder
+    if 'CustomJSONEncoder' in globals():
+        return CustomJSONEncoder
+    import json
+
+    class CustomJSONEncoder(json.JSONEncoder):
+        def default(self, o):
+            if isinstance(o, datetime.datetime):
+                return o.isoformat()
+            if isinstance(o, (decimal.Decimal, Money)):
+                return float(o)
+            if isinstance(o, Mapping):
+                return dict(o)
+            return dict((k, v) for k, v in o.__dict__.items() if not k.startswith('_'))
+
+    CustomJSONEncoder.__qualname__ = 'CustomJSONEncoder'
+    return CustomJSONEncoder
+
+
+##################################################################
+# Watching files
+
+# Files are hashed in pieces of this size to tell real changes from touches.
+_HASH_SIZE = 1 << 20
+
+
+def _file_hash(filename):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(filename, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(_HASH_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_signature(filename):
+    st = os.stat(filename)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class _BookView(object):
+    # A loaded book together with the lookup tables the watcher answers
+    # queries from. Built completely before it replaces the previous one.
+
+    def __init__(self, book, digest):
+        self.book = book
+        self.digest = digest
+        self.loaded = time.time()
+        zero = decimal.Decimal(0)
+        self.balances = {}
+        for account in book.accounts:
+            self.balances[account.guid] = sum(
+                (split.quantity for split in account.splits), zero)
+        self.guids = {}
+        for item in book.accounts:
+            self.guids[item.guid] = item
+        if not isinstance(book.transactions, _LazyTransactions):
+            for item in book.transactions:
+                self.guids[item.guid] = item
+        for item in book.invoices:
+            self.guids[item.guid] = item
+        compute_invoice_totals(book)
+
+
+class BookWatcher(object):
+    """
+    Keep a parsed Book in memory and reload it when the file changes.
+
+    The file is loaded once on construction. After start(), a background
+    thread checks its inode, size and modification time every interval
+    seconds. When those differ, the contents are hashed and, if they
+    changed, the book is loaded again and swapped in as a whole, so
+    readers of watcher.book always see a complete Book. If a reload fails,
+    e.g. because the file is only partially written, the previous book
+    is kept, the exception is stored as watcher.error and the reload is
+    retried on the next check.
+
+    Account balances, GUID lookups and invoice totals are computed once
+    per load. serve() exposes them through a small HTTP/JSON server.
+    Any further keyword arguments are passed to from_filename().
+    """
+
+    def __init__(self, filename, interval=5.0, on_reload=None, **kwargs):
+        self.filename = filename
+        self.interval = interval
+        self.on_reload = on_reload
+        self.kwargs = kwargs
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._signature = _file_signature(filename)
+        self._view = _BookView(from_filename(filename, **kwargs), _file_hash(filename))
+
+    def __repr__(self):
+        return "<BookWatcher {}>".format(self.filename)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def book(self):
+        return self._view.book
+
+    @property
+    def loaded(self):
+        """Time of the last successful load, as returned by time.time()."""
+        return self._view.loaded
+
+    def balance(self, guid):
+        """Sum of the split quantities of the account with this GUID, or None."""
+        return self._view.balances.get(guid)
+
+    def find_guid(self, guid):
+        """Return the account, transaction or invoice with this GUID, or None."""
+        view = self._view
+        item = view.guids.get(guid)
+        if item is None and isinstance(view.book.transactions, _LazyTransactions):
+            item = view.book.transactions.find(guid)
+        return item
+
+    def check(self):
+        """
+        Reload the book if the file changed. Returns True if it was reloaded.
+        """
+        with self._lock:
+            try:
+                signature = _file_signature(self.filename)
+                if signature == self._signature:
+                    return False
+                digest = _file_hash(self.filename)
+                if digest == self._view.digest:
+                    self._signature = signature
+                    return False
+                view = _BookView(from_filename(self.filename, **self.kwargs), digest)
+            except Exception as e:
+                self.error = e
+                return False
+            self._view = view
+            self._signature = signature
+            self.error = None
+        if self.on_reload is not None:
+            self.on_reload(view.book)
+        return True
+
+    def start(self):
+        """Start checking the file in a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=repr(self))
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # raised by on_reload; keep watching
+                self.error = e
+
+    def serve(self, host="127.0.0.1", port=8000):
+        """
+        Serve the book as JSON over HTTP in a background thread.
+
+        Returns the server; call its shutdown() method to stop it. The
+        endpoints are:
+
+        - /status: file name, load time and the last reload error
+        - /accounts: all accounts with their balance
+        - /accounts/<guid>: one account
+        - /guid/<guid>: the account, transaction or invoice with that GUID
+        - /invoices: all invoices with their totals
+        - /invoices/<id or guid>: one invoice
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        handler = type('BookRequestHandler', (_BookRequests, BaseHTTPRequestHandler), {})
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        server.watcher = self
+        thread = threading.Thread(target=server.serve_forever, name="{} server".format(self))
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def _account_json(account, balance):
+    return {'guid': account.guid, 'name': account.name,
+            'fullname': account.fullname(), 'type': account.actype,
+            'commodity': account.commodity and account.commodity.name,
+            'parent': account.parent and account.parent.guid,
+            'balance': balance}
+
+
+def _transaction_json(trn):
+    return {'guid': trn.guid, 'date': trn.date, 'num': trn.num,
+            'description': trn.description,
+            'currency': trn.currency and trn.currency.name,
+            'splits': [{'guid': split.guid, 'account': split.account.guid,
+                        'value': split.value, 'quantity': split.quantity,
+                        'memo': split.memo,
+                        'reconciled_state': split.reconciled_state}
+                       for split in trn.splits]}
+
+
+def _invoice_json(invoice):
+    return {'guid': invoice.guid, 'id': invoice.id, 'date': invoice.date,
+            'active': invoice.active,
+            'customer': invoice.customer and invoice.customer.name,
+            'vendor': invoice.vendor and invoice.vendor.name,
+            'subtotal': invoice.subtotal,
+            'tax': dict((table.name, amount)
+                        for table, amount in invoice.tax_by_table.items()),
+            'total': invoice.total}
+
+
+def _price_json(price):
+    return {'guid': price.guid, 'date': price.date,
+            'commodity': price.commodity.name, 'currency': price.currency.name,
+            'value': price.value}
+
+
+class _BookRequests(object):
+    # The request handling of BookWatcher.serve(), mixed into
+    # BaseHTTPRequestHandler there so http.server is imported on use
+    def do_GET(self):
+        watcher = self.server.watcher
+        view = watcher._view
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        result = None
+        if parts == ['status']:
+            result = {'filename': watcher.filename, 'guid': view.book.guid,
+                      'loaded': datetime.datetime.fromtimestamp(view.loaded),
+                      'error': watcher.error and str(watcher.error)}
+        elif parts == ['accounts']:
+            result = [_account_json(account, view.balances[account.guid])
+                      for account in view.book.accounts]
+        elif len(parts) == 2 and parts[0] == 'accounts':
+            account = view.guids.get(parts[1])
+            if isinstance(account, Account):
+                result = _account_json(account, view.balances[account.guid])
+        elif len(parts) == 2 and parts[0] == 'guid':
+            item = watcher.find_guid(parts[1])
+            if isinstance(item, Account):
+                result = dict(_account_json(item, view.balances[item.guid]), kind='account')
+            elif isinstance(item, Transaction):
+                result = dict(_transaction_json(item), kind='transaction')
+            elif isinstance(item, Invoice):
+                result = dict(_invoice_json(item), kind='invoice')
+        elif parts == ['invoices']:
+            result = [_invoice_json(invoice) for invoice in view.book.invoices]
+        elif len(parts) == 2 and parts[0] == 'invoices':
+            for invoice in view.book.invoices:
+                if parts[1] in (invoice.id, invoice.guid):
+                    result = _invoice_json(invoice)
+                    break
+        if result is None:
+            self._send(404, {'error': 'not found: {}'.format(self.path)})
+        else:
+            self._send(200, result)
+
+    def _send(self, status, result):
+        import json
+        body = json.dumps(result, cls=_json_encoder()).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the watcher's host process quiet
+        pass
+
+
+##################################################################
+# Command line
+
+def _ledger_lines(book):
+    for comm in book.commodities:
+        yield 'commodity {}'.format(comm.name)
+        yield '\tnamespace {}'.format(comm.space)
+        yield ''
+
+    for account in book.accounts:
+        yield 'account {}'.format(account.fullname())
+        if account.description:
+            yield '\tnote {}'.format(account.description)
+        yield '\tcheck commodity == "{}"'.format(account.commodity)
+        yield ''
+
+    for trn in sorted(book.transactions):
+        yield '{:%Y/%m/%d} * {}'.format(trn.date, trn.description)
+        for spl in trn.splits:
+            yield '\t{:50} {:12.2f} {} {}'.format(spl.account.fullname(),
+                                                 spl.value,
+                                                 spl.account.commodity,
+                                                 '; ' + spl.memo if spl.memo else '')
+        yield ''
+
+
+def _command_ledger(args, out):
+    book = from_filename(args.filename, backend=args.backend)
+    for line in _ledger_lines(book):
+        out.write(line)
+        out.write('\n')
+    return 0
+
+
+def _command_json(args, out):
+    encoder = _json_encoder()(separators=(',', ':'))
+    if args.kind == 'transactions':
+        # decoded one at a time, only a few are kept in memory
+        book = from_filename(args.filename, lazy=True, backend=args.backend)
+        records = (_transaction_json(trn) for trn in book.transactions)
+    else:
+        book = from_filename(args.filename, backend=args.backend)
+        if args.kind == 'accounts':
+            zero = decimal.Decimal(0)
+            records = (_account_json(account, sum((split.quantity for split in account.splits), zero))
+                       for account in book.accounts)
+        elif args.kind == 'invoices':
+            compute_invoice_totals(book)
+            records = (_invoice_json(invoice) for invoice in book.invoices)
+        else:
+            records = (_price_json(price) for price in book.prices or ())
+    for record in records:
+        out.write(encoder.encode(record))
+        out.write('\n')
+    return 0
+
+
+def _command_stats(args, out):
+    book = from_filename(args.filename, stats=True, backend=args.backend)
+    out.write('{}\n'.format(book.load_stats))
+    return 0
+
+
+def _command_verify(args, out):
+    book = from_filename(args.filename, verify=True, backend=args.backend)
+    out.write('{}\n'.format(book.verification))
+    return 0 if book.verification.ok else 1
+
+
+_COMMANDS = collections.OrderedDict([
+    ('ledger', (_command_ledger, "print the book in ledger-cli format")),
+    ('json', (_command_json, "print transactions, accounts, invoices or prices "
+                             "as JSON, one per line")),
+    ('stats', (_command_stats, "show where the time goes while loading")),
+    ('verify', (_command_verify, "check the file for damage; exits with 1 if "
+                                 "problems were found")),
+])
+
+
+def main(argv=None):
+    """
+    The gnucashxml command. Output is written as it is produced, so it
+    can be piped into other tools. Returns the exit status.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='gnucashxml', description="Read GNU Cash XML files.")
+    parser.add_argument('--version', action='version', version=__version__)
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for name, (command, help) in _COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        subparser.add_argument('filename')
+        subparser.add_argument('--backend', choices=_BACKENDS, default='etree',
+                               help="XML parser (default: etree)")
+        if name == 'json':
+            subparser.add_argument('--kind', default='transactions',
+                                   choices=('transactions', 'accounts', 'invoices', 'prices'))
+    args = parser.parse_args(argv)
+    try:
+        return _COMMANDS[args.command][0](args, sys.stdout)
+    except (OSError, ValueError) as exc:
+        if isinstance(exc, BrokenPipeError):
+            # the reader went away, e.g. head; stay quiet at exit too
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+        sys.stderr.write("gnucashxml: {}\n".format(exc))
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,7 +3,7 @@
 import os
 import shutil
 
-from distutils.core import setup
+from setuptools import setup
 
 if not os.path.exists("README.txt"):
     shutil.copy("README.md", "README.txt")
@@ -16,9 +16,14 @@ setup(name='gnucashxml',
       author_email="forcer@forcix.cx",
       url="https://github.com/jorgenschaefer/gnucashxml",
       py_modules=['gnucashxml'],
+      python_requires='>=3.7',
+      entry_points={
+          'console_scripts': ['gnucashxml = gnucashxml:main'],
+      },
       classifiers=[
           "Development Status :: 5 - Production/Stable",
           "Intended Audience :: Developers",
+          "Programming Language :: Python :: 3",
           ("License :: OSI Approved :: "
            "GNU General Public License v3 or later (GPLv3+)"),
           "Topic :: Office/Business :: Financial :: Accounting",
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[0:0] = [os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "benchmarks")]
+
+import gnucashxml  # noqa: E402
+
+# A small hand-made book: a bank account, shares bought in two lots and
+# partly sold, salary, rent from a scheduled transaction, a quarterly
+# budget and an invoice with VAT.
+SAMPLE = os.path.join(HERE, "data", "sample.gnucash")
+
+
+@pytest.fixture
+def sample():
+    return SAMPLE
+
+
+@pytest.fixture
+def book():
+    return gnucashxml.from_filename(SAMPLE)
@@ -0,0 +1,90 @@
+import datetime
+import decimal
+import io
+
+import pytest
+
+import gnucashxml
+from gnucashxml import Money
+
+D = decimal.Decimal
+date = datetime.date
+
+
+def test_budget(book):
+    budget, = book.budgets
+    assert (budget.name, budget.description, budget.num_periods) == (
+        "Household", "First quarter", 3)
+    assert budget.periods == [(date(2020, 1, 1), date(2020, 2, 1)),
+                              (date(2020, 2, 1), date(2020, 3, 1)),
+                              (date(2020, 3, 1), date(2020, 4, 1))]
+    rent = book.find_account("Rent")
+    assert budget.amounts[rent.guid] == (None, D("800"), D("800"))
+    assert budget.amount(rent, 1) == D("800")
+    assert budget.amount(book.find_account("Bank").guid, 0) is None
+    # the amounts are not repeated in the slots
+    assert list(budget.slots) == ["notes"]
+
+
+def test_budget_vs_actual(book):
+    report = book.budget_vs_actual("Household")
+    assert len(report) == 14
+    groceries = report[book.find_account("Groceries")]
+    assert groceries.budgeted == [D("100")] * 3
+    assert groceries.actual == [D("45.50"), D("62.30"), D("0")]
+    assert groceries.variance == [D("-54.50"), D("-37.70"), D("-100")]
+    rent = report[book.find_account("Rent").guid]
+    assert rent.budgeted == [None, D("800"), D("800")]
+    assert rent.actual == [D("0"), D("800"), D("0")]
+    assert rent.variance == [None, D("0"), D("-800")]
+    expenses = report[book.find_account("Expenses")]
+    assert expenses.budgeted == [D("100"), D("900"), D("900")]
+    assert expenses.actual == [D("45.50"), D("862.30"), D("0")]
+    assert report[book.find_account("Salary")].actual == [D("-2500"), D("-2500"), D("0")]
+    assert report[book.find_account("Income")].budgeted == [None, None, None]
+    assert [line.account.name for line in report][:3] == ["Assets", "Bank", "Broker"]
+
+
+def test_quantity_and_value(book):
+    by_guid = book.budget_vs_actual(book.budgets[0].guid)
+    broker = book.find_account("Broker")
+    assert by_guid[broker].actual == [D("10"), D("10"), D("-15")]
+    assert book.budget_vs_actual(book.budgets[0], field="value")[broker].actual == [
+        D("1000"), D("1200"), D("-1950")]
+    with pytest.raises(KeyError):
+        book.budget_vs_actual("Holiday")
+
+
+@pytest.mark.parametrize("options", [{"exact": True}, {"lazy": True}, {"backend": "expat"}])
+def test_load_modes(sample, book, options):
+    other = gnucashxml.from_filename(sample, **options)
+    report = other.budget_vs_actual("Household")
+    expected = book.budget_vs_actual("Household")
+    assert [(line.budgeted, line.actual) for line in report] == [
+        (line.budgeted, line.actual) for line in expected]
+    if options.get("exact"):
+        actual = report[other.find_account("Groceries")].actual
+        assert all(isinstance(amount, Money) for amount in actual)
+
+
+def test_empty_period(book):
+    budget = book.budgets[0]
+    budget.num_periods = 5
+    report = book.budget_vs_actual(budget)
+    assert report[book.find_account("Groceries")].actual[3:] == [D("0"), D("0")]
+    assert report[book.find_account("Groceries")].budgeted[3:] == [None, None]
+    assert budget.amount(book.find_account("Groceries"), 4) is None
+    budget.num_periods = 0
+    assert len(book.budget_vs_actual(budget).periods) == 0
+
+
+def test_written(book):
+    budget = book.budgets[0]
+    budget.amounts[book.find_account("Rent").guid] = (D("750"), D("800"), None)
+    out = io.BytesIO()
+    gnucashxml.write(book, out)
+    again = gnucashxml.parse(io.BytesIO(out.getvalue()))
+    budget, = again.budgets
+    assert budget.amounts[again.find_account("Rent").guid] == (D("750"), D("800"), None)
+    assert budget.amounts[again.find_account("Groceries").guid] == (D("100"),) * 3
+    assert budget.slots["notes"] == book.budgets[0].slots["notes"]
@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+
+import gnucashxml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(*args):
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_import_is_cheap():
+    result = _run("-c", "import sys, gnucashxml; print(' '.join(sorted(sys.modules)))")
+    assert result.returncode == 0, result.stderr
+    modules = set(result.stdout.split())
+    assert "gnucashxml" in modules
+    for name in ("dateutil", "lxml", "json", "asyncio", "http.server"):
+        assert name not in modules
+
+
+def test_deferred_names():
+    assert gnucashxml.parse_date("2020-01-15").year == 2020
+    assert gnucashxml.ElementTree is gnucashxml._etree()
+
+
+def test_ledger(sample, capsys):
+    assert gnucashxml.main(["ledger", sample]) == 0
+    out = capsys.readouterr().out
+    assert out.count("Grocery store") == 2
+    assert "Assets:Bank" in out
+
+
+def test_json(sample, capsys):
+    assert gnucashxml.main(["json", sample]) == 0
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(records) == 10
+    assert records[2]["description"] == "Grocery store"
+    for kind, count in (("accounts", 14), ("invoices", 1), ("prices", 3)):
+        assert gnucashxml.main(["json", "--kind", kind, "--backend", "expat", sample]) == 0
+        lines = capsys.readouterr().out.splitlines()
+        assert len(lines) == count
+    assert json.loads(lines[0])["value"] == 100.01
+    assert gnucashxml.main(["json", "--kind", "invoices", sample]) == 0
+    invoice = json.loads(capsys.readouterr().out)
+    assert (invoice["id"], invoice["customer"], invoice["total"]) == (
+        "2020-001", "Sample Customer", 1210.0)
+
+
+def test_verify(sample, tmp_path, capsys):
+    assert gnucashxml.main(["verify", sample]) == 0
+    assert capsys.readouterr().out == "ok\n"
+    with open(sample, "rb") as fobj:
+        data = fobj.read()
+    damaged = tmp_path / "damaged.gnucash"
+    damaged.write_bytes(data.replace(b"<split:value>4550/100<", b"<split:value>4551/100<"))
+    assert gnucashxml.main(["verify", str(damaged)]) == 1
+    assert "does not balance" in capsys.readouterr().out
+
+
+def test_errors(tmp_path, capsys):
+    assert gnucashxml.main(["ledger", str(tmp_path / "missing.gnucash")]) == 2
+    assert capsys.readouterr().err.startswith("gnucashxml: ")
+    result = _run("-m", "gnucashxml", "stats", str(tmp_path / "missing.gnucash"))
+    assert result.returncode == 2
@@ -0,0 +1,80 @@
+import datetime
+import decimal
+
+import pytest
+
+import gnucashxml
+
+D = decimal.Decimal
+
+GROCERIES = "acc00000000000000000000000000099"
+
+
+@pytest.fixture
+def next_year(sample, tmp_path):
+    # The sample book continued: the first eight transactions dropped,
+    # the last two carried over, one new one, and the groceries account
+    # under a new GUID.
+    book = gnucashxml.from_filename(sample)
+    for trn in book.transactions[:8]:
+        for split in trn.splits:
+            split.account.splits.remove(split)
+    del book.transactions[:8]
+    book.find_account("Groceries").guid = GROCERIES
+    gnucashxml.add_transactions(book, [
+        {"date": "2020-04-03 10:59:00 +0100", "description": "Grocery store",
+         "account": "Assets:Bank", "value": "-20.10", "transfer": "Expenses:Groceries"}])
+    path = str(tmp_path / "next.gnucash")
+    gnucashxml.to_filename(book, path)
+    return path
+
+
+@pytest.mark.parametrize("options", [{}, {"lazy": True}])
+def test_consolidated(sample, next_year, options):
+    books = gnucashxml.ConsolidatedBook([next_year, sample], **options)
+    transactions = list(books.transactions)
+    assert len(transactions) == 11
+    dates = [trn.date for trn in transactions]
+    assert dates == sorted(dates)
+    # the first book given wins for the carried-over transactions
+    sell = transactions[8]
+    assert sell.description == "Sell ACME"
+    assert sell is books.books[0].find_guid(sell.guid)
+    assert transactions[-1].description == "Grocery store"
+
+    bank = books.find_account("Bank")
+    assert len(bank.members) == 2
+    assert bank.fullname() == "Assets:Bank"
+    assert len(bank.splits) == 10
+    assert sum(split.quantity for split in bank.splits) == D("8842.20") - D("20.10")
+
+    groceries = books.find_account("Groceries")
+    assert [member.guid for member in groceries.members] == [GROCERIES,
+                                                              "acc00000000000000000000000000012"]
+    assert [split.value for split in groceries.splits] == [D("45.50"), D("62.30"), D("20.10")]
+    assert books.find_guid(GROCERIES) is groceries
+    assert books.find_guid(transactions[0].guid).description == "Opening balance"
+    assert groceries.parent is books.find_account("Expenses")
+    assert [child.name for child in books.root_account.children] == [
+        "Assets", "Liabilities", "Income", "Expenses", "Equity"]
+    assert len(list(books.prices)) == 3
+    assert len(books.invoices) == 1
+    assert len(books.commodities) == 2
+
+
+def test_by_guid(sample, next_year):
+    books = gnucashxml.ConsolidatedBook([sample, next_year], key="guid")
+    assert len(books.accounts) == 15
+    groceries = [account for account in books.accounts if account.name == "Groceries"]
+    assert [len(account.splits) for account in groceries] == [2, 1]
+    assert len(list(books.transactions)) == 11
+
+
+def test_ledger(sample, next_year):
+    books = gnucashxml.ConsolidatedBook([sample, next_year])
+    assert books.ledger().count("Grocery store") == 3
+
+
+def test_unknown_key(sample):
+    with pytest.raises(ValueError):
+        gnucashxml.ConsolidatedBook([sample], key="name")
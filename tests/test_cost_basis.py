@@ -0,0 +1,78 @@
+import datetime
+import decimal
+
+import pytest
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def test_lots(book):
+    broker = book.find_account("Broker")
+    lot, = broker.lots
+    assert lot.title == "Lot 1"
+    assert lot.account is broker
+    assert [split.quantity for split in lot.splits] == [D("10"), D("10"), D("-15")]
+    assert not lot.is_closed
+    assert broker.splits[0].lot is lot
+    receivable, = book.find_account("Accounts Receivable").lots
+    assert receivable.slots["gncInvoice"]["invoice-guid"] == book.invoices[0].guid
+
+
+@pytest.mark.parametrize("method, realized, held, cost, lots", [
+    ("fifo", D("350"), D("5"), D("600"), [(D("0"), D("300")), (D("5"), D("50"))]),
+    ("lifo", D("250"), D("5"), D("500"), [(D("5"), D("150")), (D("0"), D("100"))]),
+    ("average", D("300"), D("5"), D("550"), [(D("2.5"), D("225")), (D("2.5"), D("75"))]),
+])
+def test_report(book, method, realized, held, cost, lots):
+    report = book.cost_basis(book.find_account("Broker"), method).report()
+    assert report.realized == realized
+    assert report.quantity == held
+    assert report.cost == cost
+    assert report.price == D("130")
+    assert report.unrealized == held * D("130") - cost
+    assert [(lot.remaining, lot.realized) for lot in report.lots] == lots
+    assert [lot.date.date() for lot in report.lots] == [datetime.date(2020, 1, 10),
+                                                         datetime.date(2020, 2, 10)]
+
+
+def test_as_of(book):
+    engine = book.cost_basis(book.find_account("Broker"))
+    report = engine.report(datetime.date(2020, 2, 15))
+    assert (report.quantity, report.cost, report.realized) == (D("20"), D("2200"), D("0"))
+    assert report.price == D("120")
+    assert report.unrealized == D("200")
+    report = engine.report(datetime.datetime(2020, 1, 31, 12, 0))
+    assert (report.quantity, report.cost, report.price) == (D("10"), D("1000"), D("100.01"))
+    report = engine.report(datetime.date(2019, 12, 31))
+    assert report.lots == [] and report.price is None and report.unrealized is None
+    # an earlier date after a later one replays from the saved states
+    assert engine.report().realized == D("350")
+    assert engine.report(datetime.date(2020, 2, 15)).cost == D("2200")
+
+
+def test_checkpoints(book):
+    broker = book.find_account("Broker")
+    for method in ("fifo", "lifo", "average"):
+        engine = gnucashxml.CostBasis(broker, method, book.prices, checkpoint=1)
+        expected = book.cost_basis(broker, method)
+        for day in (datetime.date(2020, 3, 31), datetime.date(2020, 1, 31), None):
+            assert engine.report(day).realized == expected.report(day).realized
+
+
+def test_engine_follows_book(book):
+    broker = book.find_account("Broker")
+    engine = book.cost_basis(broker)
+    assert book.cost_basis(broker) is engine
+    gnucashxml.add_transactions(book, [
+        {"date": "2020-03-20", "account": broker, "value": "-650", "quantity": "-5",
+         "currency": "EUR", "transfer": "Assets:Bank"}])
+    report = book.cost_basis(broker).report()
+    assert report.quantity == 0
+    assert report.realized == D("350") + D("50")
+
+
+def test_unknown_method(book):
+    with pytest.raises(ValueError):
+        book.cost_basis(book.find_account("Broker"), "hifo")
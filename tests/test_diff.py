@@ -0,0 +1,41 @@
+import decimal
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def test_same(sample, book):
+    assert len(gnucashxml.diff_books(sample, sample)) == 0
+    assert len(gnucashxml.diff_books(book, gnucashxml.from_filename(sample, lazy=True))) == 0
+
+
+def test_changes(sample, tmp_path):
+    book = gnucashxml.from_filename(sample)
+    trn = book.transactions[2]
+    trn.description = "Market"
+    trn.splits[0].value = trn.splits[0].quantity = D("46.50")
+    trn.splits[1].value = trn.splits[1].quantity = D("-46.50")
+    removed = book.prices.pop()
+    report = gnucashxml.add_transactions(book, [
+        {"date": "2020-03-20", "description": "Bakery", "account": "Assets:Bank",
+         "value": "-3.20", "transfer": "Expenses:Groceries"}])
+    added = report.transactions[0]
+    path = str(tmp_path / "changed.gnucash")
+    gnucashxml.to_filename(book, path)
+
+    diff = gnucashxml.diff_books(sample, path)
+    assert [(change.status, change.kind, change.guid) for change in diff.modified] == [
+        ("modified", "transaction", trn.guid),
+        ("modified", "split", trn.splits[0].guid),
+        ("modified", "split", trn.splits[1].guid)]
+    assert diff.modified[0].fields == {"description": ("Grocery store", "Market")}
+    assert diff.modified[1].fields == {"value": (D("45.50"), D("46.50")),
+                                       "quantity": (D("45.50"), D("46.50"))}
+    assert [(change.kind, change.guid) for change in diff.added] == [
+        ("transaction", added.guid)] + [("split", split.guid) for split in added.splits]
+    assert diff.added[0].fields["description"] == (None, "Bakery")
+    assert [(change.kind, change.guid) for change in diff.removed] == [("price", removed.guid)]
+    assert diff.removed[0].fields["value"] == (D("130"), None)
+    assert "modified transaction {}: description 'Grocery store' -> 'Market'".format(
+        trn.guid) in str(diff)
@@ -0,0 +1,48 @@
+import io
+import warnings
+
+import pytest
+
+import gnucashxml
+
+
+def _book_data(book):
+    return [(trn.guid, trn.currency.name, trn.date, trn.date_entered, trn.description, trn.num,
+             dict(trn.slots),
+             [(split.guid, split.account.guid, split.value, split.quantity, split.memo,
+               split.action, split.reconciled_state, split.reconcile_date,
+               split.lot and split.lot.guid, dict(split.slots or {}))
+              for split in trn.splits])
+            for trn in book.transactions]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_same_as_etree(sample, book, lazy):
+    expat = gnucashxml.from_filename(sample, backend="expat", lazy=lazy, verify=True)
+    assert _book_data(expat) == _book_data(book)
+    assert expat.verification.ok
+    assert expat.schedxactions[0].transactions[0].description == "Monthly rent"
+    assert expat.invoices[0].total == book.invoices[0].total
+
+
+def test_unknown_backend(sample):
+    with pytest.raises(ValueError):
+        gnucashxml.from_filename(sample, backend="sax")
+
+
+def test_skipped_elements_are_reported(sample):
+    with open(sample, "rb") as fobj:
+        data = fobj.read()
+    data = data.replace(b"<trn:num>101</trn:num>",
+                        b"<trn:num>101</trn:num>\n  <trn:extra>kept by etree</trn:extra>")
+    out = io.BytesIO()
+    gnucashxml.write(gnucashxml.parse(io.BytesIO(data)), out)
+    assert b"<trn:extra>kept by etree</trn:extra>" in out.getvalue()
+
+    book = gnucashxml.parse(io.BytesIO(data), backend="expat")
+    with pytest.warns(UserWarning, match="^1 elements"):
+        gnucashxml.write(book, io.BytesIO())
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        gnucashxml.write(gnucashxml.from_filename(sample, backend="expat"), io.BytesIO())
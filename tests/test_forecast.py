@@ -0,0 +1,74 @@
+import datetime
+import decimal
+import io
+import itertools
+
+import gnucashxml
+
+D = decimal.Decimal
+date = datetime.date
+
+
+def test_schedxaction(book):
+    sx, = book.schedxactions
+    assert sx.name == "Monthly rent"
+    assert sx.enabled
+    assert (sx.start, sx.last, sx.end) == (date(2020, 2, 1), date(2020, 3, 1), None)
+    assert sx.instance_count == 2
+    recurrence, = sx.recurrences
+    assert (recurrence.mult, recurrence.period_type, recurrence.weekend_adj) == (1, "month", "none")
+    trn, = sx.transactions
+    assert trn.description == "Monthly rent"
+    assert sx.template_account.name == sx.guid
+    # template transactions are not part of the book
+    assert len(book.transactions) == 10
+    assert all(split.account is not sx.template_account for split in book.transactions[4].splits)
+
+
+def test_dates(book):
+    sx, = book.schedxactions
+    assert list(sx.dates(end=date(2020, 6, 30))) == [date(2020, 4, 1), date(2020, 5, 1),
+                                                      date(2020, 6, 1)]
+    assert list(sx.dates(date(2020, 5, 2), date(2020, 7, 1))) == [date(2020, 6, 1),
+                                                                  date(2020, 7, 1)]
+
+
+def test_recurrence():
+    recurrence = gnucashxml.Recurrence(1, "month", date(2020, 1, 31))
+    assert [recurrence.occurrence(n) for n in range(3)] == [
+        date(2020, 1, 31), date(2020, 2, 29), date(2020, 3, 31)]
+    recurrence = gnucashxml.Recurrence(1, "month", date(2020, 2, 1), "forward")
+    assert [recurrence.occurrence(n) for n in range(3)] == [
+        date(2020, 2, 3), date(2020, 3, 2), date(2020, 4, 1)]
+    recurrence = gnucashxml.Recurrence(2, "week", date(2020, 1, 3))
+    assert list(itertools.islice(recurrence.dates(date(2020, 1, 20)), 2)) == [
+        (2, date(2020, 1, 31)), (3, date(2020, 2, 14))]
+
+
+def test_forecast(book):
+    splits = list(book.forecast(date(2020, 3, 1), date(2020, 6, 30)))
+    assert [(split.date, split.account.name, split.amount) for split in splits] == [
+        (date(2020, 4, 1), "Rent", D("800")), (date(2020, 4, 1), "Bank", D("-800")),
+        (date(2020, 5, 1), "Rent", D("800")), (date(2020, 5, 1), "Bank", D("-800")),
+        (date(2020, 6, 1), "Rent", D("800")), (date(2020, 6, 1), "Bank", D("-800"))]
+    assert splits[0].description == "Monthly rent"
+    assert splits[0].schedxaction is book.schedxactions[0]
+
+
+def test_forecast_columnar(book):
+    columns = book.forecast(datetime.datetime(2020, 3, 1), date(2020, 6, 30), columnar=True)
+    assert columns["date"] == [date(2020, 4, 1), date(2020, 5, 1), date(2020, 6, 1)] * 2
+    assert [account.name for account in columns["account"]] == ["Rent"] * 3 + ["Bank"] * 3
+    assert sum(columns["amount"]) == 0
+
+
+def test_written(book):
+    sx, = book.schedxactions
+    sx.last = date(2020, 4, 1)
+    sx.name = "Rent"
+    out = io.BytesIO()
+    gnucashxml.write(book, out)
+    again = gnucashxml.parse(io.BytesIO(out.getvalue()), verify=True)
+    assert again.verification.ok
+    assert [(sx.name, sx.last) for sx in again.schedxactions] == [("Rent", date(2020, 4, 1))]
+    assert len(list(again.forecast(date(2020, 3, 1), date(2020, 6, 30)))) == 4
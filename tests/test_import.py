@@ -0,0 +1,89 @@
+import datetime
+import decimal
+import io
+
+import pytest
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def test_rows(book):
+    bank = book.find_account("Bank")
+    before = len(bank.splits)
+    report = gnucashxml.add_transactions(book, [
+        {"transaction": 1, "date": "2020-03-20", "description": "Books",
+         "account": "Expenses:Groceries", "value": "12.40", "memo": "cookbook"},
+        {"transaction": 1, "account": bank, "value": "-12.40"},
+        {"date": datetime.date(2020, 3, 21), "description": "Refund",
+         "account": "Assets:Bank", "value": D("30"), "transfer": "Income:Sales"},
+    ])
+    assert report.ok
+    assert len(report.transactions) == 2
+    books, refund = report.transactions
+    assert books.description == "Books"
+    assert str(books.currency) == "EUR"
+    assert [split.value for split in books.splits] == [D("12.40"), D("-12.40")]
+    assert books.splits[0].memo == "cookbook"
+    assert [(split.account.name, split.value) for split in refund.splits] == [
+        ("Bank", D("30")), ("Sales", D("-30"))]
+    assert refund.date.date() == datetime.date(2020, 3, 21)
+    assert refund.date.tzinfo is not None
+    assert len(book.transactions) == 12
+    assert len(bank.splits) == before + 2
+    assert len(set(trn.guid for trn in book.transactions)) == 12
+
+
+def test_columns(book):
+    report = gnucashxml.add_transactions(book, {
+        "transaction": ["a", "a"],
+        "date": ["2020-03-31", None],
+        "description": ["Interest", None],
+        "account": ["Assets:Bank", "Income:Salary"],
+        "value": ["1.25", "-1.25"],
+    })
+    assert report.ok
+    trn, = report.transactions
+    assert trn.description == "Interest"
+    assert sum(split.value for split in trn.splits) == 0
+
+
+def test_errors(book):
+    report = gnucashxml.add_transactions(book, [
+        {"transaction": 1, "date": "2020-03-20", "account": "Assets:Bank", "value": "10"},
+        {"transaction": 1, "account": "Income:Sales", "value": "-9"},
+        {"transaction": 2, "date": "2020-03-20", "account": "Assets:Nowhere", "value": "5",
+         "transfer": "Income:Sales"},
+        {"transaction": 3, "date": "2020-03-20", "account": "Assets:Broker", "value": "100",
+         "currency": "EUR", "transfer": "Assets:Bank"},
+        {"transaction": 4, "date": "2020-03-20", "account": "Assets:Broker", "value": "100",
+         "currency": "EUR", "quantity": "1", "transfer": "Assets:Bank"},
+    ])
+    assert not report.ok
+    assert [error.row for error in report.errors] == [0, 1, 2, 3]
+    assert "off by 1" in report.errors[0].message
+    assert "Unknown account" in report.errors[2].message
+    assert "Missing quantity" in report.errors[3].message
+    trn, = report.transactions
+    assert [split.quantity for split in trn.splits] == [D("1"), D("-100")]
+    assert len(book.transactions) == 11
+
+
+def test_written(book):
+    report = gnucashxml.add_transactions(book, [
+        {"date": "2020-03-20 12:00:00 +0100", "description": "Books", "account": "Assets:Bank",
+         "value": "-12.40", "transfer": "Expenses:Groceries"}])
+    out = io.BytesIO()
+    gnucashxml.write(book, out)
+    again = gnucashxml.parse(io.BytesIO(out.getvalue()), verify=True)
+    assert again.verification.ok
+    trn = again.find_guid(report.transactions[0].guid)
+    assert trn.description == "Books"
+    assert [split.value for split in trn.splits] == [D("-12.40"), D("12.40")]
+
+
+def test_lazy(sample):
+    book = gnucashxml.from_filename(sample, lazy=True)
+    with pytest.raises(ValueError):
+        gnucashxml.add_transactions(book, [])
@@ -0,0 +1,28 @@
+import decimal
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def test_totals(book):
+    invoice, = book.invoices
+    assert invoice.subtotal == D("1000")
+    assert invoice.total == D("1210")
+    taxtable, = invoice.tax_by_table
+    assert taxtable.name == "VAT 21%"
+    assert invoice.tax_by_table[taxtable] == D("210")
+
+
+def test_totals_follow_entries(book):
+    invoice, = book.invoices
+    assert invoice.total == D("1210")
+    invoice.entries = [entry for entry in invoice.entries if entry.action == "Hours"]
+    assert invoice.total == D("1210")
+    invoice.invalidate_totals()
+    assert invoice.total == D("968")
+
+
+def test_compute_invoice_totals(book):
+    gnucashxml.compute_invoice_totals(book.invoices)
+    assert [invoice.total for invoice in book.invoices] == [D("1210")]
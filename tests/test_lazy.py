@@ -0,0 +1,78 @@
+import gzip
+
+import pytest
+
+import gnucashxml
+
+
+def _transactions(book):
+    return [(trn.guid, trn.date, trn.description,
+             [(split.guid, split.account.guid, split.value, split.quantity, split.memo)
+              for split in trn.splits])
+            for trn in book.transactions]
+
+
+def test_same_as_eager(sample, book):
+    lazy = gnucashxml.from_filename(sample, lazy=True)
+    assert isinstance(lazy.transactions, gnucashxml._LazyTransactions)
+    assert _transactions(lazy) == _transactions(book)
+    assert [account.guid for account in lazy.accounts] == [account.guid for account in book.accounts]
+    assert len(lazy.invoices) == 1
+
+
+def test_index(sample):
+    book = gnucashxml.from_filename(sample, lazy=True)
+    index = book.transactions.index
+    assert len(index) == 10
+    assert index.dates[0] == "2020-01-01 10:59:00 +0100"
+    guid = book.transactions[8].guid
+    assert index.position(guid) == 8
+    assert book.find_guid(guid).description == "Sell ACME"
+    assert book.find_guid("0" * 32) is None
+
+
+def test_account_splits(sample, book):
+    lazy = gnucashxml.from_filename(sample, lazy=True)
+    for name in ("Bank", "Broker", "Sales"):
+        splits = lazy.find_account(name).splits
+        expected = [split.guid for split in book.find_account(name).splits]
+        assert len(splits) == len(expected)
+        assert [split.guid for split in splits] == expected
+        assert [splits[i].guid for i in range(len(splits))] == expected
+        assert [split.guid for split in splits[1:]] == expected[1:]
+    # both Sales splits of the invoice transaction
+    assert len(lazy.find_account("Sales").splits) == 2
+    with pytest.raises(IndexError):
+        lazy.find_account("Sales").splits[2]
+
+
+def test_cache(sample):
+    book = gnucashxml.from_filename(sample, lazy=True, cache_size=2)
+    first = book.transactions[0]
+    assert book.transactions[0] is first
+    for trn in book.transactions:
+        pass
+    again = book.transactions[0]
+    assert again is not first
+    assert again.guid == first.guid
+    assert again.splits[0].value == first.splits[0].value
+
+
+@pytest.mark.parametrize("where", [b"<gnc:transaction", b"<split:value>", b"</trn:splits>",
+                                   b"<gnc:schedxaction", b"<gnc:GncInvoice", b"</gnc:book>"])
+def test_truncated(sample, tmp_path, where):
+    with open(sample, "rb") as fobj:
+        data = fobj.read()
+    path = tmp_path / "truncated.gnucash"
+    path.write_bytes(data[:data.rindex(where) + 5])
+    with pytest.raises(ValueError):
+        gnucashxml.from_filename(str(path), lazy=True)
+
+
+def test_truncated_compressed(sample, tmp_path):
+    with open(sample, "rb") as fobj:
+        data = gzip.compress(fobj.read())
+    path = tmp_path / "truncated.gnucash"
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(ValueError):
+        gnucashxml.from_filename(str(path), lazy=True)
@@ -0,0 +1,81 @@
+import decimal
+import fractions
+import io
+
+import gnucashxml
+from gnucashxml import Money
+
+D = decimal.Decimal
+
+
+def test_arithmetic():
+    a = Money(4550, 100)
+    b = Money(1000050, 10000)
+    assert a + b == D("145.505")
+    assert (a + b).scale == 10000
+    assert a - 1 == D("44.50")
+    assert 1 - a == D("-44.50")
+    assert a * 3 == Money(13650, 100)
+    assert a * Money(21, 100) == D("9.555")
+    assert a / 2 == D("22.75")
+    assert -a == Money(-4550, 100) and abs(-a) == a
+    assert Money.sum([a, a, Money(1, 100)]) == Money(9101, 100)
+    assert Money.sum([a, b]) == a + b
+    assert sum([a, a]) == D("91")
+    assert Money.from_decimal("100.005") == b
+    assert Money.from_decimal(D("12")) == Money(12)
+
+
+def test_comparison_and_hash():
+    assert Money(4550, 100) == Money(455, 10) == D("45.5") == fractions.Fraction(91, 2)
+    assert Money(300, 100) == 3
+    assert hash(Money(300, 100)) == hash(3)
+    assert hash(Money(4550, 100)) == hash(D("45.50")) == hash(fractions.Fraction(91, 2))
+    assert len({Money(4550, 100), D("45.5"), Money(91, 2)}) == 1
+    assert Money(-1, 100) < 0 < Money(1, 100) <= D("0.01")
+    assert Money(1, 3) != D("0.33")
+    assert not Money(0, 100) and Money(1, 100)
+
+
+def test_rounding_and_text():
+    b = Money(1000050, 10000)
+    assert round(b, 2) == D("100.00")
+    assert round(Money(1000150, 10000), 2) == D("100.02")
+    assert round(b, 2).scale == 100
+    assert round(b) == 100
+    assert str(b) == "100.0050"
+    assert repr(Money(4550, 100)) == "Money('45.50')"
+    assert str(Money(1, 3)) == "1/3"
+    assert "{:.1f}".format(Money(4550, 100)) == "45.5"
+    assert int(Money(-4550, 100)) == -45
+    assert float(Money(1, 4)) == 0.25
+    assert Money(4550, 100).to_decimal() == D("45.50")
+
+
+def test_exact_book(sample, book):
+    exact = gnucashxml.from_filename(sample, exact=True)
+    assert exact.exact and not book.exact
+    split = exact.transactions[2].splits[0]
+    assert isinstance(split.value, Money)
+    assert (split.value.units, split.value.scale) == (4550, 100)
+    assert exact.find_account("Broker").splits[0].quantity == Money(10, 1)
+    # rounded to cents without exact=True
+    assert exact.prices[0].value == D("100.005")
+    assert book.prices[0].value == D("100.01")
+    assert exact.invoices[0].total == D("1210")
+    assert exact.cost_basis(exact.find_account("Broker")).report().realized == D("350")
+    assert sum(split.value for split in exact.root_account.get_all_splits()) == 0
+
+
+def test_exact_written(sample):
+    book = gnucashxml.from_filename(sample, exact=True)
+    split = book.transactions[2].splits[0]
+    split.value = split.quantity = split.value + Money(1, 1000)
+    book.transactions[2].splits[1].value -= Money(1, 1000)
+    out = io.BytesIO()
+    gnucashxml.write(book, out)
+    assert b"<split:value>45501/1000</split:value>" in out.getvalue()
+    assert b"<price:value>1000050/10000</price:value>" in out.getvalue()
+    again = gnucashxml.parse(io.BytesIO(out.getvalue()), exact=True, verify=True)
+    assert again.verification.ok
+    assert again.transactions[2].splits[0].value == D("45.501")
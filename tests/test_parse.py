@@ -0,0 +1,73 @@
+import datetime
+import decimal
+import io
+
+import gnucashxml
+import synthbook
+
+D = decimal.Decimal
+
+
+def test_accounts(book):
+    assert book.guid == "b00c0000000000000000000000000001"
+    assert book.root_account.actype == "ROOT"
+    assert len(book.accounts) == 14
+    bank = book.find_account("Bank")
+    assert bank.fullname() == "Assets:Bank"
+    assert bank.actype == "BANK"
+    assert bank.description == "Current account"
+    assert bank.slots["reconcile-info"]["include-children"] == 0
+    assert [child.name for child in book.find_account("Income").children] == ["Salary", "Sales"]
+    assert str(book.find_account("Broker").commodity) == "ACME"
+
+
+def test_transactions(book):
+    assert len(book.transactions) == 10
+    trn = book.transactions[2]
+    assert trn.description == "Grocery store"
+    assert trn.num == "101"
+    assert trn.date == datetime.datetime(2020, 1, 15, 10, 59, tzinfo=trn.date.tzinfo)
+    assert trn.date.utcoffset() == datetime.timedelta(hours=1)
+    assert [split.value for split in trn.splits] == [D("45.50"), D("-45.50")]
+    assert trn.splits[0].memo == "weekly shopping"
+    assert trn.splits[0].account is book.find_account("Groceries")
+    assert book.find_guid(trn.guid) is trn
+    assert book.transactions[4].slots["notes"] == "paid by transfer"
+
+
+def test_balances(book):
+    def balance(name):
+        return sum(split.quantity for split in book.find_account(name).splits)
+
+    assert balance("Bank") == D("8842.20")
+    assert balance("Broker") == D("5")
+    assert balance("Groceries") == D("107.80")
+    assert sum(split.value for split in book.root_account.get_all_splits()) == 0
+
+
+def test_prices(book):
+    assert [(price.date.date(), price.value) for price in sorted(book.prices)] == [
+        (datetime.date(2020, 1, 10), D("100.01")),
+        (datetime.date(2020, 2, 10), D("120.00")),
+        (datetime.date(2020, 3, 10), D("130.00"))]
+    assert str(book.prices[0].commodity) == "ACME"
+    assert str(book.prices[0].currency) == "EUR"
+
+
+def test_invoice(book):
+    invoice, = book.invoices
+    assert invoice.id == "2020-001"
+    assert invoice.customer.name == "Sample Customer"
+    assert sorted((entry.description, entry.qty, entry.price) for entry in invoice.entries) == [
+        ("Consulting services", D("8.00"), D("100.00")),
+        ("Travel expenses", D("1.00"), D("200.00"))]
+
+
+def test_synthbook_loads():
+    first, second = io.BytesIO(), io.BytesIO()
+    synthbook.generate(first, accounts=10, transactions=50, prices=5, customers=2, invoices=3)
+    synthbook.generate(second, accounts=10, transactions=50, prices=5, customers=2, invoices=3)
+    assert first.getvalue() == second.getvalue()
+    book = gnucashxml.parse(io.BytesIO(first.getvalue()))
+    assert len(book.transactions) == 50
+    assert len(book.invoices) == 3
@@ -0,0 +1,71 @@
+import datetime
+import decimal
+import io
+
+import gnucashxml
+
+D = decimal.Decimal
+date = datetime.date
+
+STATEMENT = [
+    {"date": "2020-01-11", "amount": "-1000"},
+    {"date": date(2020, 1, 15), "amount": D("-45.50"), "reference": "101"},
+    {"date": "2020-01-31", "amount": "2500.00"},
+    {"date": "2020-02-03", "amount": "-800"},
+    {"date": "2020-02-20", "amount": "-62.30"},
+    {"date": "2020-03-01", "amount": "2500"},
+    {"date": "2020-03-02", "amount": "lots"},
+]
+
+
+def test_reconcile(book):
+    bank = book.find_account("Bank")
+    report = gnucashxml.reconcile(bank, STATEMENT)
+    assert [line.status for line in report.lines] == [
+        "matched", "matched", "matched", "matched", "unmatched", "matched"]
+    assert [line.split.transaction.description for line in report.matched] == [
+        "Buy ACME", "Grocery store", "Salary January", "Monthly rent", "Salary February"]
+    assert [error.row for error in report.errors] == [6]
+    # the reconciled opening balance is not a candidate
+    assert [split.transaction.date.date() for split in report.missing] == [
+        date(2020, 2, 10), date(2020, 2, 14)]
+    assert report.lines[4].split is None
+
+    assert report.mark(date=datetime.datetime(2020, 3, 31)) == 5
+    assert [split.reconciled_state for split in bank.splits] == [
+        "y", "c", "c", "c", "c", "n", "n", "c", "n"]
+    assert bank.splits[1].reconcile_date == datetime.datetime(2020, 3, 31)
+
+
+def test_window_and_reference(book):
+    bank = book.find_account("Bank")
+    report = gnucashxml.reconcile(bank, [{"date": "2020-02-15", "amount": "2500"}], window=30)
+    assert report.lines[0].split.transaction.description == "Salary February"
+    report = gnucashxml.reconcile(bank, {"date": ["2020-02-15"], "amount": ["2500"],
+                                         "reference": ["january"]}, window=30)
+    assert report.lines[0].split.transaction.description == "Salary January"
+    report = gnucashxml.reconcile(bank, [{"date": "2020-02-20", "amount": "-62.30"}], window=6)
+    assert report.lines[0].status == "matched"
+
+
+def test_ambiguous(book):
+    bank = book.find_account("Bank")
+    gnucashxml.add_transactions(book, [
+        {"date": "2020-03-20 10:59:00 +0100", "account": bank, "value": "-9.99",
+         "transfer": "Expenses:Groceries"} for i in range(2)])
+    report = gnucashxml.reconcile(bank, [{"date": "2020-03-20", "amount": "-9.99"},
+                                         {"date": "2020-03-21", "amount": "-9.99"}])
+    # two equal splits on the same day cannot be told apart
+    assert [line.status for line in report.lines] == ["ambiguous", "ambiguous"]
+    assert len(report.ambiguous[0].splits) == 2
+    assert report.mark() == 0
+
+
+def test_write(book):
+    report = gnucashxml.reconcile(book.find_account("Bank"), STATEMENT)
+    out = io.StringIO()
+    report.write(out)
+    rows = out.getvalue().splitlines()
+    assert rows[0] == "row,status,date,amount,reference,split,split_date,description"
+    assert len(rows) == 1 + 6 + 1 + 2
+    assert rows[1].startswith("0,matched,2020-01-11,-1000,,")
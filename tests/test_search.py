@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+import gnucashxml
+
+
+def _descriptions(objects):
+    return [getattr(obj, "description", None) or obj.name for obj in objects]
+
+
+def test_search(book):
+    assert _descriptions(book.search("grocery")) == ["Grocery store", "Grocery store"]
+    assert book.search("WEEKLY shopping") == [book.transactions[2]]
+    assert _descriptions(book.search("sal*")) == ["Salary January", "Salary February"]
+    assert book.search("transfer") == [book.transactions[4]]
+    assert _descriptions(book.search("consult*")) == ["Sample Customer", "Consulting services"]
+    customer = book.invoices[0].customer
+    assert book.search("sample customer") == [book.transactions[9], customer]
+    assert book.search("acme sell") == [book.transactions[8]]
+    assert book.search("acme bakery") == []
+    assert book.search("") == []
+    assert book.search("acme", guids=True) == [book.transactions[i].guid for i in (1, 5, 8)]
+
+
+def test_added_transactions(book):
+    assert len(book.text_index) == 13
+    report = gnucashxml.add_transactions(book, [
+        {"date": "2020-03-20", "description": "Bakery", "account": "Assets:Bank",
+         "value": "-3.20", "transfer": "Expenses:Groceries"}])
+    assert book.search("bakery") == report.transactions
+
+
+def test_lazy(sample, book):
+    lazy = gnucashxml.from_filename(sample, lazy=True, cache_size=1, text_index=True)
+    index = lazy.text_index
+    # only GUIDs of transactions are kept, the cache decides what stays decoded
+    assert not any(isinstance(obj, gnucashxml.Transaction) for obj in index._objects.values())
+    found = lazy.search("acme")
+    assert [trn.guid for trn in found] == [trn.guid for trn in book.search("acme")]
+    assert found[0].description == "Buy ACME"
+    assert lazy.search("acme", guids=True) == book.search("acme", guids=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_save_and_load(sample, lazy):
+    book = gnucashxml.from_filename(sample, lazy=lazy)
+    out = io.BytesIO()
+    book.text_index.save(out)
+    index = gnucashxml.TextIndex.load(io.BytesIO(out.getvalue()), book)
+    assert len(index) == 13
+    assert index.search("sal*", guids=True) == book.search("sal*", guids=True)
+    assert [obj.guid for obj in index.search("consulting")] == book.search("consulting", True)
+
+    other = gnucashxml.from_filename(sample)
+    other.guid = "0" * 32
+    with pytest.raises(ValueError):
+        gnucashxml.TextIndex.load(io.BytesIO(out.getvalue()), other)
@@ -0,0 +1,62 @@
+import decimal
+import io
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def _damaged(sample, old, new):
+    with open(sample, "rb") as fobj:
+        data = fobj.read()
+    assert data.count(old) == 1
+    return io.BytesIO(data.replace(old, new))
+
+
+def test_ok(sample):
+    book = gnucashxml.from_filename(sample, verify=True)
+    report = book.verification
+    assert report.ok
+    assert str(report) == "ok"
+    assert report.counts["transaction"] == (10, 10)
+    assert report.counts["account"] == (15, 15)
+    assert report.counts["price"] == (3, 3)
+    assert report.counts["gnc:GncCustomer"] == (2, 2)
+    assert gnucashxml.from_filename(sample).verification is None
+
+
+def test_lazy(sample):
+    report = gnucashxml.from_filename(sample, lazy=True, verify=True).verification
+    assert report.ok
+    assert not report.balance_checked
+    assert report.counts["transaction"] == (10, 10)
+
+
+def test_unbalanced(sample):
+    book = gnucashxml.parse(_damaged(sample, b"<split:value>4550/100<", b"<split:value>4551/100<"),
+                            verify=True)
+    report = book.verification
+    assert not report.ok
+    assert report.unbalanced == [(book.transactions[2].guid, D("0.01"))]
+
+
+def test_unknown_account(sample):
+    guid = b"acc00000000000000000000000000012"
+    with open(sample, "rb") as fobj:
+        data = fobj.read()
+    # the groceries split of the first shopping trip
+    position = data.index(guid, data.index(b"weekly shopping"))
+    data = data[:position] + b"f" * 32 + data[position + 32:]
+    book = gnucashxml.parse(io.BytesIO(data), verify=True)
+    report = book.verification
+    trn = book.transactions[2]
+    assert report.unresolved == [(trn.guid, "5b000000000000000000000000000005", "f" * 32)]
+    assert len(trn.splits) == 1
+    assert not report.ok
+
+
+def test_count_mismatch(sample):
+    report = gnucashxml.parse(_damaged(sample, b'cd:type="transaction">10<',
+                                       b'cd:type="transaction">11<'), verify=True).verification
+    assert report.count_mismatches == [("transaction", 11, 10)]
+    assert "transaction declared 11, parsed 10" in str(report)
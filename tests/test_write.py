@@ -0,0 +1,92 @@
+import datetime
+import decimal
+import io
+from xml.etree import ElementTree
+
+import pytest
+
+import gnucashxml
+
+D = decimal.Decimal
+
+
+def _lines(element, depth=0, lines=None):
+    # The elements in document order, without the whitespace between them
+    if lines is None:
+        lines = []
+    lines.append((depth, element.tag, sorted(element.attrib.items()), (element.text or "").strip()))
+    for child in element:
+        _lines(child, depth + 1, lines)
+    return lines
+
+
+def _written(book):
+    out = io.BytesIO()
+    gnucashxml.write(book, out)
+    return out.getvalue()
+
+
+def _slot_types(data, key):
+    root = ElementTree.fromstring(data)
+    return [slot.find("{http://www.gnucash.org/XML/slot}value").get("type")
+            for slot in root.iter("slot")
+            if slot.findtext("{http://www.gnucash.org/XML/slot}key") == key]
+
+
+@pytest.mark.parametrize("options", [{}, {"lazy": True}, {"backend": "expat"}, {"exact": True}])
+def test_unchanged_book_is_written_as_read(sample, options):
+    with open(sample, "rb") as fobj:
+        raw = fobj.read()
+    book = gnucashxml.from_filename(sample, **options)
+    assert _lines(ElementTree.fromstring(_written(book))) == _lines(ElementTree.fromstring(raw))
+
+
+@pytest.mark.parametrize("options", [{}, {"lazy": True}, {"backend": "expat"}])
+def test_changes_are_written(sample, options):
+    book = gnucashxml.from_filename(sample, **options)
+    trn = book.transactions[2]
+    trn.description = "Market & <bakery>"
+    trn.splits[0].value = trn.splits[0].quantity = D("46.50")
+    trn.splits[1].value = trn.splits[1].quantity = D("-46.50")
+    trn.slots["receipt"] = 17
+    trn.date = datetime.datetime(2020, 1, 16, 10, 59, tzinfo=trn.date.tzinfo)
+    book.find_account("Groceries").name = "Food"
+    data = _written(book)
+
+    again = gnucashxml.parse(io.BytesIO(data), verify=True)
+    assert again.verification.ok
+    trn = again.find_guid(trn.guid)
+    assert trn.description == "Market & <bakery>"
+    assert [split.value for split in trn.splits] == [D("46.50"), D("-46.50")]
+    assert trn.slots["receipt"] == 17
+    assert trn.date.date() == datetime.date(2020, 1, 16)
+    assert trn.splits[0].account.name == "Food"
+    assert _slot_types(data, "receipt") == ["integer"]
+
+
+def test_slot_types_are_kept(sample):
+    book = gnucashxml.from_filename(sample)
+    book.find_account("Broker").slots["last-price"] = 131.25
+    split = book.transactions[2].splits[1]
+    split.slots["online_id"] = "b6e4f2a1d3c5b7e9f1a2b4d6f8c0e2a4"
+    book.transactions[4].slots["from-sched-xaction"] = "5c000000000000000000000000000002"
+    data = _written(book)
+    assert _slot_types(data, "last-price") == ["double"]
+    assert _slot_types(data, "online_id") == ["string"]
+    assert _slot_types(data, "from-sched-xaction") == ["guid"]
+    assert _slot_types(data, "date-posted").count("gdate") == 11
+
+    again = gnucashxml.parse(io.BytesIO(data))
+    assert again.find_account("Broker").slots["last-price"] == 131.25
+    assert again.transactions[2].splits[1].slots["online_id"] == "b6e4f2a1d3c5b7e9f1a2b4d6f8c0e2a4"
+
+
+def test_to_filename(sample, tmp_path):
+    book = gnucashxml.from_filename(sample)
+    path = str(tmp_path / "copy.gnucash")
+    gnucashxml.to_filename(book, path)
+    with open(path, "rb") as fobj:
+        assert fobj.read(2) == b"\x1f\x8b"
+    again = gnucashxml.from_filename(path)
+    assert [trn.guid for trn in again.transactions] == [trn.guid for trn in book.transactions]
+    assert again.invoices[0].total == book.invoices[0].total